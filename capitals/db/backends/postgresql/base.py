@@ -0,0 +1,7 @@
+from django.db.backends.postgresql import base
+
+from capitals.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """PostgreSQL backend with pooled, health-checked connections."""
@@ -0,0 +1,7 @@
+from django.db.backends.sqlite3 import base
+
+from capitals.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """SQLite backend with pooled, health-checked connections."""
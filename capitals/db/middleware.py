@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.urls import NoReverseMatch, reverse
+
+from location.middleware import HybridMiddleware
+
+from .routers import begin_routing, end_routing, routing_state
+
+# Cookie that keeps a client's reads on the primary after it writes.
+PRIMARY_COOKIE = 'db_primary'
+
+
+class PrimaryStickinessMiddleware(HybridMiddleware):
+    """
+    Keep reads on the primary database where replicas could be stale.
+
+    Requests to the admin, and requests carrying the cookie set after a
+    write, read from the primary. A request that writes a location model
+    sets the cookie for LOCATION_REPLICA_STICKY_SECONDS. See
+    capitals.db.routers.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = begin_routing(pinned=self.needs_primary(request))
+        try:
+            response = self.get_response(request)
+            return self.finish(response)
+        finally:
+            end_routing(token)
+
+    async def __acall__(self, request):
+        token = begin_routing(pinned=self.needs_primary(request))
+        try:
+            response = await self.get_response(request)
+            return self.finish(response)
+        finally:
+            end_routing(token)
+
+    def needs_primary(self, request):
+        if PRIMARY_COOKIE in request.COOKIES:
+            return True
+        try:
+            admin_prefix = reverse('admin:index')
+        except NoReverseMatch:
+            return False
+        return request.path.startswith(admin_prefix)
+
+    def finish(self, response):
+        replicas = getattr(settings, 'LOCATION_READ_REPLICAS', None)
+        if replicas and routing_state().wrote:
+            response.set_cookie(
+                PRIMARY_COOKIE, '1',
+                max_age=getattr(
+                    settings, 'LOCATION_REPLICA_STICKY_SECONDS', 10),
+                httponly=True, samesite='Lax')
+        return response
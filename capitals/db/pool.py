@@ -0,0 +1,163 @@
+"""
+Connection pooling and health checks for the database backends.
+
+The backends in capitals.db.backends wrap Django's own. When a
+connection is closed at the end of a request it goes back to a bounded
+pool of idle connections for its database alias instead, and the next
+connection made by any thread of the process takes one from the pool,
+saving the TCP round trip and authentication of a new one.
+
+A connection is checked with a cheap query before its first use in a
+request, so a connection the server dropped is replaced instead of
+failing the request. Connections opened, reused and failed are counted
+in the location_db_connections_total metric.
+"""
+import threading
+from collections import deque
+
+from location.metrics import inc
+
+
+def record(alias, event):
+    inc('location_db_connections_total', {'alias': alias, 'event': event})
+
+
+class ConnectionPool:
+    """Idle database connections shared by the threads of a process."""
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Take the most recently used idle connection, if any."""
+        with self._lock:
+            return self._idle.pop() if self._idle else None
+
+    def put(self, connection):
+        """Keep a connection for reuse. Return False if the pool is full."""
+        with self._lock:
+            if len(self._idle) >= self.size:
+                return False
+            self._idle.append(connection)
+            return True
+
+    def clear(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for connection in idle:
+            _close_quietly(connection)
+
+    def __len__(self):
+        return len(self._idle)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, size):
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = ConnectionPool(size)
+        return pool
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Add pooling and health checks to a DatabaseWrapper.
+
+    Configured with the POOL_SIZE (0 disables pooling) and
+    POOL_HEALTH_CHECKS entries of the database settings.
+    """
+    _health_checked = False
+
+    @property
+    def pool(self):
+        size = self.settings_dict.get('POOL_SIZE', 0)
+        return get_pool(self.alias, size) if size else None
+
+    def ping(self, connection):
+        """Return whether a raw connection still works."""
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except self.Database.Error:
+            return False
+        return True
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is not None:
+            connection = pool.get()
+            while connection is not None:
+                if self.ping(connection):
+                    record(self.alias, 'reused')
+                    return connection
+                record(self.alias, 'failed')
+                _close_quietly(connection)
+                connection = pool.get()
+        try:
+            connection = super().get_new_connection(conn_params)
+        except Exception:
+            record(self.alias, 'failed')
+            raise
+        record(self.alias, 'opened')
+        return connection
+
+    def connect(self):
+        super().connect()
+        # New and pooled connections were just checked.
+        self._health_checked = True
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # Called when a request starts and finishes.
+        self._health_checked = False
+
+    def _cursor(self, name=None):
+        self.check_health()
+        return super()._cursor(name)
+
+    def check_health(self):
+        """Replace a connection that stopped working since its last use."""
+        if (self._health_checked or self.connection is None or
+                self.in_atomic_block or
+                not self.settings_dict.get('POOL_HEALTH_CHECKS', False)):
+            return
+        self._health_checked = True
+        if not self.ping(self.connection):
+            record(self.alias, 'failed')
+            self.discard()
+
+    def discard(self):
+        """Close the connection without returning it to the pool."""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            _close_quietly(connection)
+
+    def _close(self):
+        pool = self.pool
+        reusable = (
+            pool is not None and
+            self.connection is not None and
+            not self.in_atomic_block and
+            not self.errors_occurred and
+            self.autocommit == self.settings_dict['AUTOCOMMIT']
+        )
+        if reusable and pool.put(self.connection):
+            return
+        return super()._close()
@@ -0,0 +1,119 @@
+"""
+Routing of location reads to read replicas.
+
+With LOCATION_READ_REPLICAS set, reads of the location models are spread
+over the replica aliases by weighted round-robin, so the states page and
+the JSON API do not compete with admin writes on the primary. Writes,
+and the models of every other app such as auth, sessions and the admin
+log, stay on the primary ('default').
+
+Replicas lag behind the primary, so once a request writes a location
+model, its reads go to the primary for the rest of the request, and
+PrimaryStickinessMiddleware keeps the client's reads there for
+LOCATION_REPLICA_STICKY_SECONDS so users see their own changes. Admin
+requests always use the primary.
+"""
+import itertools
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Apps whose reads may be served by a replica.
+REPLICATED_APPS = {'location'}
+
+
+class RoutingState:
+    """Whether the current request or task must read from the primary."""
+    __slots__ = ('pinned', 'wrote')
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+# A mutable state, so writes made in a worker thread of an async request
+# are seen by the middleware that installed it.
+_state = ContextVar('capitals_db_routing_state', default=None)
+
+
+def routing_state():
+    state = _state.get()
+    if state is None:
+        state = RoutingState()
+        _state.set(state)
+    return state
+
+
+def begin_routing(pinned=False):
+    """Start a new routing state, returning a token to end it with."""
+    return _state.set(RoutingState(pinned=pinned))
+
+
+def end_routing(token):
+    _state.reset(token)
+
+
+def weighted_cycle(weights):
+    """
+    Return an endless iterator over aliases, each repeated in proportion
+    to its weight and interleaved with the others (smooth weighted
+    round-robin, as used by nginx).
+    """
+    weights = {alias: weight for alias, weight in weights.items() if weight}
+    total = sum(weights.values())
+    current = dict.fromkeys(weights, 0)
+    order = []
+    for i in range(total):
+        for alias, weight in weights.items():
+            current[alias] += weight
+        alias = max(current, key=current.get)
+        current[alias] -= total
+        order.append(alias)
+    return itertools.cycle(order)
+
+
+class ReplicaRouter:
+    """Send location reads to replicas and everything else to the primary."""
+
+    def __init__(self):
+        self._replicas = None
+        self._cycle = None
+
+    def _next_replica(self):
+        replicas = getattr(settings, 'LOCATION_READ_REPLICAS', None) or {}
+        if replicas != self._replicas:
+            self._cycle = weighted_cycle(replicas) if replicas else None
+            self._replicas = dict(replicas)
+        # next() on a cycle is atomic, so threads share it without a lock.
+        return next(self._cycle) if self._cycle is not None else None
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in REPLICATED_APPS:
+            return None
+        if routing_state().pinned:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # A transaction reads the rows it is about to write, which a
+            # replica may not have yet.
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Follow relations on the database the instance came from.
+            return instance._state.db
+        return self._next_replica()
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label in REPLICATED_APPS:
+            state = routing_state()
+            state.pinned = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        databases = {DEFAULT_DB_ALIAS}
+        databases.update(
+            getattr(settings, 'LOCATION_READ_REPLICAS', None) or ())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
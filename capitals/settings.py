@@ -31,10 +31,14 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'location'
+    'location.apps.LocationConfig'
 ]
 
 MIDDLEWARE = [
+    'location.middleware.ServerTimingMiddleware',
+    'location.middleware.MetricsMiddleware',
+    'location.middleware.CompressionMiddleware',
+    'capitals.db.middleware.PrimaryStickinessMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -42,6 +46,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'location.middleware.QueryBudgetMiddleware',
 ]
 
 ROOT_URLCONF = 'capitals.urls'
@@ -50,8 +55,14 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compile each template once per process, also in development.
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -64,13 +75,37 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'capitals.wsgi.application'
 
+# Per-process cache, used for the rendered row of each state.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'capitals',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# The PostgreSQL and SQLite backends are swapped for the wrappers in
+# capitals.db.backends, which keep up to SQL_POOL_SIZE idle connections
+# per process for reuse and check connections before their first use in
+# each request. See capitals/db/pool.py.
+
+SQL_ENGINE = os.environ.get("SQL_ENGINE", "django.db.backends.sqlite3")
+
+POOLED_ENGINES = {
+    'django.db.backends.postgresql': 'capitals.db.backends.postgresql',
+    'django.db.backends.sqlite3': 'capitals.db.backends.sqlite3',
+}
+
 DATABASES = {
     'default': {
-        'ENGINE': os.environ.get("SQL_ENGINE", "django.db.backends.sqlite3"),
+        'ENGINE': POOLED_ENGINES.get(SQL_ENGINE, SQL_ENGINE),
         'NAME': os.environ.get(
             "SQL_DATABASE", os.path.join(BASE_DIR, "db.sqlite3")
         ),
@@ -78,9 +113,40 @@ DATABASES = {
         'PASSWORD': os.environ.get("SQL_PASSWORD", "password"),
         'HOST': os.environ.get("SQL_HOST", "localhost"),
         'PORT': os.environ.get("SQL_PORT", "5432"),
+        'CONN_MAX_AGE': int(os.environ.get("SQL_CONN_MAX_AGE", 0)),
+        'POOL_SIZE': int(os.environ.get("SQL_POOL_SIZE", 4)),
+        'POOL_HEALTH_CHECKS': (
+            os.environ.get("SQL_HEALTH_CHECKS", "True") == "True"),
     }
 }
 
+# Read replicas of the default database, as a space separated list of
+# HOST[:PORT] (or database files for SQLite), each with an optional
+# =WEIGHT. For example: SQL_REPLICAS="replica-a=2 replica-b:5433".
+# Reads of states and capitals are spread over them by weight and
+# clients read from the primary for LOCATION_REPLICA_STICKY_SECONDS after
+# they write (see capitals/db/routers.py).
+
+LOCATION_READ_REPLICAS = {}
+
+for number, replica in enumerate(os.getenv('SQL_REPLICAS', '').split(), 1):
+    location, _, weight = replica.partition('=')
+    alias = 'replica{}'.format(number)
+    DATABASES[alias] = dict(
+        DATABASES['default'], TEST={'MIRROR': 'default'})
+    if 'sqlite3' in SQL_ENGINE:
+        DATABASES[alias]['NAME'] = location
+    else:
+        host, _, port = location.partition(':')
+        DATABASES[alias]['HOST'] = host
+        DATABASES[alias]['PORT'] = port or DATABASES['default']['PORT']
+    LOCATION_READ_REPLICAS[alias] = int(weight or 1)
+
+LOCATION_REPLICA_STICKY_SECONDS = int(
+    os.getenv('LOCATION_REPLICA_STICKY_SECONDS', 10))
+
+DATABASE_ROUTERS = ['capitals.db.routers.ReplicaRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -124,3 +190,125 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 STATIC_ROOT = os.path.join(BASE_DIR, "static")
+
+# Where the boot command keeps the input hashes of the start-up steps it
+# ran. Containers sharing it skip the steps another one already did.
+
+LOCATION_BOOT_STATE_DIR = os.getenv(
+    'LOCATION_BOOT_STATE_DIR', os.path.join(BASE_DIR, ".boot"))
+
+
+# Location app
+# Serve state and capital lookups from an in-memory index per worker.
+
+LOCATION_LOOKUP_INDEX = os.getenv('LOCATION_LOOKUP_INDEX', 'True') == 'True'
+
+# Remember the lookup keys of up to LOCATION_NORMALIZE_CACHE_SIZE distinct
+# query values per worker.
+
+LOCATION_NORMALIZE_CACHE_SIZE = int(
+    os.getenv('LOCATION_NORMALIZE_CACHE_SIZE', 4096))
+
+# Cache rendered state pages per dataset version and answer conditional
+# GETs with 304 Not Modified.
+
+LOCATION_PAGE_CACHE = os.getenv('LOCATION_PAGE_CACHE', 'True') == 'True'
+
+LOCATION_PAGE_CACHE_SIZE = int(os.getenv('LOCATION_PAGE_CACHE_SIZE', 256))
+
+# After a change, one request per page and worker renders it again while
+# the others wait up to LOCATION_REFILL_TIMEOUT seconds for it, or are
+# served the previous page with LOCATION_STALE_WHILE_REVALIDATE. Workers
+# take turns rebuilding a missing snapshot with file locks kept in
+# LOCATION_LOCK_DIR, and learn of changes committed by other workers from
+# a stamp file there.
+
+LOCATION_REFILL_TIMEOUT = float(os.getenv('LOCATION_REFILL_TIMEOUT', 2.0))
+
+LOCATION_STALE_WHILE_REVALIDATE = (
+    os.getenv('LOCATION_STALE_WHILE_REVALIDATE', 'False') == 'True')
+
+LOCATION_LOCK_DIR = os.getenv('LOCATION_LOCK_DIR', None)
+
+# Maximum number of queries accepted by the batch lookup API.
+
+LOCATION_BATCH_LIMIT = int(os.getenv('LOCATION_BATCH_LIMIT', 1000))
+
+# Maximum number of points accepted by the batch nearest-capital API.
+
+LOCATION_NEAREST_BATCH_LIMIT = int(
+    os.getenv('LOCATION_NEAREST_BATCH_LIMIT', 10000))
+
+# Number of rows read from the database and written at a time by the
+# CSV and NDJSON exports.
+
+LOCATION_EXPORT_CHUNK_SIZE = int(os.getenv('LOCATION_EXPORT_CHUNK_SIZE', 2000))
+
+# Log ('warn'), fail ('raise') or ignore ('off') requests that run more
+# queries than the query_budget declared on their view.
+
+LOCATION_QUERY_BUDGET_MODE = os.getenv('LOCATION_QUERY_BUDGET_MODE', 'warn')
+
+# Page size of paginated state lists when a cursor is given without one,
+# and the largest page_size a request may ask for.
+
+LOCATION_PAGE_SIZE = int(os.getenv('LOCATION_PAGE_SIZE', 25))
+
+LOCATION_MAX_PAGE_SIZE = int(os.getenv('LOCATION_MAX_PAGE_SIZE', 500))
+
+# Route read-only location views to async versions that answer from the
+# in-memory index on the event loop. Enable when serving capitals.asgi.
+
+LOCATION_ASYNC_VIEWS = os.getenv('LOCATION_ASYNC_VIEWS', 'False') == 'True'
+
+# File the lookup index is shared through by all worker processes. Workers
+# load it instead of querying the database and pick up a new version when
+# the worker that saved a change replaces it. Use a path on tmpfs, such as
+# /dev/shm, so it is served from memory.
+
+LOCATION_SNAPSHOT_PATH = os.getenv('LOCATION_SNAPSHOT_PATH', None)
+
+# Add a Server-Timing header to every response and log the same timings
+# on the 'location.timing' logger when LOCATION_TIMING_LOG_LEVEL is INFO.
+
+LOCATION_SERVER_TIMING = os.getenv('LOCATION_SERVER_TIMING', 'True') == 'True'
+
+# Record request metrics for /metrics. Each worker process writes to its
+# own file in LOCATION_METRICS_DIR and the view sums them, so every worker
+# of a server must share the directory.
+
+LOCATION_METRICS = os.getenv('LOCATION_METRICS', 'True') == 'True'
+
+LOCATION_METRICS_DIR = os.getenv('LOCATION_METRICS_DIR', None)
+
+# Compress HTML and JSON responses of the location views with brotli or
+# gzip, keeping up to LOCATION_COMPRESSION_CACHE_SIZE compressed bodies
+# in memory.
+
+LOCATION_COMPRESSION = os.getenv('LOCATION_COMPRESSION', 'True') == 'True'
+
+LOCATION_COMPRESSION_CACHE_SIZE = int(
+    os.getenv('LOCATION_COMPRESSION_CACHE_SIZE', 512))
+
+# Directory the states pages are pre-rendered into for nginx to serve.
+# When set, pages are rendered again in the background after every change
+# to a State or Capital.
+
+LOCATION_PRERENDER_DIR = os.getenv('LOCATION_PRERENDER_DIR', None)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'location.timing': {
+            'handlers': ['console'],
+            'level': os.getenv('LOCATION_TIMING_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
+    },
+}
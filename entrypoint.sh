@@ -11,11 +11,21 @@ then
     echo "PostgreSQL started"
 fi
 
-echo "Applying database migrations"
-python manage.py makemigrations
-python manage.py migrate
+if [ -n "$LOCATION_SNAPSHOT_PATH" ]
+then
+    echo "Removing the location snapshot of previous runs"
+    rm -f "$LOCATION_SNAPSHOT_PATH"
+fi
+
+if [ -n "$LOCATION_METRICS_DIR" ]
+then
+    echo "Clearing metrics from previous runs"
+    rm -rf "$LOCATION_METRICS_DIR"
+fi
 
-echo "Collecting static files"
-python manage.py collectstatic --noinput --clear
+# Migrations, static files and pre-rendered pages. Steps whose inputs
+# are unchanged since they last ran are skipped.
+echo "Booting"
+python manage.py boot
 
 exec "$@"
\ No newline at end of file
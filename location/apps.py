@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class LocationConfig(AppConfig):
     name = 'location'
+
+    def ready(self):
+        from . import signals  # noqa: F401
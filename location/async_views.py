@@ -0,0 +1,66 @@
+"""
+Async versions of the location views for ASGI servers.
+
+The lookup index keeps the whole dataset in memory, so once it is built
+a request can be answered on the event loop without touching the ORM.
+Each async view makes sure the index is built, off the event loop, and
+then runs the regular view inline. With LOCATION_LOOKUP_INDEX disabled
+the regular view runs in a worker thread instead.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import SynchronousOnlyOperation
+
+from .index import aget_index
+from .lookups import index_enabled
+from .views import (
+    AutocompleteAPIView, CapitalDetailAPIView, ExportAPIView, NearestAPIView,
+    StateDetailAPIView, StateListAPIView, StateListView
+)
+
+
+def _render(response):
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    return response
+
+
+def in_memory_view(view):
+    """Wrap a view so it is served from the event loop."""
+    def sync_view(request, *args, **kwargs):
+        return _render(view(request, *args, **kwargs))
+
+    @wraps(view)
+    async def async_view(request, *args, **kwargs):
+        if index_enabled():
+            await aget_index()
+            try:
+                return sync_view(request, *args, **kwargs)
+            except SynchronousOnlyOperation:
+                # The index was invalidated after it was fetched.
+                pass
+        return await sync_to_async(sync_view, thread_sensitive=True)(
+            request, *args, **kwargs)
+    return async_view
+
+
+state_list = in_memory_view(StateListView.as_view())
+state_list_api = in_memory_view(StateListAPIView.as_view())
+state_detail_api = in_memory_view(StateDetailAPIView.as_view())
+capital_detail_api = in_memory_view(CapitalDetailAPIView.as_view())
+autocomplete_api = in_memory_view(AutocompleteAPIView.as_view())
+nearest_api = in_memory_view(NearestAPIView.as_view())
+
+_export = ExportAPIView.as_view(preload=True)
+
+
+async def export_api(request, *args, **kwargs):
+    """
+    Stream the export from rows read before the response starts.
+
+    The server iterates the response on the event loop, so the rows are
+    read in a worker thread first and only encoded while streaming.
+    """
+    return await sync_to_async(_export, thread_sensitive=True)(
+        request, *args, **kwargs)
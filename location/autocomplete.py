@@ -0,0 +1,163 @@
+"""
+Typeahead suggestions for state names, abbreviations and capitals.
+
+Suggestions are served from structures built from the lookup index, so
+answering a keystroke never touches the database. Prefix matches come
+from a trie whose nodes hold their best-ranked entries precomputed, and
+typo-tolerant matches come from a trigram index. Both are rebuilt when
+the lookup index changes version.
+"""
+import threading
+from collections import Counter, namedtuple
+
+from .index import get_index
+from .normalize import normalize_name
+
+# Upper bound on suggestions kept per trie node and returned per query.
+MAX_RESULTS = 50
+
+# Minimum trigram similarity for a fuzzy match.
+MIN_SIMILARITY = 0.3
+
+# Ranking tiers, best first. Exact matches always lead the results.
+PREFIX, ABBR_PREFIX, WORD_PREFIX, FUZZY = range(4)
+
+Entry = namedtuple('Entry', ['key', 'text', 'kind', 'state'])
+
+
+def trigrams(key):
+    """Return the set of trigrams of a key, padded at word boundaries."""
+    padded = '  {} '.format(key)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _Node:
+    """Trie node holding the best-ranked entries below it."""
+    __slots__ = ('children', 'ranks', 'top')
+
+    def __init__(self):
+        self.children = {}
+        self.ranks = {}
+        self.top = ()
+
+    def freeze(self):
+        """Keep only the top entries of every node, in rank order."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.top = tuple(
+                rank[-1] for rank in sorted(node.ranks.values())[:MAX_RESULTS])
+            node.ranks = None
+            stack.extend(node.children.values())
+
+
+class Autocomplete:
+    """Immutable prefix and trigram index over the location dataset."""
+
+    def __init__(self, states):
+        self.entries = []
+        for state in states:
+            self.entries.append(Entry(
+                normalize_name(state.name), state.name, 'state', state))
+            self.entries.append(Entry(
+                state.abbr.casefold(), state.abbr, 'abbr', state))
+            self.entries.append(Entry(
+                normalize_name(state.capital.name), state.capital.name,
+                'capital', state))
+
+        self.exact = {}
+        for entry_id, entry in enumerate(self.entries):
+            self.exact.setdefault(entry.key, []).append(entry_id)
+
+        self._trie = self._build_trie()
+        self._trigrams = [trigrams(entry.key) for entry in self.entries]
+        self._postings = {}
+        for entry_id, grams in enumerate(self._trigrams):
+            if self.entries[entry_id].kind == 'abbr':
+                continue  # Two letters are too short to match fuzzily
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(entry_id)
+
+    def _rank(self, entry_id, tier):
+        entry = self.entries[entry_id]
+        return (tier, len(entry.text), entry.text, entry_id)
+
+    def _build_trie(self):
+        root = _Node()
+        for entry_id, entry in enumerate(self.entries):
+            tier = ABBR_PREFIX if entry.kind == 'abbr' else PREFIX
+            self._insert(root, entry.key, entry_id, tier)
+            # Let "lake" find "Salt Lake City".
+            words = entry.key.split(' ')
+            for i in range(1, len(words)):
+                self._insert(root, ' '.join(words[i:]), entry_id, WORD_PREFIX)
+        root.freeze()
+        return root
+
+    def _insert(self, root, key, entry_id, tier):
+        rank = self._rank(entry_id, tier)
+        node = root
+        for char in key:
+            node = node.children.setdefault(char, _Node())
+            best = node.ranks.get(entry_id)
+            if best is None or rank < best:
+                node.ranks[entry_id] = rank
+
+    def _prefix_matches(self, key):
+        node = self._trie
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return ()
+        return node.top
+
+    def _fuzzy_matches(self, key, exclude):
+        query_grams = trigrams(key)
+        hits = Counter()
+        for gram in query_grams:
+            hits.update(self._postings.get(gram, ()))
+
+        matches = []
+        for entry_id, shared in hits.items():
+            if entry_id in exclude:
+                continue
+            union = len(query_grams) + len(self._trigrams[entry_id]) - shared
+            similarity = shared / union
+            if similarity >= MIN_SIMILARITY:
+                matches.append((-similarity, self._rank(entry_id, FUZZY)))
+        return [rank[-1] for similarity, rank in sorted(matches)]
+
+    def suggest(self, query, limit=10):
+        """Return up to ``limit`` ranked suggestions for a partial query."""
+        key = normalize_name(query)
+        if not key:
+            return []
+        limit = min(limit, MAX_RESULTS)
+
+        found = list(self.exact.get(key, ()))
+        for entry_id in self._prefix_matches(key):
+            if len(found) >= limit:
+                break
+            if entry_id not in found:
+                found.append(entry_id)
+        if len(found) < limit:
+            found.extend(self._fuzzy_matches(key, set(found)))
+
+        return [self.entries[entry_id] for entry_id in found[:limit]]
+
+
+_autocomplete = None
+_lock = threading.Lock()
+
+
+def get_autocomplete():
+    """Return the suggestion index for the current lookup index."""
+    global _autocomplete
+    index = get_index()
+    current = _autocomplete
+    if current is not None and current[0] == index.version:
+        return current[1]
+    with _lock:
+        if _autocomplete is None or _autocomplete[0] != index.version:
+            _autocomplete = (index.version, Autocomplete(index.states))
+        return _autocomplete[1]
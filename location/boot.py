@@ -0,0 +1,201 @@
+"""
+Fast start-up of web containers.
+
+boot() runs the steps a container takes before serving: applying
+migrations, collecting static files and pre-rendering pages. Each step
+with known inputs is skipped when they hash the same as when the step
+last completed, so a restart or a new replica skips the work another
+container already did. Migrating also runs whenever the database lacks
+a migration on disk, such as after it was restored from a backup. The
+hashes are kept in LOCATION_BOOT_STATE_DIR, and containers that share
+it boot one at a time.
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.loader import MigrationLoader
+
+from .prerender import prerender
+from .singleflight import file_lock
+
+STATE_FILE = 'boot-state.json'
+
+# Files collectstatic leaves out by default.
+STATIC_IGNORE_PATTERNS = ['CVS', '.*', '*~']
+
+PhaseResult = namedtuple('PhaseResult', ['name', 'ran', 'seconds'])
+
+
+def state_dir():
+    return getattr(settings, 'LOCATION_BOOT_STATE_DIR', None) or (
+        os.path.join(settings.BASE_DIR, '.boot'))
+
+
+def load_state():
+    try:
+        with open(os.path.join(state_dir(), STATE_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(state):
+    directory = state_dir()
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(prefix='.boot-', dir=directory)
+    with os.fdopen(handle, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp_path, os.path.join(directory, STATE_FILE))
+
+
+def _update_file(digest, path):
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+
+
+def migrations_hash(database=DEFAULT_DB_ALIAS):
+    """
+    Hash the migration graph on disk, the models makemigrations reads
+    and the database the migrations are applied to.
+    """
+    digest = hashlib.sha1()
+    db = connections[database].settings_dict
+    digest.update(json.dumps([
+        db['ENGINE'], str(db['NAME']), db.get('HOST', ''),
+        str(db.get('PORT', '')),
+    ]).encode('utf-8'))
+
+    loader = MigrationLoader(None, ignore_no_migrations=True)
+    for key in sorted(loader.disk_migrations):
+        migration = loader.disk_migrations[key]
+        digest.update('{}.{}\n'.format(*key).encode('utf-8'))
+        _update_file(digest, sys.modules[type(migration).__module__].__file__)
+    for app_config in apps.get_app_configs():
+        path = getattr(app_config.models_module, '__file__', None)
+        if path:
+            digest.update(app_config.label.encode('utf-8'))
+            _update_file(digest, path)
+    return digest.hexdigest()
+
+
+def migrations_pending(database=DEFAULT_DB_ALIAS):
+    """Return whether any migration on disk is unapplied in the database."""
+    executor = MigrationExecutor(connections[database])
+    return bool(
+        executor.migration_plan(executor.loader.graph.leaf_nodes()))
+
+
+def static_sources():
+    """Return the source of each file collectstatic would copy, by name."""
+    found = {}
+    for finder in get_finders():
+        for path, storage in finder.list(STATIC_IGNORE_PATTERNS):
+            prefix = getattr(storage, 'prefix', None)
+            name = os.path.join(prefix, path) if prefix else path
+            # The first finder to list a file wins, as in collectstatic.
+            found.setdefault(name, storage.path(path))
+    return found
+
+
+def static_hash():
+    """Hash the static files collectstatic would copy, and where to."""
+    digest = hashlib.sha1(str(settings.STATIC_ROOT).encode('utf-8'))
+    found = static_sources()
+    for name in sorted(found):
+        digest.update(name.encode('utf-8'))
+        _update_file(digest, found[name])
+    return digest.hexdigest()
+
+
+def _static_root_missing():
+    root = settings.STATIC_ROOT
+    return not (root and os.path.isdir(root) and os.listdir(root))
+
+
+def _migrate(stdout, verbosity):
+    call_command(
+        'makemigrations', interactive=False, verbosity=verbosity,
+        stdout=stdout)
+    call_command(
+        'migrate', interactive=False, verbosity=verbosity, stdout=stdout)
+
+
+def _same_content(first, second):
+    if os.path.getsize(first) != os.path.getsize(second):
+        return False
+    with open(first, 'rb') as f, open(second, 'rb') as g:
+        return f.read() == g.read()
+
+
+def _collectstatic(stdout, verbosity):
+    # collectstatic only replaces files whose source is newer, which an
+    # image built from another checkout does not guarantee, so collected
+    # files that differ from their source are removed first. No --clear:
+    # every other file stays in place while live traffic reads it.
+    for name, source in static_sources().items():
+        target = os.path.join(settings.STATIC_ROOT, name)
+        if os.path.exists(target) and not _same_content(source, target):
+            os.remove(target)
+    call_command(
+        'collectstatic', interactive=False, verbosity=verbosity,
+        stdout=stdout)
+
+
+def _prerender(stdout, verbosity):
+    prerender(settings.LOCATION_PRERENDER_DIR)
+
+
+def phases():
+    """
+    Return the name, input hash function and runner of each step.
+
+    Steps without an input hash always run.
+    """
+    steps = [
+        ('migrate', migrations_hash, _migrate),
+        ('collectstatic', static_hash, _collectstatic),
+    ]
+    if getattr(settings, 'LOCATION_PRERENDER_DIR', None):
+        steps.append(('prerender', None, _prerender))
+    return steps
+
+
+def boot(force=False, stdout=None, verbosity=0):
+    """Run the start-up steps that need to, timing each of them."""
+    results = []
+    with file_lock('boot', directory=state_dir()):
+        # Read inside the lock to see what a container that booted
+        # meanwhile did.
+        state = load_state()
+        for name, inputs, run in phases():
+            start = time.perf_counter()
+            key = inputs() if inputs is not None else None
+            unchanged = key is not None and state.get(name) == key
+            if name == 'migrate' and unchanged and migrations_pending():
+                unchanged = False
+            if name == 'collectstatic' and _static_root_missing():
+                unchanged = False
+            if unchanged and not force:
+                results.append(
+                    PhaseResult(name, False, time.perf_counter() - start))
+                continue
+
+            run(stdout, verbosity)
+            if inputs is not None:
+                # makemigrations may have added migrations.
+                state[name] = inputs() if name == 'migrate' else key
+                save_state(state)
+            results.append(
+                PhaseResult(name, True, time.perf_counter() - start))
+    return results
@@ -0,0 +1,161 @@
+"""
+In-memory response cache for the states page.
+
+Rendered pages are keyed on the lookup a request selects plus the
+dataset version, so editing a State or Capital naturally retires every
+cached page. Cached pages carry a strong ETag and Last-Modified header
+and conditional GETs are answered with 304 without touching the ORM or
+the template engine.
+
+After a change, only one request per page and process renders it again
+(see location/singleflight.py). Concurrent requests for the page wait
+for that render, or with LOCATION_STALE_WHILE_REVALIDATE are served the
+page of the previous version meanwhile.
+"""
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .index import get_index
+from .lookups import index_enabled, lookup_key
+from .singleflight import SingleFlight
+from .timing import set_cache_status, timed
+
+
+class LRUCache:
+    """Thread-safe mapping that evicts the least recently used entry."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+CachedPage = namedtuple(
+    'CachedPage',
+    ['content', 'content_type', 'etag', 'last_modified', 'lookup_type'])
+
+page_cache = LRUCache(getattr(settings, 'LOCATION_PAGE_CACHE_SIZE', 256))
+
+# The latest page of each lookup whatever its version, served while the
+# current version is rendered.
+stale_pages = LRUCache(getattr(settings, 'LOCATION_PAGE_CACHE_SIZE', 256))
+
+page_refills = SingleFlight()
+
+# Cache status reported for each outcome of a refill.
+REFILL_STATUS = {
+    'computed': 'miss',
+    'coalesced': 'coalesced',
+    'stale': 'stale',
+}
+
+
+def page_cache_enabled():
+    # The dataset version comes from the index, so caching needs it.
+    return getattr(settings, 'LOCATION_PAGE_CACHE', True) and index_enabled()
+
+
+def _build_response(page):
+    response = HttpResponse(page.content, content_type=page.content_type)
+    response['ETag'] = page.etag
+    response['Last-Modified'] = http_date(page.last_modified)
+    return response
+
+
+class CachedPageMixin:
+    """Serve GET requests for a list view from the page cache."""
+
+    def get(self, request, *args, **kwargs):
+        if not page_cache_enabled():
+            return super().get(request, *args, **kwargs)
+
+        index = get_index()
+        lookup = lookup_key(request.GET)
+        key = (index.version,) + lookup
+        page = page_cache.get(key)
+        if page is None:
+            page = self.refill(request, index, key, lookup, *args, **kwargs)
+            if not isinstance(page, CachedPage):
+                return page
+        else:
+            set_cache_status(request, 'hit')
+        request.lookup_type = page.lookup_type
+
+        response = _build_response(page)
+        return get_conditional_response(
+            request,
+            etag=page.etag,
+            last_modified=page.last_modified,
+            response=response,
+        )
+
+    def refill(self, request, index, key, lookup, *args, **kwargs):
+        """
+        Render a page missing from the cache, once per key at a time.
+
+        Returns the cached page, or the response when it is not one to
+        cache.
+        """
+        def render():
+            return self.render_page(request, index, key, lookup, *args,
+                                    **kwargs)
+
+        options = {
+            'timeout': getattr(settings, 'LOCATION_REFILL_TIMEOUT', 2.0),
+        }
+        if getattr(settings, 'LOCATION_STALE_WHILE_REVALIDATE', False):
+            stale = stale_pages.get(lookup)
+            if stale is not None:
+                options['stale'] = stale
+        page, outcome = page_refills.do(key, render, **options)
+        if not isinstance(page, CachedPage) and outcome != 'computed':
+            # Responses are not shared between requests.
+            page, outcome = render(), 'computed'
+        set_cache_status(request, REFILL_STATUS[outcome])
+        return page
+
+    def render_page(self, request, index, key, lookup, *args, **kwargs):
+        """Render a page and store it in the cache if it is cacheable."""
+        response = super().get(request, *args, **kwargs)
+        with timed(request, 'template'):
+            response.render()
+        if response.status_code != 200:
+            return response
+        page = CachedPage(
+            content=response.content,
+            content_type=response['Content-Type'],
+            etag='"{}"'.format(hashlib.sha1(response.content).hexdigest()),
+            last_modified=int(index.built_at),
+            lookup_type=getattr(request, 'lookup_type', None),
+        )
+        page_cache.set(key, page)
+        stale_pages.set(lookup, page)
+        return page
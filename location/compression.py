@@ -0,0 +1,161 @@
+"""
+Compressed response bodies, cached in memory.
+
+Pages and JSON for the dataset repeat across many requests. Each GET
+response with a strong ETag is compressed once, at the highest level,
+and the compressed bytes are kept in an LRU keyed on the ETag. Other
+bodies, such as the answers to batch POSTs, are seldom served twice.
+They are compressed at a fast level and not kept. The coding is picked
+by the client's quality values, with brotli ahead of gzip when they tie.
+Under ASGI, bodies are compressed in a thread so the event loop is not
+held up.
+
+Only views with a true ``compressible`` attribute are compressed, and
+never a response that used the CSRF token. Compressing a secret next to
+reflected input, as the admin's pages do, exposes it to BREACH.
+"""
+import gzip
+
+import brotli
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from .cache import LRUCache
+
+# Bodies smaller than this gain nothing from compression.
+MIN_LENGTH = 200
+
+COMPRESSIBLE_TYPES = ('text/html', 'application/json', 'text/plain')
+
+
+def _gzip(content, fast=False):
+    return gzip.compress(content, compresslevel=6 if fast else 9, mtime=0)
+
+
+def _brotli(content, fast=False):
+    return brotli.compress(content, quality=5 if fast else 11)
+
+
+# Encoders in order of preference.
+ENCODERS = {
+    'br': _brotli,
+    'gzip': _gzip,
+}
+
+compressed_cache = LRUCache(
+    getattr(settings, 'LOCATION_COMPRESSION_CACHE_SIZE', 512))
+
+
+def accepted_encodings(header):
+    """Return the quality an Accept-Encoding header gives each coding."""
+    accepted = {}
+    for item in header.split(','):
+        coding, *params = item.strip().lower().split(';')
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            accepted[coding.strip()] = quality
+    return accepted
+
+
+def choose_encoding(header):
+    """
+    Return the coding the client prefers of those available, or None.
+
+    Codings with the same quality are picked in the order of ENCODERS.
+    """
+    accepted = accepted_encodings(header)
+    best, best_quality = None, 0
+    for encoding in ENCODERS:
+        quality = accepted.get(encoding, accepted.get('*', 0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def view_compressible(request):
+    """Return whether the view of a request allows compression."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None or request.META.get('CSRF_COOKIE_USED'):
+        return False
+    view = getattr(match.func, 'view_class', match.func)
+    return getattr(view, 'compressible', False)
+
+
+def is_compressible(response):
+    if response.streaming or response.has_header('Content-Encoding'):
+        return False
+    if response.status_code != 200 or len(response.content) < MIN_LENGTH:
+        return False
+    content_type = response.get('Content-Type', '').split(';')[0].strip()
+    return content_type in COMPRESSIBLE_TYPES
+
+
+def _negotiate(request, response):
+    """Return the coding to compress a response with, or None."""
+    if not (view_compressible(request) and is_compressible(response)):
+        return None
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+
+def _cache_key(request, response, encoding):
+    """Return the key a body is kept under, or None if it is not kept."""
+    etag = response.get('ETag', '')
+    if request.method in ('GET', 'HEAD') and etag.startswith('"'):
+        return (encoding, etag)
+    return None
+
+
+def _encode(encoding, content, key):
+    if key is None:
+        return ENCODERS[encoding](content, fast=True)
+    compressed = ENCODERS[encoding](content)
+    compressed_cache.set(key, compressed)
+    return compressed
+
+
+def compress_response(request, response):
+    """Replace the body of a response with compressed bytes."""
+    encoding = _negotiate(request, response)
+    if encoding is None:
+        return response
+    key = _cache_key(request, response, encoding)
+    compressed = None if key is None else compressed_cache.get(key)
+    if compressed is None:
+        compressed = _encode(encoding, response.content, key)
+    return _replace_content(response, encoding, compressed)
+
+
+async def acompress_response(request, response):
+    """Compress a response like compress_response(), in a thread."""
+    encoding = _negotiate(request, response)
+    if encoding is None:
+        return response
+    key = _cache_key(request, response, encoding)
+    compressed = None if key is None else compressed_cache.get(key)
+    if compressed is None:
+        compressed = await sync_to_async(_encode, thread_sensitive=False)(
+            encoding, response.content, key)
+    return _replace_content(response, encoding, compressed)
+
+
+def _replace_content(response, encoding, compressed):
+    if len(compressed) >= len(response.content):
+        return response
+
+    etag = response.get('ETag', '')
+    response.content = compressed
+    response['Content-Length'] = str(len(compressed))
+    response['Content-Encoding'] = encoding
+    # The bytes differ from the identity body, as with GZipMiddleware.
+    if etag.startswith('"'):
+        response['ETag'] = 'W/' + etag
+    return response
@@ -0,0 +1,112 @@
+"""
+Great-circle distances between state capitals.
+
+The full capital-to-capital matrix is computed at once with a vectorized
+haversine over NumPy arrays and kept per dataset version, so pairwise
+and one-to-many queries are answered by indexing into it rather than by
+computing distances again. The whole matrix is also kept serialized in
+the .npy format for clients that load it into NumPy directly.
+"""
+import io
+import threading
+
+import numpy as np
+
+from .geo import EARTH_RADIUS_KM
+from .index import get_index
+from .lookups import resolve_many
+
+
+class UnknownCapital(LookupError):
+    pass
+
+
+def haversine_matrix(latitudes, longitudes):
+    """Return the distances in km between every pair of points."""
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    delta_latitude = latitudes[:, np.newaxis] - latitudes
+    delta_longitude = longitudes[:, np.newaxis] - longitudes
+    cos_latitude = np.cos(latitudes)
+    h = (np.sin(delta_latitude / 2) ** 2
+         + np.outer(cos_latitude, cos_latitude)
+         * np.sin(delta_longitude / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+class DistanceMatrix:
+    """Immutable distances between the capitals that have coordinates."""
+
+    def __init__(self, states):
+        self.states = tuple(
+            state for state in states
+            if state.capital.latitude is not None
+            and state.capital.longitude is not None)
+        self.positions = {
+            state.id: position for position, state in enumerate(self.states)}
+        self.matrix = haversine_matrix(
+            [state.capital.latitude for state in self.states],
+            [state.capital.longitude for state in self.states])
+        self.matrix.setflags(write=False)
+        self._npy = None
+
+    def resolve(self, queries):
+        """
+        Return the states matching state abbreviations, state names or
+        capital names, or every state when ``queries`` is None.
+        """
+        if queries is None:
+            return self.states
+        states = []
+        for query, state in zip(queries, resolve_many(queries)):
+            if state is None:
+                raise UnknownCapital(
+                    'Unknown state or capital: {}'.format(query))
+            if state.id not in self.positions:
+                raise UnknownCapital(
+                    'The capital of {} has no coordinates.'.format(
+                        state.name))
+            states.append(self.states[self.positions[state.id]])
+        return states
+
+    def distances(self, sources, targets):
+        """Return the distances from each source state to each target."""
+        rows = [self.positions[state.id] for state in sources]
+        columns = [self.positions[state.id] for state in targets]
+        return self.matrix[np.ix_(rows, columns)]
+
+    def to_npy(self):
+        """Return the whole matrix in the .npy format."""
+        if self._npy is None:
+            self._npy = to_npy(self.matrix)
+        return self._npy
+
+
+def to_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def parse_queries(value):
+    """Split a comma separated list of queries, or return None."""
+    if not value:
+        return None
+    return [query.strip() for query in value.split(',') if query.strip()]
+
+
+_matrix = None
+_lock = threading.Lock()
+
+
+def get_distance_matrix():
+    """Return the distance matrix for the current lookup index."""
+    global _matrix
+    index = get_index()
+    current = _matrix
+    if current is not None and current[0] == index.version:
+        return current[1]
+    with _lock:
+        if _matrix is None or _matrix[0] != index.version:
+            _matrix = (index.version, DistanceMatrix(index.states))
+        return _matrix[1]
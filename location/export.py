@@ -0,0 +1,109 @@
+"""
+Bulk export of the location dataset as CSV or NDJSON.
+
+Rows are read with a chunked iterator, which uses a server-side cursor
+on PostgreSQL, and encoded one chunk at a time, so memory use does not
+grow with the table. The CSV header is produced before the query runs,
+so a streaming response starts sending straight away. Exported files
+can be loaded back with the load_locations command.
+
+Django 3.1 iterates a streaming response on the event loop under ASGI,
+where the ORM cannot run, so the async view streams preloaded_rows()
+instead: the lookup index already holds every row, and without it the
+rows are read in one query before the response starts.
+"""
+import csv
+import io
+import json
+
+from django.conf import settings
+
+from .index import get_index
+from .lookups import index_enabled
+from .models import State
+
+# Exported column names and the values they are read from.
+COLUMNS = (
+    ('state', 'name'),
+    ('abbr', 'abbr'),
+    ('capital', 'capital__name'),
+    ('latitude', 'capital__latitude'),
+    ('longitude', 'capital__longitude'),
+)
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def chunk_size():
+    return getattr(settings, 'LOCATION_EXPORT_CHUNK_SIZE', 2000)
+
+
+def export_rows(size=None):
+    """Yield the exported values of every state, in id order."""
+    return State.objects.order_by('id').values_list(
+        *(field for column, field in COLUMNS)
+    ).iterator(chunk_size=size or chunk_size())
+
+
+def preloaded_rows():
+    """Return the exported values of every state, read up front."""
+    if not index_enabled():
+        return list(export_rows())
+    states = sorted(get_index().states, key=lambda state: state.id)
+    return [
+        (state.name, state.abbr, state.capital.name,
+         state.capital.latitude, state.capital.longitude)
+        for state in states
+    ]
+
+
+def _csv_chunks(rows, size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column for column, field in COLUMNS)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _ndjson_chunks(rows, size):
+    columns = [column for column, field in COLUMNS]
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row))) + '\n')
+        if len(lines) == size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+ENCODERS = {
+    'csv': _csv_chunks,
+    'ndjson': _ndjson_chunks,
+}
+
+
+def export_chunks(export_format, size=None, rows=None):
+    """
+    Yield the dataset in ``export_format`` as strings of many rows.
+
+    The rows are read from the database as they are encoded, unless
+    ``rows`` are passed in.
+    """
+    size = size or chunk_size()
+    if rows is None:
+        rows = export_rows(size)
+    return ENCODERS[export_format](rows, size)
@@ -0,0 +1,169 @@
+"""
+Nearest-capital lookups.
+
+Capitals are kept in a KD-tree over their positions as unit vectors in
+3D space. The straight-line (chord) distance between two such vectors
+grows with the great-circle distance between the places, so the k
+nearest capitals by chord are the k nearest on the globe, with no
+special cases at the poles or the antimeridian. A search only descends
+into the branches that can hold a closer capital instead of measuring
+every one. The tree is built from the lookup index and rebuilt when the
+index changes version.
+"""
+import heapq
+import math
+import threading
+from collections import namedtuple
+
+from .index import get_index
+
+# Mean radius of the Earth, in kilometres.
+EARTH_RADIUS_KM = 6371.0088
+
+# Upper bound on the neighbours returned per point.
+MAX_NEIGHBORS = 50
+
+Neighbor = namedtuple('Neighbor', ['state', 'distance_km'])
+
+
+def to_unit_vector(latitude, longitude):
+    """Return the position of a point on the unit sphere."""
+    latitude = math.radians(latitude)
+    longitude = math.radians(longitude)
+    cos_latitude = math.cos(latitude)
+    return (
+        cos_latitude * math.cos(longitude),
+        cos_latitude * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def chord_to_km(chord):
+    """Convert a chord of the unit sphere to a great-circle distance."""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+def parse_point(latitude, longitude):
+    """Return a point as floats, raising ValueError if it is invalid."""
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError('Latitude and longitude must be numbers.')
+    if not -90 <= latitude <= 90:
+        raise ValueError('Latitude must be between -90 and 90.')
+    if not -180 <= longitude <= 180:
+        raise ValueError('Longitude must be between -180 and 180.')
+    return latitude, longitude
+
+
+def parse_neighbors(k):
+    """Return the number of neighbours requested as an int."""
+    try:
+        k = int(k)
+    except (TypeError, ValueError):
+        raise ValueError('k must be a number.')
+    if not 1 <= k <= MAX_NEIGHBORS:
+        raise ValueError('k must be between 1 and {}.'.format(MAX_NEIGHBORS))
+    return k
+
+
+class _Node:
+    __slots__ = ('point', 'order', 'state', 'axis', 'left', 'right')
+
+
+class NearestIndex:
+    """Immutable KD-tree of the capitals that have coordinates."""
+
+    def __init__(self, states):
+        points = [
+            (to_unit_vector(state.capital.latitude, state.capital.longitude),
+             order, state)
+            for order, state in enumerate(states)
+            if state.capital.latitude is not None
+            and state.capital.longitude is not None
+        ]
+        self.size = len(points)
+        self._root = self._build(points)
+
+    def _build(self, points):
+        if not points:
+            return None
+        # Split on the axis the points spread along the most.
+        axis = max(range(3), key=lambda axis: (
+            max(point[0][axis] for point in points)
+            - min(point[0][axis] for point in points)))
+        points.sort(key=lambda point: point[0][axis])
+        middle = len(points) // 2
+
+        node = _Node()
+        node.point, node.order, node.state = points[middle]
+        node.axis = axis
+        node.left = self._build(points[:middle])
+        node.right = self._build(points[middle + 1:])
+        return node
+
+    def nearest(self, latitude, longitude, k=1):
+        """Return the k capitals nearest a point, closest first."""
+        target = to_unit_vector(latitude, longitude)
+        # Max-heap on distance of the best k so far; ties keep the
+        # capital that comes first in the index.
+        best = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if isinstance(node, tuple):
+                # A far branch, visited only if it can still be closer.
+                offset, node = node
+                if len(best) == k and offset > -best[0][0]:
+                    continue
+
+            x, y, z = node.point
+            distance = (
+                (target[0] - x) ** 2 + (target[1] - y) ** 2
+                + (target[2] - z) ** 2)
+            entry = (-distance, -node.order, node.state)
+            if len(best) < k:
+                heapq.heappush(best, entry)
+            elif entry[:2] > best[0][:2]:
+                heapq.heapreplace(best, entry)
+
+            difference = target[node.axis] - node.point[node.axis]
+            if difference < 0:
+                near, far = node.left, node.right
+            else:
+                near, far = node.right, node.left
+            if far is not None:
+                stack.append((difference * difference, far))
+            stack.append(near)
+
+        return [
+            Neighbor(state, chord_to_km(math.sqrt(-distance)))
+            for distance, order, state in sorted(best, reverse=True)
+        ]
+
+    def nearest_many(self, points, k=1):
+        """Return the k nearest capitals of each point, in input order."""
+        nearest = self.nearest
+        return [
+            nearest(latitude, longitude, k) for latitude, longitude in points
+        ]
+
+
+_nearest = None
+_lock = threading.Lock()
+
+
+def get_nearest_index():
+    """Return the KD-tree for the current lookup index."""
+    global _nearest
+    index = get_index()
+    current = _nearest
+    if current is not None and current[0] == index.version:
+        return current[1]
+    with _lock:
+        if _nearest is None or _nearest[0] != index.version:
+            _nearest = (index.version, NearestIndex(index.states))
+        return _nearest[1]
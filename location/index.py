@@ -0,0 +1,222 @@
+"""
+Process-local lookup index for the state and capital dataset.
+
+The dataset is small and rarely changes, so each worker builds an
+immutable index once and answers lookups with dictionary access instead
+of SQL round-trips. Saving or deleting a State or Capital invalidates
+the index (see location/signals.py) and the next lookup rebuilds it.
+Other workers on the host learn of the change from a stamp file under
+LOCATION_LOCK_DIR that is replaced once it is committed, and rebuild
+their index on their next lookup.
+
+With LOCATION_SNAPSHOT_PATH set, workers load the index from a shared
+snapshot file (see location/snapshot.py) instead of the database, and
+committed changes are published by writing a new snapshot.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from types import MappingProxyType
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .models import State
+from .normalize import normalize_name
+from .singleflight import file_lock, lock_dir
+from .snapshot import current_identity, read_snapshot, write_snapshot
+
+
+def state_row(state):
+    """Return the plain row a state is serialized as."""
+    return MappingProxyType({
+        'id': state.id,
+        'name': state.name,
+        'abbr': state.abbr,
+        'capital': state.capital.name,
+    })
+
+
+class LocationIndex:
+    """Immutable snapshot of all states keyed for fast lookups."""
+    # Identity of the snapshot file the index was loaded from or written
+    # to, if any.
+    snapshot_id = None
+    # Identity of the stamp file when an index was built from the
+    # database.
+    stamp_id = None
+
+    def __init__(self, states, built_at=None):
+        # Sorted here, not by the database, so the order matches the
+        # keys that paginated lists are bisected on under any collation.
+        self.states = tuple(sorted(states, key=lambda state: state.name))
+        self.order_keys = tuple((state.name,) for state in self.states)
+        self.by_abbr = MappingProxyType(
+            {state.abbr.upper(): (state,) for state in self.states})
+        self.by_name = MappingProxyType(
+            {normalize_name(state.name): (state,) for state in self.states})
+        self.by_capital = MappingProxyType({
+            normalize_name(state.capital.name): (state,)
+            for state in self.states
+        })
+        self.rows = MappingProxyType(
+            {state.id: state_row(state) for state in self.states})
+        self.version = self._compute_version()
+        self.built_at = time.time() if built_at is None else built_at
+
+    def _compute_version(self):
+        """Hash the dataset so equal data yields equal versions."""
+        digest = hashlib.sha1()
+        for state in self.states:
+            digest.update('{}|{}|{}|{}|{}|{}|{}\n'.format(
+                state.id, state.name, state.abbr,
+                state.capital.id, state.capital.name,
+                state.capital.latitude,
+                state.capital.longitude).encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls):
+        """Load every state and its capital in a single query."""
+        # The index is kept until the dataset next changes, so it is read
+        # from the primary rather than a replica that may lag behind.
+        return cls(
+            State.objects.using(DEFAULT_DB_ALIAS).select_related('capital'))
+
+
+_index = None
+_generation = 0
+_lock = threading.Lock()
+
+
+def snapshot_path():
+    return getattr(settings, 'LOCATION_SNAPSHOT_PATH', None)
+
+
+def stamp_path():
+    return os.path.join(lock_dir(), 'index.stamp')
+
+
+def _touch_stamp():
+    """Tell the other workers that the dataset changed."""
+    directory = lock_dir()
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(prefix='.stamp-', dir=directory)
+    os.close(handle)
+    # A new file every time, so its inode differs even when the change
+    # falls within the resolution of the modification time.
+    os.replace(temp_path, stamp_path())
+
+
+def _is_current(index):
+    if index.snapshot_id is not None:
+        return current_identity(snapshot_path()) == index.snapshot_id
+    return current_identity(stamp_path()) == index.stamp_id
+
+
+def _build():
+    # Read the stamp first, so a change committed during the build is
+    # picked up by the next lookup.
+    stamp_id = current_identity(stamp_path())
+    index = LocationIndex.build()
+    index.stamp_id = stamp_id
+    return index
+
+
+def get_index():
+    """Return the current index, building it on first use."""
+    index = _index
+    if index is not None and _is_current(index):
+        return index
+    return _rebuild()
+
+
+async def aget_index():
+    """Return the current index without blocking the event loop."""
+    index = _index
+    if index is not None and _is_current(index):
+        return index
+    return await sync_to_async(_rebuild, thread_sensitive=True)()
+
+
+def _uncommitted():
+    """
+    Return whether the open transaction changed the dataset.
+
+    The signal handlers publish a change once it is committed. Until
+    then, only the transaction that made the change can see it, so it
+    must not reach the shared index. A rollback drops the pending
+    publication along with the change.
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    return connection.in_atomic_block and any(
+        callback[1] is publish_index
+        for callback in connection.run_on_commit)
+
+
+def _snapshot_lock(path, timeout=None):
+    """Hold the lock of the workers that write the snapshot at ``path``."""
+    name = 'snapshot-' + hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return file_lock(name, timeout=timeout)
+
+
+def _load():
+    path = snapshot_path()
+    if path is None:
+        return _build()
+    index = read_snapshot(path, LocationIndex)
+    if index is not None:
+        return index
+    # Only one worker rebuilds a missing snapshot from the database; the
+    # others wait for it and read what it wrote.
+    timeout = getattr(settings, 'LOCATION_REFILL_TIMEOUT', 2.0)
+    with _snapshot_lock(path, timeout=timeout):
+        index = read_snapshot(path, LocationIndex)
+        if index is None:
+            index = write_snapshot(path, LocationIndex.build())
+    return index
+
+
+def _rebuild():
+    global _index
+    if _uncommitted():
+        # Built for this transaction alone and not kept.
+        return _build()
+    with _lock:
+        if _index is not None and _is_current(_index):
+            return _index
+        generation = _generation
+        index = _load()
+        # Only publish the index if nothing changed while it was built.
+        if generation == _generation:
+            _index = index
+        return index
+
+
+def invalidate_index():
+    """Drop the current index so the next lookup rebuilds it."""
+    global _index, _generation
+    _generation += 1
+    _index = None
+
+
+def publish_index():
+    """
+    Rebuild the index after committed changes and share it with the
+    other workers through the snapshot, or the stamp without one.
+    """
+    global _index, _generation
+    path = snapshot_path()
+    if path is None:
+        invalidate_index()
+        _touch_stamp()
+        return
+    # Workers that commit close together publish one at a time, so the
+    # last snapshot written is built from the last committed change.
+    with _lock, _snapshot_lock(path):
+        _generation += 1
+        _index = write_snapshot(path, LocationIndex.build())
+    _touch_stamp()
@@ -0,0 +1,160 @@
+"""
+Lookup rules shared by the location views.
+
+Lookups are answered from the in-memory index when
+``LOCATION_LOOKUP_INDEX`` is enabled and from the database otherwise.
+"""
+from django.conf import settings
+from django.db.models import Q, QuerySet
+
+from .index import LocationIndex, get_index, state_row
+from .models import State
+from .normalize import normalize_name, parse_state_query
+from .pagination import paginate_queryset, paginate_sequence
+
+NOT_FOUND_MESSAGES = {
+    'state': 'State not found!',
+    'capital': 'Capital not found!',
+}
+
+# Columns of a serialized state row and the lookups that produce them.
+ROW_FIELDS = ('id', 'name', 'abbr', 'capital')
+ROW_COLUMNS = ('id', 'name', 'abbr', 'capital__name')
+
+
+def state_queryset():
+    """Return states with their capitals fetched in the same query."""
+    return State.objects.select_related('capital')
+
+
+def index_enabled():
+    return getattr(settings, 'LOCATION_LOOKUP_INDEX', True)
+
+
+def all_states():
+    """Return every state with its capital."""
+    if index_enabled():
+        return get_index().states
+    return state_queryset()
+
+
+def paginate_states(cursor, page_size):
+    """Return one page of every state, in name order."""
+    if index_enabled():
+        index = get_index()
+        return paginate_sequence(
+            index.states, index.order_keys, cursor, page_size)
+    return paginate_queryset(state_queryset(), cursor, page_size)
+
+
+def states_for_state_query(query):
+    """Return the states matching a state abbreviation or name."""
+    kind, key = parse_state_query(query)
+    if kind == 'abbr':
+        if index_enabled():
+            return get_index().by_abbr.get(key, ())
+        return state_queryset().filter(abbr=key)
+    if index_enabled():
+        return get_index().by_name.get(key, ())
+    return state_queryset().filter(name_key=key)
+
+
+def states_for_capital_query(query):
+    """Return the states whose capital matches a capital name."""
+    if index_enabled():
+        return get_index().by_capital.get(normalize_name(query), ())
+    return state_queryset().filter(
+        capital__name_key=normalize_name(query))
+
+
+def resolve_many(queries):
+    """
+    Resolve a batch of state abbreviations, state names and capital names.
+
+    Returns the matching state, or None, for each query in input order.
+    Without the index the whole batch is resolved with a single query.
+    """
+    if index_enabled():
+        index = get_index()
+    elif queries:
+        index = LocationIndex(_batch_queryset(queries))
+    else:
+        return []
+    return [_resolve(index, query) for query in queries]
+
+
+def _batch_queryset(queries):
+    abbrs, keys = set(), set()
+    for query in queries:
+        kind, key = parse_state_query(query)
+        (abbrs if kind == 'abbr' else keys).add(key)
+    return state_queryset().filter(
+        Q(abbr__in=abbrs) | Q(name_key__in=keys) |
+        Q(capital__name_key__in=keys))
+
+
+def _resolve(index, query):
+    kind, key = parse_state_query(query)
+    if kind == 'abbr':
+        matches = index.by_abbr.get(key)
+    else:
+        matches = index.by_name.get(key) or index.by_capital.get(key)
+    return matches[0] if matches else None
+
+
+def find_states(params):
+    """
+    Apply the state and capital query parameters.
+
+    Returns the kind of lookup made ('state', 'capital' or 'list') and
+    the matching states.
+    """
+    state_query = params.get('state', None)
+    capital_query = params.get('capital', None)
+
+    if state_query:
+        return 'state', states_for_state_query(state_query)
+    elif capital_query:
+        return 'capital', states_for_capital_query(capital_query)
+    return 'list', all_states()
+
+
+def lookup_key(params):
+    """
+    Reduce request parameters to the lookup they select.
+
+    Requests that resolve to the same lookup share a key, which makes the
+    key suitable for caching rendered responses.
+    """
+    state_query = params.get('state', None)
+    capital_query = params.get('capital', None)
+
+    if state_query:
+        return parse_state_query(state_query)
+    elif capital_query:
+        return ('capital', normalize_name(capital_query))
+    elif 'cursor' in params or 'page_size' in params:
+        return ('list', params.get('cursor', ''), params.get('page_size', ''))
+    return ('list',)
+
+
+def lookup_type(params, found):
+    """
+    Name the kind of lookup a request made for metrics: list, abbr, name,
+    capital or not_found.
+    """
+    kind = lookup_key(params)[0]
+    if kind != 'list' and not found:
+        return 'not_found'
+    return kind
+
+
+def state_rows(states):
+    """Return lookup results as plain rows ready for serialization."""
+    if isinstance(states, QuerySet):
+        return [
+            dict(zip(ROW_FIELDS, values))
+            for values in states.values_list(*ROW_COLUMNS)
+        ]
+    rows = get_index().rows if index_enabled() else {}
+    return [rows.get(state.id) or state_row(state) for state in states]
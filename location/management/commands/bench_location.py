@@ -0,0 +1,406 @@
+import asyncio
+import io
+import json
+import random
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from location.index import get_index
+
+SCENARIOS = ('list', 'state', 'capital', 'not_found')
+
+# Metrics compared against a baseline and whether higher is better.
+COMPARED_METRICS = {
+    'rps': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'queries_per_request': False,
+    'bytes_per_request': False,
+}
+
+
+class QueryCounter:
+    """Execute wrapper counting queries on every connection it is added to."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        self.install(connection)
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def build_requests(count, weights, seed):
+    """Return (scenario, query string) pairs drawn from the dataset."""
+    states = get_index().states
+    rng = random.Random(seed)
+
+    def query(scenario):
+        state = rng.choice(states)
+        if scenario == 'list':
+            return ''
+        if scenario == 'state':
+            value = rng.choice([state.abbr, state.abbr.lower(), state.name])
+            return 'state=' + value.replace(' ', '_')
+        if scenario == 'capital':
+            return 'capital=' + state.capital.name.replace(' ', '_')
+        return rng.choice(['state=Atlantis', 'state=ZZ', 'capital=Nowhere'])
+
+    scenarios = rng.choices(
+        SCENARIOS, weights=[weights[name] for name in SCENARIOS], k=count)
+    return [(scenario, query(scenario)) for scenario in scenarios]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the states page in-process through the WSGI and ASGI '
+        'handlers and report throughput, latency, queries and allocations.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--server', choices=['wsgi', 'asgi', 'both'], default='both',
+            help='Handler to drive.')
+        parser.add_argument(
+            '--requests', type=int, default=2000,
+            help='Requests per handler in the load pass.')
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='Concurrent clients in the load pass.')
+        parser.add_argument(
+            '--mix', default='list=1,state=4,capital=4,not_found=1',
+            help='Relative weights of the request scenarios.')
+        parser.add_argument(
+            '--profile-requests', type=int, default=100,
+            help='Sequential requests per scenario used to measure queries '
+                 'and allocations.')
+        parser.add_argument(
+            '--path', default='/', help='URL path of the states page.')
+        parser.add_argument(
+            '--host', default=None,
+            help='Host header to send. Defaults to the first allowed host.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--json', dest='json_path',
+            help='Write the results as JSON to this file, or - for stdout.')
+        parser.add_argument(
+            '--baseline', help='JSON results of an earlier run to compare.')
+
+    def handle(self, *args, **options):
+        weights = self.parse_mix(options['mix'])
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be >= 1.')
+        self.path = options['path']
+        self.host = options['host'] or next(
+            (host for host in settings.ALLOWED_HOSTS
+             if host and not host.startswith(('.', '*'))), 'localhost')
+
+        self.counter = QueryCounter()
+        for connection in connections.all():
+            self.counter.install(connection)
+        connection_created.connect(self.counter.on_connection_created)
+        try:
+            servers = ['wsgi', 'asgi'] if options['server'] == 'both' else [
+                options['server']]
+            results = {
+                'config': {
+                    'requests': options['requests'],
+                    'concurrency': options['concurrency'],
+                    'mix': weights,
+                    'profile_requests': options['profile_requests'],
+                    'path': self.path,
+                },
+                'servers': {},
+            }
+            for server in servers:
+                results['servers'][server] = self.run_server(
+                    server, options, weights)
+        finally:
+            connection_created.disconnect(self.counter.on_connection_created)
+
+        self.report(results)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                self.compare(json.load(f), results)
+        if options['json_path'] == '-':
+            self.stdout.write(json.dumps(results, indent=2))
+        elif options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def parse_mix(self, mix):
+        weights = dict.fromkeys(SCENARIOS, 0)
+        try:
+            for part in mix.split(','):
+                name, weight = part.split('=')
+                if name.strip() not in weights:
+                    raise ValueError(name)
+                weights[name.strip()] = float(weight)
+        except ValueError:
+            raise CommandError(
+                '--mix expects weights like list=1,state=4 for the '
+                'scenarios {}.'.format(', '.join(SCENARIOS)))
+        if not any(weights.values()):
+            raise CommandError('--mix needs at least one positive weight.')
+        return weights
+
+    def run_server(self, server, options, weights):
+        """Run the load and profile passes against one handler."""
+        requests = build_requests(
+            options['requests'], weights, options['seed'])
+        if server == 'wsgi':
+            handler = WSGIHandler()
+            run_load = self.run_wsgi_load
+            call = self.call_wsgi
+        else:
+            handler = ASGIHandler()
+            run_load = self.run_asgi_load
+            call = self.call_asgi
+            self.loop = asyncio.new_event_loop()
+
+        try:
+            return self.measure(handler, run_load, call, requests, options)
+        finally:
+            if server == 'asgi':
+                self.loop.close()
+
+    def measure(self, handler, run_load, call, requests, options):
+        # Warm up caches so the load pass measures steady state.
+        for scenario, query in requests[:50]:
+            call(handler, query)
+
+        queries_before = self.counter.count
+        start = time.perf_counter()
+        timings = run_load(handler, requests, options['concurrency'])
+        elapsed = time.perf_counter() - start
+        queries = self.counter.count - queries_before
+
+        latencies = defaultdict(list)
+        for scenario, duration in timings:
+            latencies[scenario].append(duration)
+            latencies['all'].append(duration)
+
+        result = {}
+        for scenario, values in latencies.items():
+            values.sort()
+            result[scenario] = {
+                'requests': len(values),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+            }
+        result['all']['rps'] = len(timings) / elapsed
+        result['all']['queries_per_request'] = queries / len(timings)
+
+        profile = self.profile(handler, call, options)
+        for scenario, values in profile.items():
+            result.setdefault(scenario, {'requests': 0}).update(values)
+        return result
+
+    def profile(self, handler, call, options):
+        """Measure queries and peak allocations per request sequentially."""
+        count = options['profile_requests']
+        if count < 1:
+            return {}
+        profile = {}
+        tracemalloc.start()
+        try:
+            for scenario in SCENARIOS:
+                requests = build_requests(
+                    count, {name: name == scenario for name in SCENARIOS},
+                    options['seed'])
+                queries_before = self.counter.count
+                allocated = 0
+                for scenario_name, query in requests:
+                    tracemalloc.reset_peak()
+                    current = tracemalloc.get_traced_memory()[0]
+                    call(handler, query)
+                    allocated += tracemalloc.get_traced_memory()[1] - current
+                profile[scenario] = {
+                    'queries_per_request':
+                        (self.counter.count - queries_before) / count,
+                    'bytes_per_request': allocated / count,
+                }
+        finally:
+            tracemalloc.stop()
+        return profile
+
+    def environ(self, query):
+        return {
+            'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': self.path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': self.host,
+            'REMOTE_ADDR': '127.0.0.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+
+    def call_wsgi(self, handler, query):
+        status = []
+        body = handler(self.environ(query),
+                       lambda code, headers, *args: status.append(code))
+        try:
+            for chunk in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return status[0]
+
+    def run_wsgi_load(self, handler, requests, concurrency):
+        pending = iter(requests)
+        lock = threading.Lock()
+        timings = []
+
+        def client():
+            try:
+                while True:
+                    with lock:
+                        item = next(pending, None)
+                    if item is None:
+                        return
+                    start = time.perf_counter()
+                    self.call_wsgi(handler, item[1])
+                    timings.append((item[0], time.perf_counter() - start))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=client) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return timings
+
+    def scope(self, query):
+        return {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': self.path,
+            'raw_path': self.path.encode(),
+            'root_path': '',
+            'query_string': query.encode(),
+            'headers': [(b'host', self.host.encode())],
+            'client': ('127.0.0.1', 0),
+            'server': (self.host, 80),
+        }
+
+    async def acall_asgi(self, handler, query):
+        received = False
+        status = []
+
+        async def receive():
+            nonlocal received
+            if received:
+                # Keep the connection open until the response is sent.
+                await asyncio.Event().wait()
+            received = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        await handler(self.scope(query), receive, send)
+        return status[0]
+
+    def call_asgi(self, handler, query):
+        return self.loop.run_until_complete(self.acall_asgi(handler, query))
+
+    def run_asgi_load(self, handler, requests, concurrency):
+        async def run():
+            pending = iter(requests)
+            timings = []
+
+            async def client():
+                for scenario, query in pending:
+                    start = time.perf_counter()
+                    await self.acall_asgi(handler, query)
+                    timings.append((scenario, time.perf_counter() - start))
+
+            await asyncio.gather(*[client() for i in range(concurrency)])
+            return timings
+        return self.loop.run_until_complete(run())
+
+    def report(self, results):
+        for server, scenarios in results['servers'].items():
+            overall = scenarios['all']
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                '{}: {:.0f} requests/s, {:.2f} queries/request'.format(
+                    server.upper(), overall['rps'],
+                    overall['queries_per_request'])))
+            self.stdout.write(
+                '  {:<10} {:>8} {:>9} {:>9} {:>9} {:>9} {:>11}'.format(
+                    'scenario', 'requests', 'p50 ms', 'p95 ms', 'p99 ms',
+                    'queries', 'bytes'))
+            columns = [
+                ('p50_ms', '9.3f'), ('p95_ms', '9.3f'), ('p99_ms', '9.3f'),
+                ('queries_per_request', '9.2f'),
+                ('bytes_per_request', '11.0f'),
+            ]
+            for scenario in SCENARIOS + ('all',):
+                if scenario not in scenarios:
+                    continue
+                values = scenarios[scenario]
+                cells = [
+                    format(values[name], spec) if name in values
+                    else '-'.rjust(int(spec.split('.')[0]))
+                    for name, spec in columns
+                ]
+                self.stdout.write('  {:<10} {:>8} {}'.format(
+                    scenario, values['requests'], ' '.join(cells)))
+
+    def compare(self, baseline, results):
+        self.stdout.write(self.style.MIGRATE_HEADING('Change from baseline:'))
+        for server, scenarios in results['servers'].items():
+            for scenario, values in scenarios.items():
+                before = baseline.get('servers', {}).get(
+                    server, {}).get(scenario, {})
+                for metric, higher_is_better in COMPARED_METRICS.items():
+                    if metric not in values or not before.get(metric):
+                        continue
+                    change = (values[metric] - before[metric]) / before[metric]
+                    better = (change > 0) == higher_is_better
+                    style = self.style.SUCCESS if better else self.style.ERROR
+                    self.stdout.write(style('  {} {} {}: {:+.1%}'.format(
+                        server, scenario, metric, change)))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from location.boot import boot
+
+
+class Command(BaseCommand):
+    help = (
+        'Prepare the container to serve: apply migrations, collect static '
+        'files and pre-render pages, skipping the steps whose inputs have '
+        'not changed since they last ran.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Run every step even if its inputs are unchanged.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        verbosity = max(options['verbosity'] - 1, 0)
+        results = boot(
+            force=options['force'], stdout=self.stdout, verbosity=verbosity)
+        for result in results:
+            self.stdout.write('{:<14} {:<8} {:8.3f}s'.format(
+                result.name, 'ran' if result.ran else 'skipped',
+                result.seconds))
+        self.stdout.write(self.style.SUCCESS(
+            'Booted in {:.3f}s.'.format(time.perf_counter() - start)))
@@ -0,0 +1,73 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from location.distances import (
+    UnknownCapital, get_distance_matrix, parse_queries, to_npy
+)
+
+FORMATS = {
+    '.json': 'json',
+    '.npy': 'npy',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Write the great-circle distances in km between state capitals as '
+        'JSON or a NumPy .npy array.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', default='-',
+            help='File to write, or - for stdout (JSON only).')
+        parser.add_argument(
+            '--format', choices=sorted(set(FORMATS.values())),
+            help='Output format. Defaults to the extension of --output.')
+        parser.add_argument(
+            '--from', dest='sources',
+            help='Comma separated states or capitals to measure from.')
+        parser.add_argument(
+            '--to', dest='targets',
+            help='Comma separated states or capitals to measure to.')
+
+    def handle(self, *args, **options):
+        path = options['output']
+        output_format = options['format']
+        if output_format is None:
+            extension = os.path.splitext(path)[1].lower()
+            output_format = FORMATS.get(extension, 'json')
+        if output_format == 'npy' and path == '-':
+            raise CommandError('Pass --output to write an .npy file.')
+
+        start = time.perf_counter()
+        matrix = get_distance_matrix()
+        try:
+            sources = matrix.resolve(parse_queries(options['sources']))
+            targets = matrix.resolve(parse_queries(options['targets']))
+        except UnknownCapital as e:
+            raise CommandError(str(e))
+        distances = matrix.distances(sources, targets)
+
+        if output_format == 'npy':
+            with open(path, 'wb') as f:
+                f.write(to_npy(distances))
+        else:
+            content = json.dumps({
+                'from': [state.abbr for state in sources],
+                'to': [state.abbr for state in targets],
+                'distances_km': distances.round(3).tolist(),
+            })
+            if path == '-':
+                self.stdout.write(content)
+                return
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote {}x{} distances to {} in {:.2f}s.'.format(
+                len(sources), len(targets), path,
+                time.perf_counter() - start)))
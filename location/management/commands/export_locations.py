@@ -0,0 +1,60 @@
+import os
+import time
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from location.export import ENCODERS, chunk_size, export_chunks
+
+FORMATS = {
+    '.csv': 'csv',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Export every state and its capital as CSV or NDJSON, streaming '
+        'rows from the database in chunks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default='-',
+            help='File to write, or - for stdout (the default).')
+        parser.add_argument(
+            '--format', choices=sorted(ENCODERS),
+            help='Output format. Defaults to the file extension, or csv.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=chunk_size(),
+            help='Number of rows fetched and written at a time.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        export_format = options['format']
+        if export_format is None:
+            extension = os.path.splitext(path)[1].lower()
+            export_format = FORMATS.get(extension, 'csv')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+
+        if path == '-':
+            stream = None
+            write = partial(self.stdout.write, ending='')
+        else:
+            stream = open(path, 'w', encoding='utf-8', newline='')
+            write = stream.write
+
+        start = time.perf_counter()
+        try:
+            for chunk in export_chunks(export_format, options['chunk_size']):
+                write(chunk)
+        finally:
+            if stream is not None:
+                stream.close()
+
+        if stream is not None:
+            self.stdout.write(self.style.SUCCESS(
+                'Exported to {} in {:.2f}s.'.format(
+                    path, time.perf_counter() - start)))
@@ -0,0 +1,249 @@
+import csv
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connection, transaction
+
+from location.index import publish_index
+from location.models import State, Capital
+from location.prerender import prerender
+
+FORMATS = {
+    '.csv': 'csv',
+    '.json': 'json',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+
+
+def iter_csv(stream):
+    yield from csv.DictReader(stream)
+
+
+def iter_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_json(stream, chunk_size=64 * 1024):
+    """Yield the items of a top-level JSON array without loading it all."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # Skip whitespace and separators between items.
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise CommandError('Unexpected end of JSON input.')
+            buffer = stream.read(chunk_size)
+            pos = 0
+            eof = not buffer
+            continue
+
+        if not started:
+            if buffer[pos] != '[':
+                raise CommandError('Expected a JSON array of records.')
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if eof:
+                raise CommandError('Invalid JSON near character {}.'.format(
+                    pos))
+            # The item continues in the next chunk.
+            more = stream.read(chunk_size)
+            eof = not more
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+READERS = {
+    'csv': iter_csv,
+    'json': iter_json,
+    'ndjson': iter_ndjson,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Load states and capitals from a CSV, JSON or NDJSON file. '
+        'Records need state (or name), abbr and capital fields and are '
+        'upserted by abbreviation in batches.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to load, or - for stdin.')
+        parser.add_argument(
+            '--format', choices=sorted(READERS),
+            help='Input format. Defaults to the file extension.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of records written per batch.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        data_format = options['format']
+        if data_format is None:
+            extension = os.path.splitext(path)[1].lower()
+            if extension not in FORMATS:
+                raise CommandError(
+                    'Cannot tell the format of {}; use --format.'.format(path))
+            data_format = FORMATS[extension]
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        if path == '-':
+            stream = sys.stdin
+        else:
+            stream = open(path, encoding='utf-8', newline='')
+
+        totals = {'rows': 0, 'capitals': 0, 'created': 0, 'updated': 0}
+        start = time.perf_counter()
+        try:
+            records = READERS[data_format](stream)
+            while True:
+                batch = list(islice(records, options['batch_size']))
+                if not batch:
+                    break
+                try:
+                    counts = self.load_batch(batch, totals['rows'])
+                except IntegrityError as e:
+                    raise CommandError(
+                        'Could not load the batch after row {}: {}'.format(
+                            totals['rows'], e))
+                totals['rows'] += len(batch)
+                for key, count in counts.items():
+                    totals[key] += count
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            # Bulk writes skip the signals that refresh the lookup index
+            # and the pre-rendered pages. The pages are rendered here
+            # rather than in a background thread, which would not
+            # outlive the command.
+            publish_index()
+            if getattr(settings, 'LOCATION_PRERENDER_DIR', None):
+                prerender(settings.LOCATION_PRERENDER_DIR)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            'Loaded {rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s): '
+            '{capitals} capitals created, {created} states created, '
+            '{updated} states updated.'.format(
+                elapsed=elapsed,
+                rate=totals['rows'] / elapsed if elapsed else 0,
+                **totals)))
+
+    def parse_record(self, record, number):
+        """Return a normalized, unsaved State with its capital name."""
+        if not isinstance(record, dict):
+            raise CommandError('Row {} is not a record.'.format(number))
+        name = record.get('state') or record.get('name')
+        abbr = record.get('abbr')
+        capital = record.get('capital')
+        if not (name and abbr and capital):
+            raise CommandError(
+                'Row {} needs state, abbr and capital values.'.format(number))
+        if len(abbr.strip()) != 2:
+            raise CommandError(
+                'Row {} has an abbreviation that is not two letters.'.format(
+                    number))
+
+        state = State(name=name.strip(), abbr=abbr.strip())
+        state.normalize()
+        capital = Capital(name=capital.strip())
+        capital.normalize()
+        return state, capital.name
+
+    @transaction.atomic
+    def load_batch(self, batch, offset):
+        """Upsert one batch of records with a fixed number of queries."""
+        # Later records win when a batch repeats an abbreviation.
+        states = {}
+        for number, record in enumerate(batch, start=offset + 1):
+            state, capital_name = self.parse_record(record, number)
+            states[state.abbr] = (state, capital_name)
+
+        # Resolve capitals in memory, creating the missing ones.
+        capital_names = {capital for state, capital in states.values()}
+        capital_ids = dict(Capital.objects.filter(
+            name__in=capital_names).values_list('name', 'id'))
+        new_capitals = []
+        for capital_name in capital_names - capital_ids.keys():
+            capital = Capital(name=capital_name)
+            capital.normalize()
+            new_capitals.append(capital)
+        if new_capitals:
+            Capital.objects.bulk_create(new_capitals)
+            capital_ids.update(Capital.objects.filter(
+                name__in=[capital.name for capital in new_capitals]
+            ).values_list('name', 'id'))
+
+        existing = {
+            state.abbr: state
+            for state in State.objects.filter(abbr__in=states.keys())
+        }
+        created, updated = [], []
+        for abbr, (state, capital_name) in states.items():
+            capital_id = capital_ids[capital_name]
+            if abbr in existing:
+                current = existing[abbr]
+                if (current.name, current.capital_id) == (
+                        state.name, capital_id):
+                    continue
+                current.name = state.name
+                current.name_key = state.name_key
+                current.capital_id = capital_id
+                updated.append(current)
+            else:
+                state.capital_id = capital_id
+                created.append(state)
+
+        State.objects.bulk_create(created)
+        self.update_states(updated)
+        return {
+            'capitals': len(new_capitals),
+            'created': len(created),
+            'updated': len(updated),
+        }
+
+    def update_states(self, states):
+        """
+        Write changed states with one prepared UPDATE.
+
+        QuerySet.bulk_update() builds a CASE expression per row, which
+        dominates load time on large files.
+        """
+        if not states:
+            return
+        quote = connection.ops.quote_name
+        columns = [
+            State._meta.get_field(name).column
+            for name in ('name', 'name_key', 'capital', 'id')
+        ]
+        sql = 'UPDATE {} SET {} = %s, {} = %s, {} = %s WHERE {} = %s'.format(
+            quote(State._meta.db_table), *map(quote, columns))
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [
+                (state.name, state.name_key, state.capital_id, state.pk)
+                for state in states
+            ])
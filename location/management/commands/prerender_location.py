@@ -0,0 +1,33 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from location.prerender import PAGES_DIR, prerender
+
+
+class Command(BaseCommand):
+    help = (
+        'Write the states page and every state and capital lookup as '
+        'static files, with gzip copies, for nginx to serve.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default=getattr(settings, 'LOCATION_PRERENDER_DIR', None),
+            help='Directory to write to. Defaults to LOCATION_PRERENDER_DIR.')
+
+    def handle(self, *args, **options):
+        output_dir = options['output']
+        if not output_dir:
+            raise CommandError(
+                'Set LOCATION_PRERENDER_DIR or pass --output.')
+
+        start = time.perf_counter()
+        pages = prerender(output_dir)
+        self.stdout.write(self.style.SUCCESS(
+            'Pre-rendered {} pages into {} in {:.2f}s.'.format(
+                pages, os.path.join(output_dir, PAGES_DIR),
+                time.perf_counter() - start)))
@@ -0,0 +1,295 @@
+"""
+Request metrics aggregated across worker processes.
+
+Every worker keeps its samples in its own memory-mapped file under
+LOCATION_METRICS_DIR, so recording a sample only writes to local memory
+and workers never wait on each other. The metrics view sums the files
+of all workers and renders the totals in the Prometheus text format.
+"""
+import glob
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from django.conf import settings
+
+# Upper bounds of the request latency histogram buckets, in seconds.
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, float('inf'),
+)
+
+# Type and help text of every metric family, in output order.
+FAMILIES = {
+    'location_requests_total': (
+        'counter', 'Requests served by view, lookup type and status.'),
+    'location_request_duration_seconds': (
+        'histogram', 'Time taken to serve requests by view and lookup type.'),
+    'location_db_queries_total': (
+        'counter', 'SQL queries run while serving requests by view.'),
+    'location_page_cache_requests_total': (
+        'counter', 'Page cache lookups by result.'),
+    'location_db_connections_total': (
+        'counter', 'Database connections opened, reused from the pool or '
+        'failed, by alias.'),
+}
+
+# Request methods kept as labels. Any other method a client sends is
+# counted as 'other', so clients cannot create new series at will.
+METHODS = frozenset(
+    ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+HEADER = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+
+
+def _entries(buffer, used):
+    """Yield the key, value and value offset of each entry in a buffer."""
+    offset = HEADER.size
+    while offset < used:
+        length = KEY_LENGTH.unpack_from(buffer, offset)[0]
+        start = offset + KEY_LENGTH.size
+        key = bytes(buffer[start:start + length]).decode('utf-8')
+        # Values are aligned to eight bytes.
+        offset = start + length + (-(KEY_LENGTH.size + length) % 8)
+        yield key, VALUE.unpack_from(buffer, offset)[0], offset
+        offset += VALUE.size
+
+
+class MmapStore:
+    """
+    Float values keyed by string, kept in a memory-mapped file.
+
+    The file starts with the number of bytes in use, followed by entries
+    made of a key length, the UTF-8 key and a double. Entries are only
+    appended, and the size in use is updated after an entry is written,
+    so other processes reading the file never see a partial entry.
+    """
+    initial_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.initial_size:
+            size = self.initial_size
+            self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+        self._used = HEADER.unpack_from(self._mmap)[0] or HEADER.size
+        HEADER.pack_into(self._mmap, 0, self._used)
+        self._offsets = {
+            key: offset
+            for key, value, offset in _entries(self._mmap, self._used)
+        }
+
+    def add(self, key, amount):
+        with self._lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._append(key)
+            value = VALUE.unpack_from(self._mmap, offset)[0]
+            VALUE.pack_into(self._mmap, offset, value + amount)
+
+    def items(self):
+        with self._lock:
+            return [
+                (key, value)
+                for key, value, offset in _entries(self._mmap, self._used)
+            ]
+
+    def close(self):
+        with self._lock:
+            self._mmap.close()
+            self._file.close()
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        padding = -(KEY_LENGTH.size + len(encoded)) % 8
+        size = KEY_LENGTH.size + len(encoded) + padding + VALUE.size
+        while self._used + size > len(self._mmap):
+            self._grow()
+
+        start = self._used
+        KEY_LENGTH.pack_into(self._mmap, start, len(encoded))
+        start += KEY_LENGTH.size
+        self._mmap[start:start + len(encoded)] = encoded
+        offset = start + len(encoded) + padding
+        VALUE.pack_into(self._mmap, offset, 0.0)
+
+        self._used += size
+        HEADER.pack_into(self._mmap, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def _grow(self):
+        size = len(self._mmap) * 2
+        self._mmap.close()
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+
+def read_store(path):
+    """Return the entries of a store file written by any process."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        return []
+    used = min(HEADER.unpack_from(data)[0], len(data))
+    return [(key, value) for key, value, offset in _entries(data, used)]
+
+
+def metrics_dir():
+    return getattr(settings, 'LOCATION_METRICS_DIR', None) or os.path.join(
+        tempfile.gettempdir(), 'location-metrics')
+
+
+_store = None
+_lock = threading.Lock()
+
+
+def get_store():
+    """Return the store of the current process, opening it after a fork."""
+    global _store
+    directory = metrics_dir()
+    current = _store
+    if current is not None and current[:2] == (os.getpid(), directory):
+        return current[2]
+    with _lock:
+        if _store is None or _store[:2] != (os.getpid(), directory):
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'worker-{}.db'.format(os.getpid()))
+            _store = (os.getpid(), directory, MmapStore(path))
+        return _store[2]
+
+
+def _key(family, name, labels):
+    return json.dumps([family, name, sorted(labels.items())])
+
+
+def inc(family, labels, amount=1):
+    """Add ``amount`` to a counter."""
+    get_store().add(_key(family, family, labels), amount)
+
+
+def observe(family, labels, value):
+    """Record ``value`` in a histogram."""
+    store = get_store()
+    bound = next(bound for bound in DURATION_BUCKETS if value <= bound)
+    # Buckets are kept per interval and made cumulative when rendered.
+    store.add(_key(
+        family, family + '_bucket', dict(labels, le=_format(bound))), 1)
+    store.add(_key(family, family + '_sum', labels), value)
+    store.add(_key(family, family + '_count', labels), 1)
+
+
+def record_request(view, lookup, method, status, duration, queries=None,
+                   cache_status=None):
+    """Record one served request."""
+    labels = {'view': view, 'lookup': lookup}
+    if method not in METHODS:
+        method = 'other'
+    inc('location_requests_total',
+        dict(labels, method=method, status=str(status)))
+    observe('location_request_duration_seconds', labels, duration)
+    if queries is not None:
+        inc('location_db_queries_total', {'view': view}, queries)
+    if cache_status is not None:
+        inc('location_page_cache_requests_total', {'result': cache_status})
+
+
+def collect():
+    """Return the samples of every process, summed."""
+    totals = {}
+    for path in glob.glob(os.path.join(metrics_dir(), '*.db')):
+        try:
+            entries = read_store(path)
+        except FileNotFoundError:
+            continue
+        for key, value in entries:
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{{{}}}'.format(','.join(
+            '{}="{}"'.format(label, _escape(label_value))
+            for label, label_value in labels))
+    return '{} {}'.format(name, _format(value))
+
+
+def _histogram_samples(family, samples):
+    series = {}
+    for name, labels, value in samples:
+        le = dict(labels).pop('le', None)
+        labels = tuple(label for label in labels if label[0] != 'le')
+        counts = series.setdefault(labels, {})
+        if name.endswith('_bucket'):
+            counts[float(le)] = value
+        else:
+            counts[name] = value
+
+    lines = []
+    for labels, counts in sorted(series.items()):
+        cumulative = 0.0
+        for bound in DURATION_BUCKETS:
+            cumulative += counts.get(bound, 0.0)
+            lines.append(_sample(
+                family + '_bucket', labels + (('le', _format(bound)),),
+                cumulative))
+        lines.append(_sample(
+            family + '_sum', labels, counts.get(family + '_sum', 0.0)))
+        lines.append(_sample(
+            family + '_count', labels, counts.get(family + '_count', 0.0)))
+    return lines
+
+
+def render_metrics():
+    """Render the metrics of all processes in the Prometheus text format."""
+    families = {}
+    for key, value in collect().items():
+        family, name, labels = json.loads(key)
+        families.setdefault(family, []).append(
+            (name, tuple(map(tuple, labels)), value))
+
+    lines = []
+    for family, (kind, help_text) in FAMILIES.items():
+        samples = sorted(families.get(family, ()))
+        lines.append('# HELP {} {}'.format(family, help_text))
+        lines.append('# TYPE {} {}'.format(family, kind))
+        if kind == 'histogram':
+            lines.extend(_histogram_samples(family, samples))
+        else:
+            lines.extend(
+                _sample(name, labels, value)
+                for name, labels, value in samples)
+
+    cache = {
+        dict(labels)['result']: value
+        for name, labels, value in families.get(
+            'location_page_cache_requests_total', ())
+    }
+    lookups = sum(cache.values())
+    lines.append('# HELP location_page_cache_hit_ratio '
+                 'Share of page cache lookups served from the cache.')
+    lines.append('# TYPE location_page_cache_hit_ratio gauge')
+    lines.append(_sample(
+        'location_page_cache_hit_ratio', (),
+        cache.get('hit', 0.0) / lookups if lookups else 0.0))
+    return '\n'.join(lines) + '\n'
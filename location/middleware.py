@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from .compression import acompress_response, compress_response
+from .metrics import record_request
+from .querybudget import QueryBudget, QueryRecorder, recording
+from .timing import add_timing
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+timing_logger = logging.getLogger('location.timing')
+
+
+class HybridMiddleware:
+    """Base class for middleware usable in sync and async stacks."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+class QueryBudgetMiddleware(HybridMiddleware):
+    """
+    Check each request against the query budget of its view.
+
+    Views declare a budget with a ``query_budget`` attribute. The
+    LOCATION_QUERY_BUDGET_MODE setting selects 'warn' to log requests
+    over budget, 'raise' to fail them, or 'off'.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        mode = getattr(settings, 'LOCATION_QUERY_BUDGET_MODE', 'warn')
+        if mode == 'off':
+            return self.get_response(request)
+
+        request.query_budget = QueryBudget(mode=mode)
+        with request.query_budget:
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        mode = getattr(settings, 'LOCATION_QUERY_BUDGET_MODE', 'warn')
+        if mode == 'off':
+            return await self.get_response(request)
+
+        request.query_budget = QueryBudget(mode=mode)
+        with request.query_budget:
+            return await self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budget = getattr(request, 'query_budget', None)
+        if budget is None:
+            return None
+        view = getattr(view_func, 'view_class', view_func)
+        budget.budget = getattr(view, 'query_budget', None)
+        budget.label = request.resolver_match.view_name
+        return None
+
+
+class ServerTimingMiddleware(HybridMiddleware):
+    """
+    Break down where the time of each request went.
+
+    Adds a Server-Timing header with database time and query count,
+    template render time, cache hit or miss and total time, and logs the
+    same values as one key=value line on the 'location.timing' logger.
+    Install it first in MIDDLEWARE so the total covers other middleware.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not getattr(settings, 'LOCATION_SERVER_TIMING', True):
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        request.server_timing = {}
+        with recording(QueryRecorder()) as recorder:
+            response = self.get_response(request)
+        return self.finish(request, response, start, recorder)
+
+    async def __acall__(self, request):
+        if not getattr(settings, 'LOCATION_SERVER_TIMING', True):
+            return await self.get_response(request)
+
+        start = time.perf_counter()
+        request.server_timing = {}
+        with recording(QueryRecorder()) as recorder:
+            response = await self.get_response(request)
+        return self.finish(request, response, start, recorder)
+
+    def process_template_response(self, request, response):
+        start = time.perf_counter()
+        response.add_post_render_callback(
+            lambda response: add_timing(
+                request, 'template', time.perf_counter() - start))
+        return response
+
+    def finish(self, request, response, start, recorder):
+        total = time.perf_counter() - start
+        timings = request.server_timing
+        cache_status = getattr(request, 'cache_status', None)
+
+        metrics = []
+        log_values = [
+            ('method', request.method),
+            ('path', request.path),
+            ('status', response.status_code),
+        ]
+        metrics.append('db;dur={:.3f};desc="{} queries"'.format(
+            recorder.duration * 1000, recorder.count))
+        log_values += [
+            ('db_ms', '{:.3f}'.format(recorder.duration * 1000)),
+            ('queries', recorder.count),
+        ]
+        if 'template' in timings:
+            metrics.append('tpl;dur={:.3f}'.format(timings['template'] * 1000))
+            log_values.append(
+                ('template_ms', '{:.3f}'.format(timings['template'] * 1000)))
+        if cache_status is not None:
+            metrics.append('cache;desc="{}"'.format(cache_status))
+            log_values.append(('cache', cache_status))
+        metrics.append('total;dur={:.3f}'.format(total * 1000))
+        log_values.append(('total_ms', '{:.3f}'.format(total * 1000)))
+
+        response['Server-Timing'] = ', '.join(metrics)
+        if timing_logger.isEnabledFor(logging.INFO):
+            timing_logger.info(' '.join(
+                '{}={}'.format(key, value) for key, value in log_values))
+        return response
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """
+    Record request counts, latencies, query counts and page cache results
+    for the metrics view.
+
+    Requests are labelled with the name of the URL pattern they matched
+    and the lookup type their view reports.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not getattr(settings, 'LOCATION_METRICS', True):
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        with recording(QueryRecorder()) as recorder:
+            response = self.get_response(request)
+        self.record(request, response, start, recorder.count)
+        return response
+
+    async def __acall__(self, request):
+        if not getattr(settings, 'LOCATION_METRICS', True):
+            return await self.get_response(request)
+
+        start = time.perf_counter()
+        with recording(QueryRecorder()) as recorder:
+            response = await self.get_response(request)
+        self.record(request, response, start, recorder.count)
+        return response
+
+    def record(self, request, response, start, queries):
+        match = request.resolver_match
+        record_request(
+            view=match.view_name if match else 'unmatched',
+            lookup=getattr(request, 'lookup_type', None) or 'none',
+            method=request.method,
+            status=response.status_code,
+            duration=time.perf_counter() - start,
+            queries=queries,
+            cache_status=getattr(request, 'cache_status', None),
+        )
+
+
+class CompressionMiddleware(HybridMiddleware):
+    """
+    Compress HTML and JSON responses with brotli or gzip.
+
+    Views opt in with a ``compressible`` attribute. Bodies with a strong
+    ETag are cached, so a page served many times is only compressed
+    once. Install it above anything that reads the body.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        if not getattr(settings, 'LOCATION_COMPRESSION', True):
+            return response
+        return compress_response(request, response)
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if not getattr(settings, 'LOCATION_COMPRESSION', True):
+            return response
+        return await acompress_response(request, response)
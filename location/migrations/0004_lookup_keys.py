@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('location', '0003_auto_20210213_0633'),
+    ]
+
+    def populateLookupKeys(apps, schema_editor):
+        """Fill in the normalized lookup keys of existing rows"""
+        def normalize_name(value):
+            return ' '.join(value.replace('_', ' ').split()).casefold()
+
+        for model_name in ('Capital', 'State'):
+            Model = apps.get_model('location', model_name)
+            rows = list(Model.objects.only('id', 'name'))
+            for row in rows:
+                row.name_key = normalize_name(row.name)
+            Model.objects.bulk_update(rows, ['name_key'])
+
+    operations = [
+        migrations.AddField(
+            model_name='capital',
+            name='name_key',
+            field=models.CharField(
+                db_index=True,
+                default='',
+                editable=False,
+                max_length=100
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='state',
+            name='name_key',
+            field=models.CharField(
+                db_index=True,
+                default='',
+                editable=False,
+                max_length=100
+            ),
+            preserve_default=False,
+        ),
+        migrations.RunPython(
+            populateLookupKeys, migrations.RunPython.noop),
+    ]
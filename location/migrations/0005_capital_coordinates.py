@@ -0,0 +1,84 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('location', '0004_lookup_keys'),
+    ]
+
+    def populateCoordinates(apps, schema_editor):
+        """Set the latitude and longitude of the 50 state capitals"""
+        coordinates = {
+            'Montgomery': (32.3777, -86.3006),
+            'Juneau': (58.3019, -134.4197),
+            'Phoenix': (33.4484, -112.0740),
+            'Little Rock': (34.7465, -92.2896),
+            'Sacramento': (38.5816, -121.4944),
+            'Denver': (39.7392, -104.9903),
+            'Hartford': (41.7658, -72.6734),
+            'Dover': (39.1582, -75.5244),
+            'Tallahassee': (30.4383, -84.2807),
+            'Atlanta': (33.7490, -84.3880),
+            'Honolulu': (21.3069, -157.8583),
+            'Boise': (43.6150, -116.2023),
+            'Springfield': (39.7817, -89.6501),
+            'Indianapolis': (39.7684, -86.1581),
+            'Des Moines': (41.5868, -93.6250),
+            'Topeka': (39.0473, -95.6752),
+            'Frankfort': (38.2009, -84.8733),
+            'Baton Rouge': (30.4515, -91.1871),
+            'Augusta': (44.3106, -69.7795),
+            'Annapolis': (38.9784, -76.4922),
+            'Boston': (42.3601, -71.0589),
+            'Lansing': (42.7325, -84.5555),
+            'Saint Paul': (44.9537, -93.0900),
+            'Jackson': (32.2988, -90.1848),
+            'Jefferson City': (38.5767, -92.1735),
+            'Helena': (46.5891, -112.0391),
+            'Lincoln': (40.8136, -96.7026),
+            'Carson City': (39.1638, -119.7674),
+            'Concord': (43.2081, -71.5376),
+            'Trenton': (40.2206, -74.7597),
+            'Santa Fe': (35.6870, -105.9378),
+            'Albany': (42.6526, -73.7562),
+            'Raleigh': (35.7796, -78.6382),
+            'Bismarck': (46.8083, -100.7837),
+            'Columbus': (39.9612, -82.9988),
+            'Oklahoma City': (35.4676, -97.5164),
+            'Salem': (44.9429, -123.0351),
+            'Harrisburg': (40.2732, -76.8867),
+            'Providence': (41.8240, -71.4128),
+            'Columbia': (34.0007, -81.0348),
+            'Pierre': (44.3683, -100.3510),
+            'Nashville': (36.1627, -86.7816),
+            'Austin': (30.2672, -97.7431),
+            'Salt Lake City': (40.7608, -111.8910),
+            'Montpelier': (44.2601, -72.5754),
+            'Richmond': (37.5407, -77.4360),
+            'Olympia': (47.0379, -122.9007),
+            'Charleston': (38.3498, -81.6326),
+            'Madison': (43.0731, -89.4012),
+            'Cheyenne': (41.1400, -104.8202),
+        }
+
+        Capital = apps.get_model('location', 'Capital')
+        capitals = list(Capital.objects.filter(name__in=coordinates))
+        for capital in capitals:
+            capital.latitude, capital.longitude = coordinates[capital.name]
+        Capital.objects.bulk_update(capitals, ['latitude', 'longitude'])
+
+    operations = [
+        migrations.AddField(
+            model_name='capital',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='capital',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunPython(
+            populateCoordinates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+import unicodedata
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('location', '0005_capital_coordinates'),
+    ]
+
+    def refreshLookupKeys(apps, schema_editor):
+        """Fold accents and punctuation out of existing lookup keys"""
+        translation = str.maketrans(
+            '_-,/\u2013\u2014', ' ' * 6, ".'`\u2018\u2019\u02bb")
+        words = {'st': 'saint', 'mt': 'mount', 'ft': 'fort'}
+
+        def normalize_name(value):
+            decomposed = unicodedata.normalize('NFKD', value)
+            stripped = ''.join(
+                char for char in decomposed
+                if not unicodedata.combining(char))
+            return ' '.join(
+                words.get(word, word)
+                for word in stripped.translate(translation).casefold().split())
+
+        for model_name in ('Capital', 'State'):
+            Model = apps.get_model('location', model_name)
+            rows = [
+                row for row in Model.objects.only('id', 'name', 'name_key')
+                if row.name_key != normalize_name(row.name)
+            ]
+            for row in rows:
+                row.name_key = normalize_name(row.name)
+            Model.objects.bulk_update(rows, ['name_key'])
+
+    operations = [
+        migrations.RunPython(
+            refreshLookupKeys, migrations.RunPython.noop),
+    ]
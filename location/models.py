@@ -1,6 +1,10 @@
+import hashlib
+
 from django.core.validators import RegexValidator
 from django.db import models
 
+from .normalize import normalize_name
+
 
 class Capital(models.Model):
     """Capital City Model Class"""
@@ -13,16 +17,28 @@ class Capital(models.Model):
         unique=True,
         validators=[alpha]
     )
+    name_key = models.CharField(
+        max_length=100,
+        db_index=True,
+        editable=False
+    )
+    latitude = models.FloatField(blank=True, null=True)
+    longitude = models.FloatField(blank=True, null=True)
 
     class Meta:
         verbose_name = "capital"
         verbose_name_plural = "capitals"
         ordering = ['name']
 
-    def save(self, *args, **kwargs):
-        """Ensure capitalization of capital names upon save"""
+    def normalize(self):
+        """Ensure capitalization of capital names"""
         if self.name is not None:
             self.name = self.name.title()  # Capitalize first letter
+            self.name_key = normalize_name(self.name)  # Lookup key
+
+    def save(self, *args, **kwargs):
+        """Ensure capitalization of capital names upon save"""
+        self.normalize()
         return super(Capital, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -49,19 +65,35 @@ class State(models.Model):
         validators=[alpha]
     )
     capital = models.ForeignKey(Capital, on_delete=models.CASCADE, null=False)
+    name_key = models.CharField(
+        max_length=100,
+        db_index=True,
+        editable=False
+    )
 
     class Meta:
         verbose_name = "state"
         verbose_name_plural = "states"
         ordering = ['name']
 
-    def save(self, *args, **kwargs):
-        """Ensure capitalization of state names and abbreviations upon save"""
+    def normalize(self):
+        """Ensure capitalization of state names and abbreviations"""
         if self.name is not None:
             self.name = self.name.title()  # Capitalize only first letter
+            self.name_key = normalize_name(self.name)  # Lookup key
         if self.abbr is not None:
             self.abbr = self.abbr.upper()  # Capitalize all letters
+
+    def save(self, *args, **kwargs):
+        """Ensure capitalization of state names and abbreviations upon save"""
+        self.normalize()
         return super(State, self).save(*args, **kwargs)
 
+    @property
+    def row_version(self):
+        """Hash of the values shown for a state, for fragment caching"""
+        values = '|'.join((self.name, self.abbr, self.capital.name))
+        return hashlib.sha1(values.encode()).hexdigest()[:16]
+
     def __str__(self):
         return self.name
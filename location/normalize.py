@@ -0,0 +1,119 @@
+"""
+Normalization of state and capital names into lookup keys.
+
+Keys ignore case, accents, punctuation and how words are separated, so
+"new_hampshire", "New-Hampshire" and "NEW  HAMPSHIRE" share a key, as do
+"Hawai'i" and "Hawaii". The name_key columns hold the same keys.
+
+parse_state_query() also tells abbreviations from names and resolves
+the usual short forms of state names, such as "Calif." or "D.C.". Query
+values are mapped to their keys through an LRU of
+LOCATION_NORMALIZE_CACHE_SIZE entries per process, so a repeated
+spelling costs one dictionary lookup. The mapping does not depend on the
+dataset and never goes stale.
+"""
+import unicodedata
+from functools import lru_cache
+
+from django.conf import settings
+
+# Characters left out of keys, so that "D.C." reads as "DC".
+DROPPED = ".'`\u2018\u2019\u02bb"
+
+# Characters that separate words like a space does.
+SEPARATORS = '_-,/\u2013\u2014'
+
+_TRANSLATION = str.maketrans(
+    SEPARATORS, ' ' * len(SEPARATORS), DROPPED)
+
+# Abbreviated words, spelled out wherever they appear in a name.
+WORD_ALIASES = {
+    'st': 'saint',
+    'mt': 'mount',
+    'ft': 'fort',
+}
+
+# Short forms of state names that are not the postal abbreviation, by
+# key without spaces. Two letter forms such as "N.Y." are abbreviations
+# already.
+STATE_ALIASES = {
+    'ala': 'AL',
+    'ariz': 'AZ',
+    'ark': 'AR',
+    'cal': 'CA',
+    'calif': 'CA',
+    'colo': 'CO',
+    'conn': 'CT',
+    'del': 'DE',
+    'fla': 'FL',
+    'ill': 'IL',
+    'ind': 'IN',
+    'kan': 'KS',
+    'kans': 'KS',
+    'mass': 'MA',
+    'mich': 'MI',
+    'minn': 'MN',
+    'miss': 'MS',
+    'mont': 'MT',
+    'ndak': 'ND',
+    'neb': 'NE',
+    'nebr': 'NE',
+    'nev': 'NV',
+    'nmex': 'NM',
+    'okla': 'OK',
+    'ore': 'OR',
+    'oreg': 'OR',
+    'penn': 'PA',
+    'sdak': 'SD',
+    'tenn': 'TN',
+    'tex': 'TX',
+    'wash': 'WA',
+    'washingtondc': 'DC',
+    'wis': 'WI',
+    'wisc': 'WI',
+    'wva': 'WV',
+    'wyo': 'WY',
+}
+
+CACHE_SIZE = getattr(settings, 'LOCATION_NORMALIZE_CACHE_SIZE', 4096)
+
+
+def _words(value):
+    decomposed = unicodedata.normalize('NFKD', value)
+    stripped = ''.join(
+        char for char in decomposed if not unicodedata.combining(char))
+    return stripped.translate(_TRANSLATION).casefold().split()
+
+
+def _join(words):
+    return ' '.join(WORD_ALIASES.get(word, word) for word in words)
+
+
+def fold(value):
+    """Return the lookup key for any spelling of a name."""
+    return _join(_words(value))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize_name(value):
+    """Return the lookup key for a state or capital name."""
+    return fold(value)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_state_query(value):
+    """
+    Return the lookup a state query value selects.
+
+    That is ('abbr', postal abbreviation) for abbreviations and known
+    short forms, and ('name', key) for anything else.
+    """
+    words = _words(value)
+    # Short forms are matched without their spaces, so "W. Va." and
+    # "N. Y." are found as well as "W.Va." and "N.Y.".
+    compact = ''.join(words)
+    if compact in STATE_ALIASES:
+        return 'abbr', STATE_ALIASES[compact]
+    if len(compact) == 2:
+        return 'abbr', compact.upper()
+    return 'name', _join(words)
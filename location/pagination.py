@@ -0,0 +1,146 @@
+"""
+Keyset pagination for location lists.
+
+Pages are selected by the sort key of the last row seen rather than by
+an offset, so every page costs one indexed range scan of ``page_size``
+rows however deep it is. Cursors carry that key, base64 encoded, and
+are opaque to clients.
+"""
+import base64
+import binascii
+import json
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Q
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'previous_cursor'])
+
+# Sort key of the paginated lists and the type of each of its values.
+# Names are unique, so they need no tie-breaker, and a filter on the
+# name alone is answered with a range seek on its index.
+ORDERING = ('name',)
+ORDERING_TYPES = (str,)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(position, reverse=False):
+    data = json.dumps([list(position), reverse], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return the position and direction a cursor points at."""
+    try:
+        position, reverse = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')))
+        position = tuple(position)
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor.')
+    if len(position) != len(ORDERING) or not isinstance(reverse, bool):
+        raise InvalidCursor('Invalid cursor.')
+    if not all(map(isinstance, position, ORDERING_TYPES)):
+        raise InvalidCursor('Invalid cursor.')
+    return position, reverse
+
+
+def pagination_params(params):
+    """
+    Return the cursor and page size requested, or None when the request
+    does not ask for a page.
+    """
+    cursor = params.get('cursor', None)
+    page_size = params.get('page_size', None)
+    if cursor is None and page_size is None:
+        return None
+
+    max_page_size = getattr(settings, 'LOCATION_MAX_PAGE_SIZE', 500)
+    if page_size is None:
+        page_size = getattr(settings, 'LOCATION_PAGE_SIZE', 25)
+    else:
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            raise ValueError('page_size must be a number.')
+        if not 1 <= page_size <= max_page_size:
+            raise ValueError('page_size must be between 1 and {}.'.format(
+                max_page_size))
+    if cursor:
+        decode_cursor(cursor)
+    return cursor or None, page_size
+
+
+def sort_key(item):
+    return tuple(getattr(item, field) for field in ORDERING)
+
+
+def _after(position, reverse):
+    """Build the filter for rows past a position, in either direction."""
+    (field,), (value,) = ORDERING, position
+    lookup = 'lt' if reverse else 'gt'
+    return Q(**{'{}__{}'.format(field, lookup): value})
+
+
+def paginate_queryset(queryset, cursor, page_size):
+    """Return one page of a queryset."""
+    position, reverse = decode_cursor(cursor) if cursor else (None, False)
+    if reverse:
+        queryset = queryset.order_by(*('-' + field for field in ORDERING))
+    else:
+        queryset = queryset.order_by(*ORDERING)
+    if position is not None:
+        queryset = queryset.filter(_after(position, reverse))
+
+    # One extra row tells whether there is another page.
+    items = list(queryset[:page_size + 1])
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    if reverse:
+        items.reverse()
+    return _page(items, position is not None, has_more, reverse)
+
+
+def paginate_sequence(items, keys, cursor, page_size):
+    """
+    Return one page of a sequence sorted on ORDERING, given the sort key
+    of each item.
+    """
+    position, reverse = decode_cursor(cursor) if cursor else (None, False)
+    if position is None:
+        start, end = 0, page_size
+    elif reverse:
+        end = bisect_left(keys, position)
+        start = max(end - page_size, 0)
+    else:
+        start = bisect_right(keys, position)
+        end = start + page_size
+    end = min(end, len(keys))
+    if start >= end:
+        return Page([], None, None)
+    return Page(
+        items=list(items[start:end]),
+        next_cursor=(
+            encode_cursor(keys[end - 1]) if end < len(keys) else None),
+        previous_cursor=(
+            encode_cursor(keys[start], reverse=True) if start > 0 else None),
+    )
+
+
+def _page(items, came_from_cursor, has_more, reverse):
+    if not items:
+        return Page(items, None, None)
+    if reverse:
+        has_next, has_previous = came_from_cursor, has_more
+    else:
+        has_next, has_previous = has_more, came_from_cursor
+    return Page(
+        items=items,
+        next_cursor=encode_cursor(sort_key(items[-1])) if has_next else None,
+        previous_cursor=(
+            encode_cursor(sort_key(items[0]), reverse=True)
+            if has_previous else None),
+    )
@@ -0,0 +1,173 @@
+"""
+Pre-rendered copies of the states page for nginx to serve from disk.
+
+The page only changes when a State or Capital does, so every variant
+worth caching is written out ahead of time: the full list as index.html
+and one page per state under state/ and capital/, named after the raw
+query string values that select it. Each page has a gzip copy next to it
+for gzip_static. nginx falls back to Django for any other request.
+
+Workers and containers that share the output directory render at the
+same time, but swap in their pages one at a time under a file lock kept
+next to the pages.
+"""
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from urllib.parse import quote
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpRequest
+
+from .index import get_index
+from .singleflight import file_lock
+from .views import StateListView
+
+logger = logging.getLogger(__name__)
+
+# Name of the directory inside the output directory that nginx serves.
+PAGES_DIR = 'pages'
+
+# Name of the lock taken in the output directory to swap in new pages.
+SWAP_LOCK = '.prerender'
+
+
+def query_variants(value):
+    """Return the spellings of a query value that select the same page."""
+    variants = set()
+    for text in (value, value.lower()):
+        encoded = quote(text, safe='')
+        variants.update((
+            encoded,
+            encoded.replace('%20', '+'),
+            quote(text.replace(' ', '_'), safe=''),
+        ))
+    return variants
+
+
+def render_page(params):
+    """Render the states page for the given query parameters."""
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = '/'
+    request.GET.update(params)
+    response = StateListView.as_view()(request)
+    if hasattr(response, 'render'):
+        response.render()
+    return response.content
+
+
+def _write(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+
+def prerender(output_dir):
+    """
+    Write every page variant into ``output_dir``.
+
+    Pages are written to a new directory that then replaces the served
+    one, so nginx never serves a mix of old and new pages and pages of
+    removed states disappear. Returns the number of pages written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix='.pages-', dir=output_dir)
+    try:
+        # mkdtemp() makes the directory private, but nginx runs as
+        # another user.
+        os.chmod(build_dir, 0o755)
+        os.mkdir(os.path.join(build_dir, 'state'))
+        os.mkdir(os.path.join(build_dir, 'capital'))
+
+        _write(build_dir, 'index.html', render_page({}))
+        pages = 1
+        for state in get_index().states:
+            content = render_page({'state': state.abbr})
+            names = [
+                os.path.join('state', value + '.html')
+                for value in query_variants(state.abbr)
+                | query_variants(state.name)
+            ]
+            names.extend(
+                os.path.join('capital', value + '.html')
+                for value in query_variants(state.capital.name))
+            for name in names:
+                _write(build_dir, name, content)
+            pages += len(names)
+
+        with file_lock(SWAP_LOCK, directory=output_dir):
+            _swap(build_dir, output_dir)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    return pages
+
+
+def _swap(build_dir, output_dir):
+    """Serve the pages in ``build_dir`` instead of the current ones."""
+    # Old pages left behind by a run that crashed mid-swap.
+    for name in os.listdir(output_dir):
+        if name.startswith('.old-'):
+            shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+
+    served_dir = os.path.join(output_dir, PAGES_DIR)
+    old_dir = tempfile.mkdtemp(prefix='.old-', dir=output_dir)
+    old_pages = os.path.join(old_dir, PAGES_DIR)
+    try:
+        if os.path.exists(served_dir):
+            os.rename(served_dir, old_pages)
+        # Requests between the renames fall through to Django.
+        os.rename(build_dir, served_dir)
+    except BaseException:
+        if os.path.exists(old_pages) and not os.path.exists(served_dir):
+            os.rename(old_pages, served_dir)
+        raise
+    finally:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+_pending = False
+_worker = None
+_lock = threading.Lock()
+
+
+def schedule_prerender():
+    """
+    Pre-render the pages again in a background thread.
+
+    Changes made while a run is in progress are picked up by one more
+    run, so a burst of saves costs at most two. Returns the thread.
+    """
+    global _pending, _worker
+    with _lock:
+        _pending = True
+        if _worker is None:
+            _worker = threading.Thread(
+                target=_prerender_pending, name='prerender-location',
+                daemon=True)
+            _worker.start()
+        return _worker
+
+
+def _prerender_pending():
+    global _pending, _worker
+    try:
+        while True:
+            with _lock:
+                if not _pending:
+                    _worker = None
+                    return
+                _pending = False
+            try:
+                prerender(settings.LOCATION_PRERENDER_DIR)
+            except Exception:
+                logger.exception('Pre-rendering the states pages failed.')
+    finally:
+        connections.close_all()
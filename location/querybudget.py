@@ -0,0 +1,120 @@
+"""
+Query budgets for location views.
+
+A budget is the number of SQL queries a block of code may run. Use
+QueryBudget directly as a context manager in tests, or declare a
+``query_budget`` on a view and let QueryBudgetMiddleware check every
+request to it.
+
+Queries are recorded by an execute wrapper that every database
+connection gets when it is opened. It reports to the recorders of the
+current context, and sync_to_async() runs the ORM in a copy of that
+context, so queries made for async requests are recorded as well.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block of code runs more queries than budgeted."""
+
+
+# Recorders of the blocks being recorded in the current context.
+_recorders = ContextVar('query_recorders', default=())
+
+
+def _record(execute, sql, params, many, context):
+    recorders = _recorders.get()
+    if not recorders:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        for recorder in recorders:
+            recorder.queries.append((sql, duration))
+
+
+def install_recorder(connection):
+    """Add the recording execute wrapper to a database connection."""
+    if _record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record)
+
+
+class QueryRecorder:
+    """Each query run inside recording() and its duration."""
+
+    def __init__(self):
+        self.queries = []
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for sql, duration in self.queries)
+
+
+@contextmanager
+def recording(recorder):
+    """Record the queries run inside the block in ``recorder``."""
+    token = _recorders.set(_recorders.get() + (recorder,))
+    try:
+        yield recorder
+    finally:
+        _recorders.reset(token)
+
+
+class QueryBudget:
+    """
+    Record the queries run inside a block and check them against a budget.
+
+    With mode='raise' running over the budget raises QueryBudgetExceeded,
+    which fails tests like any other assertion. With mode='warn' a
+    warning is logged instead. A budget of None only records queries.
+    """
+
+    def __init__(self, budget=None, label=None, mode='raise'):
+        self.budget = budget
+        self.label = label
+        self.mode = mode
+        self.recorder = QueryRecorder()
+        self._recording = None
+
+    @property
+    def queries(self):
+        return [sql for sql, duration in self.recorder.queries]
+
+    def __enter__(self):
+        self._recording = recording(self.recorder)
+        self._recording.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._recording.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self.check()
+
+    def check(self):
+        if self.budget is None or self.recorder.count <= self.budget:
+            return
+        message = '{} ran {} queries, over its budget of {}:\n{}'.format(
+            self.label or 'Code block', self.recorder.count, self.budget,
+            '\n'.join(self.queries))
+        if self.mode == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+def query_budget(budget):
+    """Declare the query budget of a function-based view."""
+    def decorator(view_func):
+        view_func.query_budget = budget
+        return view_func
+    return decorator
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .index import invalidate_index, publish_index
+from .models import State, Capital
+from .prerender import schedule_prerender
+from .querybudget import install_recorder
+
+
+@receiver(connection_created)
+def record_connection_queries(sender, connection, **kwargs):
+    """Let query budgets and timings see the queries of a connection."""
+    install_recorder(connection)
+
+
+@receiver(post_save, sender=State)
+@receiver(post_delete, sender=State)
+@receiver(post_save, sender=Capital)
+@receiver(post_delete, sender=Capital)
+def invalidate_location_index(sender, **kwargs):
+    """Rebuild the lookup index after any change to the dataset."""
+    invalidate_index()
+    # Until the commit, lookups in this transaction build an index of
+    # their own (see location.index._uncommitted).
+    transaction.on_commit(publish_index)
+
+
+@receiver(post_save, sender=State)
+@receiver(post_delete, sender=State)
+@receiver(post_save, sender=Capital)
+@receiver(post_delete, sender=Capital)
+def prerender_location_pages(sender, **kwargs):
+    """Refresh the pre-rendered pages once a change is committed."""
+    if getattr(settings, 'LOCATION_PRERENDER_DIR', None):
+        transaction.on_commit(schedule_prerender)
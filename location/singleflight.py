@@ -0,0 +1,130 @@
+"""
+Single-flight refills of cached values.
+
+When the dataset changes, every cached page goes stale at once and the
+requests that arrive next would all rebuild the same pages. SingleFlight
+lets one caller per key recompute a value while concurrent callers for
+that key wait for its result, or are handed the previous value straight
+away when one is available (stale-while-revalidate). Callers on an
+event loop never wait, as that would hold up every request on the loop,
+and compute the value themselves instead.
+
+file_lock() extends this across worker processes with an flock() on a
+file under LOCATION_LOCK_DIR, so only one worker rebuilds a shared value
+from the database while the others wait to read what it wrote.
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.conf import settings
+
+# Default of the stale argument of SingleFlight.do(), as None is a value.
+_MISSING = object()
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'ok')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.ok = False
+
+
+class SingleFlight:
+    """Coalesce concurrent computations of the same key in a process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, compute, stale=_MISSING, timeout=None):
+        """
+        Return ``compute()``, running it at most once at a time per key.
+
+        Callers that find a computation of the key in flight return
+        ``stale`` if one is given, and otherwise wait up to ``timeout``
+        seconds for its result, except on an event loop. When the wait
+        times out or the computation fails, they compute the value
+        themselves. Returns
+        the value and whether this caller computed it, waited for it
+        (``'coalesced'``) or was handed the stale value (``'stale'``).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if stale is not _MISSING:
+                return stale, 'stale'
+            if _on_event_loop():
+                return compute(), 'computed'
+            if call.done.wait(timeout) and call.ok:
+                return call.result, 'coalesced'
+            return compute(), 'computed'
+
+        try:
+            call.result = compute()
+            call.ok = True
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, 'computed'
+
+
+def lock_dir():
+    return getattr(settings, 'LOCATION_LOCK_DIR', None) or os.path.join(
+        tempfile.gettempdir(), 'location-locks')
+
+
+@contextmanager
+def file_lock(name, timeout=None, poll_interval=0.01, directory=None):
+    """
+    Hold an exclusive lock shared by the processes of this host.
+
+    Waits up to ``timeout`` seconds (forever if None) and yields whether
+    the lock was acquired. Callers go ahead without the lock when it
+    times out, or when the platform has no flock(). The lock file is
+    kept in ``directory``, LOCATION_LOCK_DIR by default.
+    """
+    if fcntl is None:
+        yield False
+        return
+
+    directory = directory or lock_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name + '.lock'), 'a') as f:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    yield False
+                    return
+                time.sleep(poll_interval)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
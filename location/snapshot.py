@@ -0,0 +1,141 @@
+"""
+Binary snapshot of the location dataset shared by worker processes.
+
+The worker that changes the dataset writes the lookup index to the file
+named by LOCATION_SNAPSHOT_PATH, and every other worker loads its index
+from that file instead of querying the database. A new snapshot replaces
+the old file with a rename, so readers see either version in full, and
+workers notice the new file by its inode and modification time.
+
+The file holds a header (magic, SHA-1 dataset version, build time and
+state count) followed by one record per state: state and capital ids,
+the capital's latitude and longitude (NaN when unknown), then the UTF-8
+state name, abbreviation and capital name.
+"""
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+from .models import Capital, State
+from .normalize import normalize_name
+
+MAGIC = b'LOCSNAP2'
+HEADER = struct.Struct('<8s20sdI')
+RECORD = struct.Struct('<IIddHHH')
+
+
+def snapshot_identity(stat):
+    """Return what tells two versions of the snapshot file apart."""
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def current_identity(path):
+    try:
+        return snapshot_identity(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+
+def _coordinate(value):
+    return float('nan') if value is None else value
+
+
+def _decode_coordinate(value):
+    return None if math.isnan(value) else value
+
+
+def encode_snapshot(index):
+    parts = [HEADER.pack(
+        MAGIC, bytes.fromhex(index.version), index.built_at,
+        len(index.states))]
+    for state in index.states:
+        name = state.name.encode('utf-8')
+        abbr = state.abbr.encode('utf-8')
+        capital = state.capital.name.encode('utf-8')
+        parts.append(RECORD.pack(
+            state.id, state.capital.id,
+            _coordinate(state.capital.latitude),
+            _coordinate(state.capital.longitude),
+            len(name), len(abbr), len(capital)))
+        parts.extend((name, abbr, capital))
+    return b''.join(parts)
+
+
+def decode_snapshot(buffer):
+    """Return the version, build time and states stored in a snapshot."""
+    magic, version, built_at, count = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('Not a location snapshot.')
+
+    capitals = {}
+    states = []
+    offset = HEADER.size
+    for i in range(count):
+        state_id, capital_id, latitude, longitude, *lengths = (
+            RECORD.unpack_from(buffer, offset))
+        offset += RECORD.size
+        values = []
+        for length in lengths:
+            values.append(
+                bytes(buffer[offset:offset + length]).decode('utf-8'))
+            offset += length
+        name, abbr, capital_name = values
+
+        capital = capitals.get(capital_id)
+        if capital is None:
+            capital = capitals[capital_id] = Capital(
+                id=capital_id, name=capital_name,
+                name_key=normalize_name(capital_name),
+                latitude=_decode_coordinate(latitude),
+                longitude=_decode_coordinate(longitude))
+        states.append(State(
+            id=state_id, name=name, abbr=abbr, capital=capital,
+            name_key=normalize_name(name)))
+    return version.hex(), built_at, states
+
+
+def read_snapshot(path, index_class):
+    """
+    Load an index from a snapshot file.
+
+    Returns None when there is no snapshot or it cannot be used, in which
+    case the caller builds the index from the database.
+    """
+    try:
+        with open(path, 'rb') as f:
+            identity = snapshot_identity(os.fstat(f.fileno()))
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                version, built_at, states = decode_snapshot(buffer)
+    except (OSError, ValueError, struct.error):
+        return None
+
+    index = index_class(states, built_at=built_at)
+    if index.version != version:
+        return None
+    index.snapshot_id = identity
+    return index
+
+
+def write_snapshot(path, index):
+    """Write an index to a snapshot file, replacing it atomically."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(encode_snapshot(index))
+            f.flush()
+            os.fchmod(f.fileno(), 0o644)
+            # Renaming keeps the inode and modification time.
+            identity = snapshot_identity(os.fstat(f.fileno()))
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    index.snapshot_id = identity
+    return index
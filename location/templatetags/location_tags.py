@@ -0,0 +1,44 @@
+from django import template
+from django.core.cache import cache
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+# Fragments are keyed on the values they show, so they never go stale
+# and are only dropped when the cache culls them.
+FRAGMENT_TIMEOUT = None
+
+
+def fragment_key(state):
+    return 'location:state_row:{}:{}'.format(state.pk, state.row_version)
+
+
+@register.simple_tag
+def state_rows(states):
+    """
+    Render the row of each state, reusing cached fragments.
+
+    All fragments are fetched with one cache lookup, and only the rows of
+    states that are new or changed since they were cached get rendered.
+    """
+    row_template = get_template('location/state_row.html')
+    states = list(states)
+    keys = [
+        fragment_key(state) if hasattr(state, 'row_version') else None
+        for state in states
+    ]
+    fragments = cache.get_many([key for key in keys if key is not None])
+
+    missing = {}
+    rows = []
+    for state, key in zip(states, keys):
+        fragment = fragments.get(key)
+        if fragment is None:
+            fragment = row_template.render({'state': state})
+            if key is not None:
+                missing[key] = fragment
+        rows.append(fragment)
+    if missing:
+        cache.set_many(missing, FRAGMENT_TIMEOUT)
+    return mark_safe(''.join(rows))
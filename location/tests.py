@@ -1,9 +1,67 @@
-from django.db import IntegrityError, transaction
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import mock, skipUnless
+
+import brotli
+import numpy as np
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.models import User
+from django.db import (
+    IntegrityError, connection, connections, router, transaction
+)
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.test import TestCase, Client
-from django.urls import reverse
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import (
+    AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, Client,
+    override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import ResolverMatch, reverse
+
+from capitals.db.backends.sqlite3.base import DatabaseWrapper
+from capitals.db.middleware import (
+    PRIMARY_COOKIE, PrimaryStickinessMiddleware
+)
+from capitals.db.pool import get_pool
+from capitals.db.routers import (
+    ReplicaRouter, begin_routing, end_routing, weighted_cycle
+)
 
+from . import async_views
+from .boot import boot, load_state, migrations_pending
+from .cache import page_cache, stale_pages
+from .compression import choose_encoding, compressed_cache
+from .distances import DistanceMatrix
+from .export import export_chunks
+from .geo import EARTH_RADIUS_KM, NearestIndex
+from .index import (
+    LocationIndex, _snapshot_lock, _touch_stamp, aget_index, get_index,
+    invalidate_index, publish_index
+)
+from .lookups import states_for_capital_query, states_for_state_query
+from .metrics import MmapStore, collect, inc, render_metrics
+from .middleware import CompressionMiddleware, ServerTimingMiddleware
 from .models import State, Capital
+from .normalize import normalize_name, parse_state_query
+from .pagination import encode_cursor
+from .prerender import query_variants, schedule_prerender
+from .querybudget import QueryBudget, QueryBudgetExceeded
+from .singleflight import SingleFlight, file_lock
+from .snapshot import read_snapshot, write_snapshot
+from .views import StateListView
 
 
 class TestModels(TestCase):
@@ -238,6 +296,7 @@ class TestModels(TestCase):
                 'Only alpha characters are allowed.')
 
 
+@override_settings(LOCATION_PAGE_CACHE=False)
 class TestView(TestCase):
     valid_states = [
         'Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California',
@@ -490,3 +549,1905 @@ class TestView(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(
             response.context[0]['states'], {'message': 'Capital not found!'})
+
+
+@override_settings(LOCATION_PAGE_CACHE=False)
+class TestLookupIndex(TestCase):
+    def setUp(self):
+        invalidate_index()
+        # Rolled back rows must not outlive the test in the index.
+        self.addCleanup(invalidate_index)
+
+    def test_index_lookups_do_not_query_once_built(self):
+        """Test that a built index answers lookups without queries."""
+        get_index()
+        with self.assertNumQueries(0):
+            response = self.client.get('/', {'state': 'tx'})
+        self.assertEqual(str(response.context[0]['states'][0]), 'Texas')
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/', {'capital': 'Salt_Lake_City'})
+        self.assertEqual(str(response.context[0]['states'][0]), 'Utah')
+
+    def test_index_is_built_with_a_single_query(self):
+        """Test that building the index costs one query."""
+        with self.assertNumQueries(1):
+            index = get_index()
+        self.assertEqual(len(index.states), 50)
+        self.assertEqual(str(index.by_abbr['NY'][0].capital), 'Albany')
+
+    def test_index_is_rebuilt_when_capital_changes(self):
+        """Test that saving a capital invalidates the index."""
+        version = get_index().version
+        capital = Capital.objects.get(name='Austin')
+        capital.name = 'Austintown'
+        capital.save()
+
+        self.assertNotEqual(get_index().version, version)
+        response = self.client.get('/', {'capital': 'austintown'})
+        self.assertEqual(str(response.context[0]['states'][0]), 'Texas')
+
+    def test_rolled_back_changes_do_not_reach_the_index(self):
+        """Test that only the transaction that changed a row sees it."""
+        index = get_index()
+        with transaction.atomic():
+            capital = Capital.objects.get(name='Austin')
+            capital.name = 'Phantom'
+            capital.save()
+            self.assertIn('phantom', get_index().by_capital)
+            self.assertIsNot(get_index(), get_index())
+            transaction.set_rollback(True)
+
+        self.assertNotIn('phantom', get_index().by_capital)
+        self.assertEqual(get_index().version, index.version)
+        self.assertIs(get_index(), get_index())
+
+    def test_index_follows_changes_committed_by_other_workers(self):
+        """Test that a new stamp file makes the index rebuild."""
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        with override_settings(LOCATION_LOCK_DIR=lock_dir):
+            index = get_index()
+            with self.assertNumQueries(0):
+                self.assertIs(get_index(), index)
+
+            # As done by publish_index() in the worker that saved.
+            _touch_stamp()
+            with self.assertNumQueries(1):
+                self.assertIsNot(get_index(), index)
+
+    def test_index_is_rebuilt_when_state_is_deleted(self):
+        """Test that deleting a state invalidates the index."""
+        get_index()
+        State.objects.get(abbr='WY').delete()
+
+        response = self.client.get('/', {'state': 'WY'})
+        self.assertEqual(
+            response.context[0]['states'], {'message': 'State not found!'})
+        self.assertEqual(len(get_index().states), 49)
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_lookups_fall_back_to_database_when_index_disabled(self):
+        """Test that lookups still work without the index."""
+        response = self.client.get('/', {'state': 'new_york'})
+        self.assertEqual(str(response.context[0]['states'][0]), 'New York')
+
+        response = self.client.get('/', {'capital': 'saint paul'})
+        self.assertEqual(str(response.context[0]['states'][0]), 'Minnesota')
+
+
+class TestPageCache(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+
+    def test_response_has_etag_and_last_modified(self):
+        """Test that state pages carry validators for conditional GETs."""
+        response = self.client.get('/', {'state': 'TX'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('Last-Modified', response)
+        self.assertContains(response, 'Austin')
+
+    def test_equivalent_queries_share_a_cached_page(self):
+        """Test that equivalent queries are served from one cache entry."""
+        first = self.client.get('/', {'state': 'new_york'})
+        with self.assertNumQueries(0):
+            second = self.client.get('/', {'state': 'NEW YORK'})
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertEqual(first.content, second.content)
+        self.assertFalse(second.templates)
+
+    def test_conditional_get_returns_not_modified(self):
+        """Test that a matching If-None-Match is answered with 304."""
+        etag = self.client.get('/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(response.content)
+
+    def test_if_modified_since_returns_not_modified(self):
+        """Test that a current If-Modified-Since is answered with 304."""
+        last_modified = self.client.get('/')['Last-Modified']
+        response = self.client.get(
+            '/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_cached_page_changes_with_dataset(self):
+        """Test that editing a capital retires cached pages."""
+        etag = self.client.get('/', {'state': 'TX'})['ETag']
+        capital = Capital.objects.get(name='Austin')
+        capital.name = 'Austintown'
+        capital.save()
+
+        response = self.client.get(
+            '/', {'state': 'TX'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'Austintown')
+
+
+class TestAPI(TestCase):
+    def setUp(self):
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+
+    def test_state_list_returns_all_states(self):
+        """Test that the state list API returns every state."""
+        response = self.client.get(reverse('api_states'))
+        self.assertEqual(response.status_code, 200)
+        states = response.json()['states']
+        self.assertEqual(len(states), 50)
+        self.assertEqual(
+            states[0],
+            {'id': states[0]['id'], 'name': 'Alabama', 'abbr': 'AL',
+             'capital': 'Montgomery'})
+
+    def test_state_list_applies_lookup_rules(self):
+        """Test that the state list API filters like the states page."""
+        response = self.client.get(
+            reverse('api_states'), {'capital': 'salt_lake_city'})
+        self.assertEqual(
+            [state['name'] for state in response.json()['states']], ['Utah'])
+
+        response = self.client.get(reverse('api_states'), {'state': 'abc'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'error': 'State not found!'})
+
+    def test_fields_parameter_selects_columns(self):
+        """Test that only the requested fields are returned."""
+        response = self.client.get(
+            reverse('api_states'), {'fields': 'abbr,capital'})
+        self.assertEqual(
+            response.json()['states'][0],
+            {'abbr': 'AL', 'capital': 'Montgomery'})
+
+    def test_unknown_field_is_rejected(self):
+        """Test that an unknown field returns a 400 error."""
+        response = self.client.get(
+            reverse('api_states'), {'fields': 'name,population'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json(), {'error': 'Unknown field(s): population'})
+
+    def test_state_detail_by_abbreviation_and_name(self):
+        """Test that a state can be fetched by abbreviation or name."""
+        response = self.client.get(reverse('api_state', args=['sc']))
+        self.assertEqual(response.json()['capital'], 'Columbia')
+
+        response = self.client.get(
+            reverse('api_state', args=['South_Carolina']), {'fields': 'abbr'})
+        self.assertEqual(response.json(), {'abbr': 'SC'})
+
+        response = self.client.get(reverse('api_state', args=['XX']))
+        self.assertEqual(response.status_code, 404)
+
+    def test_capital_detail(self):
+        """Test that a state can be fetched by its capital."""
+        response = self.client.get(
+            reverse('api_capital', args=['jefferson city']))
+        self.assertEqual(response.json()['name'], 'Missouri')
+
+        response = self.client.get(reverse('api_capital', args=['abc']))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'error': 'Capital not found!'})
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_database_path_serializes_with_one_query(self):
+        """Test that the database path reads rows in one query."""
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('api_states'))
+        self.assertEqual(len(response.json()['states']), 50)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('api_state', args=['TX']))
+        self.assertEqual(response.json()['capital'], 'Austin')
+
+
+class TestBatchLookupAPI(TestCase):
+    def setUp(self):
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+
+    def post(self, data, **extra):
+        return self.client.post(
+            reverse('api_lookup'), json.dumps(data),
+            content_type='application/json', **extra)
+
+    def test_batch_resolves_mixed_queries_in_input_order(self):
+        """Test that each query gets a result in input order."""
+        queries = ['tx', 'Salt_Lake_City', 'new york', 'Nowhere', 'XX']
+        response = self.post({'queries': queries})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+
+        self.assertEqual([result['query'] for result in results], queries)
+        self.assertEqual(
+            [result['found'] for result in results],
+            [True, True, True, False, False])
+        self.assertEqual(results[0]['state']['name'], 'Texas')
+        self.assertEqual(results[1]['state']['abbr'], 'UT')
+        self.assertEqual(results[2]['state']['capital'], 'Albany')
+        self.assertNotIn('state', results[3])
+
+    def test_batch_makes_no_queries_with_warm_index(self):
+        """Test that a warm index resolves a batch without queries."""
+        get_index()
+        with self.assertNumQueries(0):
+            response = self.post({'queries': ['AL', 'Juneau'] * 100})
+        self.assertEqual(len(response.json()['results']), 200)
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_batch_makes_one_query_without_index(self):
+        """Test that the database path resolves a batch in one query."""
+        with self.assertNumQueries(1):
+            response = self.post(
+                {'queries': ['AL', 'Juneau', 'rhode_island', 'abc']})
+        self.assertEqual(
+            [result['found'] for result in response.json()['results']],
+            [True, True, True, False])
+
+    def test_batch_supports_field_selection(self):
+        """Test that the fields parameter applies to batch results."""
+        response = self.client.post(
+            reverse('api_lookup') + '?fields=abbr',
+            json.dumps({'queries': ['Boise']}),
+            content_type='application/json')
+        self.assertEqual(
+            response.json()['results'][0]['state'], {'abbr': 'ID'})
+
+    @override_settings(LOCATION_BATCH_LIMIT=2)
+    def test_invalid_batches_are_rejected(self):
+        """Test that malformed and oversized batches return 400."""
+        self.assertEqual(self.post({'queries': 'TX'}).status_code, 400)
+        self.assertEqual(self.post({'queries': [1]}).status_code, 400)
+        self.assertEqual(self.post(['TX']).status_code, 400)
+        self.assertEqual(
+            self.post({'queries': ['TX', 'UT', 'NY']}).status_code, 400)
+
+    def test_batch_does_not_require_csrf_token(self):
+        """Test that service clients can post without a CSRF token."""
+        client = Client(enforce_csrf_checks=True)
+        response = client.post(
+            reverse('api_lookup'), json.dumps({'queries': ['TX']}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(LOCATION_PAGE_CACHE=False)
+class TestQueryBudget(TestCase):
+    def setUp(self):
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+
+    def test_budget_records_queries(self):
+        """Test that a budget records the queries run inside it."""
+        with QueryBudget() as budget:
+            list(State.objects.all())
+        self.assertEqual(len(budget.queries), 1)
+        self.assertIn('location_state', budget.queries[0])
+
+    def test_budget_raises_when_exceeded(self):
+        """Test that running over budget fails like an assertion."""
+        with self.assertRaises(QueryBudgetExceeded):
+            with QueryBudget(1, label='two queries'):
+                State.objects.count()
+                Capital.objects.count()
+
+    def test_budget_warns_when_exceeded_in_warn_mode(self):
+        """Test that warn mode logs instead of raising."""
+        with self.assertLogs('location.querybudget', 'WARNING') as logs:
+            with QueryBudget(0, label='one query', mode='warn'):
+                State.objects.count()
+        self.assertIn('one query ran 1 queries', logs.output[0])
+
+    async def test_budget_records_queries_run_in_a_thread(self):
+        """Test that queries made through sync_to_async are recorded."""
+        with QueryBudget() as budget:
+            await sync_to_async(
+                State.objects.count, thread_sensitive=False)()
+        self.assertEqual(len(budget.queries), 1)
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_state_list_fetches_capitals_in_the_same_query(self):
+        """Test that rendering every state and capital is one query."""
+        with QueryBudget(1):
+            response = self.client.get(reverse('states'))
+        self.assertContains(response, 'Montgomery')
+
+        with QueryBudget(1):
+            response = self.client.get('/', {'capital': 'Boise'})
+        self.assertContains(response, 'Idaho')
+
+    @override_settings(LOCATION_QUERY_BUDGET_MODE='raise')
+    def test_middleware_enforces_view_budget(self):
+        """Test that the middleware checks the budget of the view."""
+        response = self.client.get(reverse('states'))
+        self.assertEqual(response.status_code, 200)
+
+        with self.settings(LOCATION_LOOKUP_INDEX=False):
+            with mock.patch.object(StateListView, 'query_budget', 0):
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(reverse('states'))
+
+
+class TestLookupKeys(TestCase):
+    def test_lookup_keys_are_populated_for_existing_rows(self):
+        """Test that migrated rows carry normalized lookup keys."""
+        state = State.objects.get(abbr='NH')
+        self.assertEqual(state.name_key, 'new hampshire')
+        self.assertEqual(state.capital.name_key, 'concord')
+        self.assertFalse(State.objects.filter(name_key='').exists())
+        self.assertFalse(Capital.objects.filter(name_key='').exists())
+
+    def test_lookup_keys_are_maintained_on_save(self):
+        """Test that saving a row refreshes its lookup key."""
+        new_capital = Capital.objects.create(name='test  city')
+        new_state = State.objects.create(
+            name='test STATE', abbr='TS', capital=new_capital)
+        self.assertEqual(new_capital.name_key, 'test city')
+        self.assertEqual(new_state.name_key, 'test state')
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_capital_resolves_to_state_in_one_query(self):
+        """Test that a capital lookup is a single indexed join."""
+        with self.assertNumQueries(1):
+            states = list(states_for_capital_query('SALT_lake_city'))
+        self.assertEqual([str(state) for state in states], ['Utah'])
+
+        with self.assertNumQueries(1):
+            states = list(states_for_state_query('north   carolina'))
+        self.assertEqual([str(state) for state in states], ['North Carolina'])
+
+    def test_keys_fold_accents_punctuation_and_separators(self):
+        """Test that spellings of a name share one lookup key."""
+        for value in ('new-hampshire', 'New_Hampshire', ' NEW  hampshire'):
+            self.assertEqual(normalize_name(value), 'new hampshire')
+        self.assertEqual(normalize_name("Hawai\u02bbi"), 'hawaii')
+        self.assertEqual(normalize_name('Sa\u0303o Paulo'), 'sao paulo')
+        self.assertEqual(normalize_name('St. Paul'), 'saint paul')
+
+    def test_state_queries_resolve_short_forms(self):
+        """Test that abbreviations and short forms select a state."""
+        self.assertEqual(parse_state_query('ny'), ('abbr', 'NY'))
+        self.assertEqual(parse_state_query('N.Y.'), ('abbr', 'NY'))
+        self.assertEqual(parse_state_query('D.C.'), ('abbr', 'DC'))
+        self.assertEqual(parse_state_query('Wash.'), ('abbr', 'WA'))
+        self.assertEqual(parse_state_query('W. Va.'), ('abbr', 'WV'))
+        self.assertEqual(
+            parse_state_query('Rhode-Island'), ('name', 'rhode island'))
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_odd_spellings_find_states(self):
+        """Test that folded and aliased queries match stored keys."""
+        for query, name in (
+                ('Calif.', 'California'), ('WASH', 'Washington'),
+                ('west-virginia', 'West Virginia'),
+                ('Hawai\u2018i', 'Hawaii')):
+            states = list(states_for_state_query(query))
+            self.assertEqual([str(state) for state in states], [name])
+        states = list(states_for_capital_query('St Paul'))
+        self.assertEqual([str(state) for state in states], ['Minnesota'])
+
+    def test_repeated_queries_are_memoized(self):
+        """Test that a query value is only parsed once."""
+        parse_state_query.cache_clear()
+        parse_state_query('  Calif.  ')
+        parse_state_query('  Calif.  ')
+        info = parse_state_query.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+
+class TestAutocomplete(TestCase):
+    def setUp(self):
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+
+    def suggest(self, query, **params):
+        response = self.client.get(
+            reverse('api_autocomplete'), dict(params, q=query))
+        self.assertEqual(response.status_code, 200)
+        return [result['text'] for result in response.json()['results']]
+
+    def test_prefix_matches_are_ranked(self):
+        """Test that prefix matches are returned shortest first."""
+        self.assertEqual(
+            self.suggest('new', limit=4),
+            ['New York', 'New Jersey', 'New Mexico', 'New Hampshire'])
+
+    def test_exact_abbreviation_is_ranked_first(self):
+        """Test that an exact match leads the suggestions."""
+        self.assertEqual(
+            self.suggest('in'), ['IN', 'Indiana', 'Indianapolis'])
+
+    def test_words_inside_names_are_matched(self):
+        """Test that later words of a name match as prefixes."""
+        self.assertEqual(self.suggest('lake'), ['Salt Lake City'])
+
+    def test_misspellings_are_matched(self):
+        """Test that typos still find a match."""
+        self.assertEqual(self.suggest('misisippi'), ['Mississippi'])
+        self.assertEqual(self.suggest('Sprngfield'), ['Springfield'])
+
+    def test_results_are_capped_at_limit(self):
+        """Test that the number of suggestions respects the limit."""
+        self.assertEqual(len(self.suggest('s', limit=3)), 3)
+        self.assertEqual(self.suggest('', limit=3), [])
+
+    def test_result_includes_state_details(self):
+        """Test that each suggestion carries its state and capital."""
+        response = self.client.get(
+            reverse('api_autocomplete'), {'q': 'salt'})
+        self.assertEqual(
+            response.json()['results'][0],
+            {'text': 'Salt Lake City', 'kind': 'capital', 'name': 'Utah',
+             'abbr': 'UT', 'capital': 'Salt Lake City'})
+
+    def test_suggestions_do_not_query_once_built(self):
+        """Test that keystrokes are answered without queries."""
+        self.suggest('a')
+        with self.assertNumQueries(0):
+            self.suggest('al')
+
+    def test_suggestions_follow_dataset_changes(self):
+        """Test that the suggestion index is rebuilt on changes."""
+        self.suggest('aus')
+        capital = Capital.objects.get(name='Austin')
+        capital.name = 'Austintown'
+        capital.save()
+        self.assertEqual(self.suggest('aus'), ['Austintown'])
+
+
+class TestLoadLocations(TestCase):
+    def setUp(self):
+        self.addCleanup(invalidate_index)
+
+    def write_file(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def load(self, path, *args):
+        out = io.StringIO()
+        call_command('load_locations', path, *args, stdout=out)
+        return out.getvalue()
+
+    def test_load_csv_creates_states_and_capitals(self):
+        """Test that CSV records create new states and capitals."""
+        path = self.write_file(
+            '.csv',
+            'state,abbr,capital\n'
+            'puerto rico,pr,san juan\n'
+            'Guam,GU,Hagatna\n')
+        output = self.load(path)
+
+        self.assertIn('Loaded 2 rows', output)
+        self.assertIn('rows/s', output)
+        state = State.objects.get(abbr='PR')
+        self.assertEqual(state.name, 'Puerto Rico')
+        self.assertEqual(state.name_key, 'puerto rico')
+        self.assertEqual(str(state.capital), 'San Juan')
+        self.assertEqual(state.capital.name_key, 'san juan')
+
+    def test_load_json_upserts_existing_states(self):
+        """Test that JSON records update states by abbreviation."""
+        path = self.write_file('.json', json.dumps([
+            {'state': 'Texas', 'abbr': 'TX', 'capital': 'Houston'},
+            {'state': 'Utah', 'abbr': 'UT', 'capital': 'Salt Lake City'},
+        ]))
+        output = self.load(path, '--batch-size', '1')
+
+        self.assertIn('1 capitals created, 0 states created', output)
+        self.assertIn('1 states updated', output)
+        self.assertEqual(
+            str(State.objects.get(abbr='TX').capital), 'Houston')
+        self.assertEqual(State.objects.count(), 50)
+
+    def test_load_refreshes_prerendered_pages(self):
+        """Test that a bulk load rewrites the pages nginx serves."""
+        page_cache.clear()
+        self.addCleanup(page_cache.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        texas = os.path.join(directory.name, 'pages', 'state', 'TX.html')
+        path = self.write_file('.json', json.dumps([
+            {'state': 'Texas', 'abbr': 'TX', 'capital': 'Houston'},
+        ]))
+        with override_settings(LOCATION_PRERENDER_DIR=directory.name):
+            call_command('prerender_location', stdout=io.StringIO())
+            self.load(path)
+        with open(texas, encoding='utf-8') as f:
+            self.assertIn('Houston', f.read())
+
+    def test_load_ndjson_uses_a_fixed_number_of_queries(self):
+        """Test that a batch costs the same queries whatever its size."""
+        lines = '\n'.join(
+            json.dumps({'state': 'State {}'.format(letter),
+                        'abbr': 'Z' + letter, 'capital': 'City ' + letter})
+            for letter in 'ABCDEFGHIJ')
+        path = self.write_file('.ndjson', lines + '\n')
+        # Fetch capitals, create them, refetch their ids, fetch states,
+        # create states, plus the savepoint around the batch.
+        with self.assertNumQueries(7):
+            self.load(path)
+        self.assertEqual(State.objects.filter(abbr__startswith='Z').count(),
+                         10)
+
+    def test_load_refreshes_lookup_index(self):
+        """Test that loaded rows are visible to index lookups."""
+        get_index()
+        path = self.write_file(
+            '.ndjson', '{"state": "Guam", "abbr": "GU", "capital": "Hagatna"}')
+        self.load(path)
+        self.assertIn('GU', get_index().by_abbr)
+
+    def test_invalid_records_are_reported(self):
+        """Test that a record missing fields stops the load."""
+        path = self.write_file('.csv', 'state,abbr\nGuam,GU\n')
+        with self.assertRaisesMessage(CommandError, 'Row 1 needs'):
+            self.load(path)
+
+        path = self.write_file('.txt', '')
+        with self.assertRaisesMessage(CommandError, 'Cannot tell the format'):
+            self.load(path)
+
+
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+        self.factory = AsyncRequestFactory()
+
+    async def test_state_page_is_served_from_memory(self):
+        """Test that a warm index serves the page on the event loop."""
+        await aget_index()
+        request = self.factory.get('/', {'state': 'tx'})
+        # The ORM refuses to run on the event loop, so this also checks
+        # that no query is made.
+        response = await async_views.state_list(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Austin', response.content)
+
+    async def test_cold_index_is_built_off_the_event_loop(self):
+        """Test that the first request builds the index in a thread."""
+        request = self.factory.get('/', {'capital': 'Salt_Lake_City'})
+        response = await async_views.state_list(request)
+        self.assertIn(b'Utah', response.content)
+
+    async def test_json_api_is_served_from_memory(self):
+        """Test that the JSON API works from the event loop."""
+        request = self.factory.get('/api/states/', {'fields': 'abbr'})
+        response = await async_views.state_list_api(request)
+        self.assertEqual(len(json.loads(response.content)['states']), 50)
+
+        request = self.factory.get('/api/capitals/boise/')
+        response = await async_views.capital_detail_api(request, name='boise')
+        self.assertEqual(json.loads(response.content)['abbr'], 'ID')
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    async def test_database_path_runs_in_a_thread(self):
+        """Test that views without the index still work under ASGI."""
+        request = self.factory.get('/api/states/ny/')
+        response = await async_views.state_detail_api(request, abbr='ny')
+        self.assertEqual(json.loads(response.content)['capital'], 'Albany')
+
+
+class TestBenchLocation(TestCase):
+    def setUp(self):
+        get_index()
+        self.addCleanup(invalidate_index)
+
+    def test_bench_reports_results_as_json(self):
+        """Test that the benchmark reports each handler and scenario."""
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+
+        out = io.StringIO()
+        call_command(
+            'bench_location', '--requests', '20', '--concurrency', '2',
+            '--profile-requests', '2', '--host', 'testserver',
+            '--json', path, stdout=out)
+        with open(path) as f:
+            results = json.load(f)
+
+        self.assertIn('WSGI:', out.getvalue())
+        self.assertEqual(set(results['servers']), {'wsgi', 'asgi'})
+        overall = results['servers']['wsgi']['all']
+        self.assertEqual(overall['requests'], 20)
+        self.assertGreater(overall['rps'], 0)
+        self.assertLessEqual(overall['p50_ms'], overall['p99_ms'])
+        state = results['servers']['asgi']['state']
+        self.assertEqual(state['queries_per_request'], 0)
+        self.assertGreater(state['bytes_per_request'], 0)
+
+        out = io.StringIO()
+        call_command(
+            'bench_location', '--requests', '10', '--server', 'wsgi',
+            '--profile-requests', '0', '--host', 'testserver',
+            '--baseline', path, stdout=out)
+        self.assertIn('Change from baseline:', out.getvalue())
+
+    def test_invalid_mix_is_rejected(self):
+        """Test that unknown scenarios in the mix are reported."""
+        with self.assertRaisesMessage(CommandError, '--mix expects'):
+            call_command('bench_location', '--mix', 'list=1,detail=2')
+
+
+class TestServerTiming(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+
+    def parse(self, response):
+        metrics = {}
+        for metric in response['Server-Timing'].split(', '):
+            name, *params = metric.split(';')
+            metrics[name] = dict(param.split('=', 1) for param in params)
+        return metrics
+
+    def test_page_reports_timing_breakdown(self):
+        """Test that the header breaks down db, template and cache time."""
+        with self.assertLogs('location.timing', 'INFO') as logs:
+            response = self.client.get('/', {'state': 'TX'})
+        metrics = self.parse(response)
+        self.assertEqual(metrics['cache']['desc'], '"miss"')
+        self.assertIn('queries"', metrics['db']['desc'])
+        self.assertGreater(float(metrics['tpl']['dur']), 0)
+        self.assertGreaterEqual(
+            float(metrics['total']['dur']), float(metrics['tpl']['dur']))
+        self.assertIn('method=GET path=/ status=200', logs.output[0])
+        self.assertIn('cache=miss', logs.output[0])
+
+        metrics = self.parse(self.client.get('/', {'state': 'TX'}))
+        self.assertEqual(metrics['cache']['desc'], '"hit"')
+        self.assertEqual(metrics['db']['desc'], '"0 queries"')
+        self.assertNotIn('tpl', metrics)
+
+    @override_settings(LOCATION_PAGE_CACHE=False)
+    def test_template_response_is_timed(self):
+        """Test that uncached template renders are timed."""
+        metrics = self.parse(self.client.get('/'))
+        self.assertIn('tpl', metrics)
+        self.assertNotIn('cache', metrics)
+
+    def test_api_reports_database_time(self):
+        """Test that JSON responses carry db and total timings."""
+        metrics = self.parse(self.client.get('/api/states/tx/'))
+        self.assertEqual(set(metrics), {'db', 'total'})
+
+    async def test_async_requests_report_database_time(self):
+        """Test that queries of async requests are counted."""
+        async def view(request):
+            await sync_to_async(
+                State.objects.count, thread_sensitive=False)()
+            return HttpResponse()
+
+        middleware = ServerTimingMiddleware(view)
+        response = await middleware(AsyncRequestFactory().get('/'))
+        self.assertEqual(self.parse(response)['db']['desc'], '"1 queries"')
+
+    @override_settings(LOCATION_SERVER_TIMING=False)
+    def test_timing_can_be_disabled(self):
+        """Test that the header is left out when timing is off."""
+        self.assertNotIn('Server-Timing', self.client.get('/'))
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(LOCATION_METRICS_DIR=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_store_survives_reopening_and_growth(self):
+        """Test that a store keeps its values across growth and reopen."""
+        path = os.path.join(self.directory, 'worker-1.db')
+        store = MmapStore(path)
+        store.initial_size = 64
+        for i in range(500):
+            store.add('key-{}'.format(i), i)
+        store.add('key-1', 0.5)
+        store.close()
+
+        store = MmapStore(path)
+        self.addCleanup(store.close)
+        values = dict(store.items())
+        self.assertEqual(len(values), 500)
+        self.assertEqual(values['key-1'], 1.5)
+        self.assertEqual(values['key-499'], 499)
+
+    def test_values_are_summed_across_processes(self):
+        """Test that the files of other workers are included in totals."""
+        other = MmapStore(os.path.join(self.directory, 'worker-0.db'))
+        self.addCleanup(other.close)
+        other.add(json.dumps([
+            'location_db_queries_total', 'location_db_queries_total',
+            [['view', 'states']]]), 3)
+        inc('location_db_queries_total', {'view': 'states'}, 2)
+
+        self.assertEqual(list(collect().values()), [5.0])
+        self.assertIn(
+            'location_db_queries_total{view="states"} 5.0',
+            render_metrics())
+
+    def test_unknown_methods_share_one_series(self):
+        """Test that arbitrary request methods are counted as other."""
+        self.client.generic('BREW', '/')
+        self.client.generic('PROPFIND', '/')
+        self.client.post('/')
+
+        text = render_metrics()
+        self.assertIn('method="other"', text)
+        self.assertIn('method="POST"', text)
+        self.assertNotIn('BREW', text)
+        self.assertNotIn('PROPFIND', text)
+
+    def test_metrics_endpoint_reports_requests(self):
+        """Test that /metrics breaks requests down by view and lookup."""
+        self.client.get('/', {'state': 'TX'})
+        self.client.get('/', {'state': 'TX'})
+        self.client.get('/', {'capital': 'Nowhere'})
+        self.client.get('/api/states/texas/')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn(
+            'location_requests_total{lookup="abbr",method="GET",'
+            'status="200",view="states"} 2.0', text)
+        self.assertIn(
+            'location_requests_total{lookup="not_found",method="GET",'
+            'status="200",view="states"} 1.0', text)
+        self.assertIn(
+            'location_requests_total{lookup="name",method="GET",'
+            'status="200",view="api_state"} 1.0', text)
+        self.assertIn(
+            'location_request_duration_seconds_count'
+            '{lookup="abbr",view="states"} 2.0', text)
+        self.assertIn(
+            'location_request_duration_seconds_bucket'
+            '{lookup="abbr",view="states",le="+Inf"} 2.0', text)
+        self.assertIn(
+            'location_page_cache_requests_total{result="hit"} 1.0', text)
+        self.assertIn('location_page_cache_hit_ratio 0.333', text)
+        self.assertIn('location_db_queries_total{view="states"}', text)
+
+
+class TestPrerender(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.pages = os.path.join(self.directory, 'pages')
+
+    def read(self, name):
+        with open(os.path.join(self.pages, name), 'rb') as f:
+            return f.read()
+
+    def test_query_variants(self):
+        """Test that the spellings browsers send are all covered."""
+        self.assertEqual(query_variants('Salt Lake City'), {
+            'Salt%20Lake%20City', 'Salt+Lake+City', 'Salt_Lake_City',
+            'salt%20lake%20city', 'salt+lake+city', 'salt_lake_city',
+        })
+        self.assertEqual(query_variants('TX'), {'TX', 'tx'})
+
+    def test_command_writes_every_variant(self):
+        """Test that the pages match what Django serves for each query."""
+        out = io.StringIO()
+        call_command(
+            'prerender_location', '--output', self.directory, stdout=out)
+        self.assertIn('Pre-rendered', out.getvalue())
+
+        self.assertEqual(
+            self.read('index.html'), self.client.get('/').content)
+        texas = self.client.get('/', {'state': 'TX'}).content
+        for name in ('state/TX.html', 'state/tx.html', 'state/Texas.html',
+                     'capital/Austin.html', 'capital/austin.html'):
+            self.assertEqual(self.read(name), texas)
+        self.assertEqual(
+            gzip.decompress(self.read('state/new_york.html.gz')),
+            self.read('state/New%20York.html'))
+
+    def test_pages_of_removed_states_are_dropped(self):
+        """Test that a new run replaces the previous pages."""
+        call_command(
+            'prerender_location', '--output', self.directory,
+            stdout=io.StringIO())
+        State.objects.get(abbr='TX').delete()
+        call_command(
+            'prerender_location', '--output', self.directory,
+            stdout=io.StringIO())
+        self.assertFalse(
+            os.path.exists(os.path.join(self.pages, 'state', 'TX.html')))
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), ['.prerender.lock', 'pages'])
+
+    def test_failed_swap_keeps_the_served_pages(self):
+        """Test that the previous pages survive a failed swap."""
+        call_command(
+            'prerender_location', '--output', self.directory,
+            stdout=io.StringIO())
+        texas = self.read('state/TX.html')
+        rename = os.rename
+
+        def fail_into_pages(source, target):
+            if target == self.pages and '.pages-' in source:
+                raise OSError('ENOTEMPTY')
+            return rename(source, target)
+
+        with mock.patch('location.prerender.os.rename', fail_into_pages):
+            with self.assertRaises(OSError):
+                call_command(
+                    'prerender_location', '--output', self.directory,
+                    stdout=io.StringIO())
+        self.assertEqual(self.read('state/TX.html'), texas)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), ['.prerender.lock', 'pages'])
+
+    def test_missing_output_directory_is_reported(self):
+        """Test that the command needs somewhere to write."""
+        with self.assertRaisesMessage(CommandError, 'LOCATION_PRERENDER_DIR'):
+            call_command('prerender_location', stdout=io.StringIO())
+
+    def test_saving_a_state_schedules_a_prerender(self):
+        """Test that committed changes refresh the pages."""
+        with override_settings(LOCATION_PRERENDER_DIR=self.directory), \
+                mock.patch('location.signals.schedule_prerender') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                state = State.objects.get(abbr='TX')
+                state.name = 'Tejas'
+                state.save()
+        schedule.assert_called_once_with()
+
+    def test_prerender_runs_in_the_background(self):
+        """Test that scheduled runs write to LOCATION_PRERENDER_DIR."""
+        with override_settings(LOCATION_PRERENDER_DIR=self.directory), \
+                mock.patch('location.prerender.prerender') as prerender:
+            schedule_prerender().join()
+        prerender.assert_called_once_with(self.directory)
+
+
+@override_settings(LOCATION_PAGE_CACHE=False)
+class TestFragmentCache(TestCase):
+    def setUp(self):
+        invalidate_index()
+        cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(cache.clear)
+
+    def test_rows_are_rendered_from_cached_fragments(self):
+        """Test that a second list render reuses every state's row."""
+        first = self.client.get('/')
+        second = self.client.get('/')
+        self.assertEqual(first.content, second.content)
+        rows = [
+            template for template in second.templates
+            if template.name == 'location/state_row.html'
+        ]
+        self.assertEqual(rows, [])
+
+    def test_editing_a_state_renders_only_its_row(self):
+        """Test that a changed state gets a new fragment."""
+        self.client.get('/')
+        state = State.objects.get(abbr='TX')
+        state.name = 'Tejas'
+        state.save()
+
+        response = self.client.get('/')
+        rows = [
+            template for template in response.templates
+            if template.name == 'location/state_row.html'
+        ]
+        self.assertEqual(len(rows), 1)
+        self.assertContains(response, '<h3>Tejas</h3>', html=True)
+        self.assertNotContains(response, 'Texas')
+
+
+class TestCompression(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        compressed_cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+        self.addCleanup(compressed_cache.clear)
+
+    def test_choose_encoding(self):
+        """Test that Accept-Encoding is negotiated with quality values."""
+        self.assertEqual(choose_encoding('gzip, deflate, br'), 'br')
+        self.assertEqual(choose_encoding('gzip;q=0.5, br;q=0'), 'gzip')
+        self.assertEqual(choose_encoding('*'), 'br')
+        self.assertEqual(choose_encoding('br;q=0.5, gzip'), 'gzip')
+        self.assertEqual(choose_encoding('gzip, *;q=0.1'), 'gzip')
+        self.assertEqual(choose_encoding('br;q=0, *'), 'gzip')
+        self.assertIsNone(choose_encoding('identity'))
+        self.assertIsNone(choose_encoding(''))
+
+    def test_page_is_served_compressed(self):
+        """Test that pages are compressed for clients that accept it."""
+        plain = self.client.get('/')
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(response['ETag'], 'W/' + plain['ETag'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertNotIn('Content-Encoding', plain)
+
+        response = self.client.get('/', HTTP_ACCEPT_ENCODING='br, gzip')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), plain.content)
+
+    def test_bodies_are_compressed_once(self):
+        """Test that repeated pages are served from the compressed cache."""
+        encoder = mock.Mock(return_value=b'compressed')
+        with mock.patch.dict(
+                'location.compression.ENCODERS', {'gzip': encoder}):
+            for i in range(3):
+                response = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(encoder.call_count, 1)
+        self.assertEqual(encoder.call_args.kwargs, {})
+        self.assertEqual(response.content, b'compressed')
+        self.assertEqual(response['Content-Length'], '10')
+
+    def test_one_off_bodies_are_compressed_fast_and_not_kept(self):
+        """Test that POST answers skip the slow level and the cache."""
+        queries = [state.abbr for state in State.objects.all()]
+        encoder = mock.Mock(return_value=b'compressed')
+        with mock.patch.dict(
+                'location.compression.ENCODERS', {'gzip': encoder}):
+            for i in range(2):
+                response = self.client.post(
+                    reverse('api_lookup'), json.dumps({'queries': queries}),
+                    content_type='application/json',
+                    HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(encoder.call_count, 2)
+        self.assertEqual(encoder.call_args.kwargs, {'fast': True})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(compressed_cache), 0)
+
+    async def test_async_responses_are_compressed_in_a_thread(self):
+        """Test that the event loop does not run the encoder."""
+        loop_thread = threading.get_ident()
+        threads = []
+
+        def encoder(content, fast=False):
+            threads.append(threading.get_ident())
+            return b'compressed'
+
+        async def view(request):
+            return HttpResponse(b'x' * 1000)
+        view.compressible = True
+
+        middleware = CompressionMiddleware(view)
+        request = AsyncRequestFactory().post('/')
+        request.resolver_match = ResolverMatch(view, (), {})
+        request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        with mock.patch.dict(
+                'location.compression.ENCODERS', {'gzip': encoder}):
+            response = await middleware(request)
+        self.assertEqual(response.content, b'compressed')
+        self.assertNotEqual(threads, [loop_thread])
+
+    def test_only_location_views_are_compressed(self):
+        """Test that pages with a CSRF token are left alone."""
+        response = self.client.get(
+            '/admin/login/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_weak_etag_still_matches(self):
+        """Test that conditional GETs work with the compressed ETag."""
+        etag = self.client.get('/', HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        response = self.client.get(
+            '/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_small_and_error_responses_are_left_alone(self):
+        """Test that only worthwhile responses are compressed."""
+        response = self.client.get(
+            '/api/states/tx/', {'fields': 'abbr'},
+            HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+        response = self.client.get(
+            '/api/states/nowhere/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.pool = get_pool('pool_test', 1)
+        self.addCleanup(self.pool.clear)
+        patcher = mock.patch('capitals.db.pool.record')
+        self.record = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_wrapper(self):
+        settings_dict = dict(
+            connection.settings_dict, NAME=self.path, POOL_SIZE=1,
+            POOL_HEALTH_CHECKS=True)
+        wrapper = DatabaseWrapper(settings_dict, alias='pool_test')
+        self.addCleanup(wrapper.discard)
+        return wrapper
+
+    def events(self):
+        return [event for alias, event in (
+            recorded.args for recorded in self.record.call_args_list)]
+
+    def test_closed_connections_are_reused(self):
+        """Test that a closed connection is handed to the next wrapper."""
+        first = self.make_wrapper()
+        first.ensure_connection()
+        raw = first.connection
+        first.close()
+        self.assertEqual(len(self.pool), 1)
+
+        second = self.make_wrapper()
+        second.ensure_connection()
+        self.assertIs(second.connection, raw)
+        self.assertEqual(self.events(), ['opened', 'reused'])
+
+    def test_pool_is_bounded(self):
+        """Test that connections beyond the pool size are closed."""
+        wrappers = [self.make_wrapper(), self.make_wrapper()]
+        for wrapper in wrappers:
+            wrapper.ensure_connection()
+        for wrapper in wrappers:
+            wrapper.close()
+        self.assertEqual(len(self.pool), 1)
+
+    def test_connection_in_a_transaction_is_not_pooled(self):
+        """Test that only connections in a clean state are reused."""
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        wrapper.set_autocommit(False)
+        wrapper.close()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_broken_connection_is_replaced(self):
+        """Test that the health check reconnects before the first query."""
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        raw = wrapper.connection
+        # A new request starts.
+        wrapper.close_if_unusable_or_obsolete()
+        with mock.patch.object(wrapper, 'ping', return_value=False):
+            with wrapper.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        self.assertIsNot(wrapper.connection, raw)
+        self.assertEqual(self.events(), ['opened', 'failed', 'opened'])
+
+    def test_health_is_checked_once_per_request(self):
+        """Test that later queries in a request skip the check."""
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        wrapper.close_if_unusable_or_obsolete()
+        with mock.patch.object(
+                wrapper, 'ping', wraps=wrapper.ping) as ping:
+            for i in range(3):
+                with wrapper.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+        self.assertEqual(ping.call_count, 1)
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'snapshot.bin')
+        settings = override_settings(LOCATION_SNAPSHOT_PATH=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(invalidate_index)
+        publish_index()
+
+    def test_snapshot_round_trip(self):
+        """Test that a snapshot restores the same dataset."""
+        index = LocationIndex.build()
+        loaded = read_snapshot(self.path, LocationIndex)
+        self.assertEqual(loaded.version, index.version)
+        self.assertEqual(
+            [(state.id, state.name, state.abbr, state.capital.name,
+              state.capital.latitude, state.capital.longitude)
+             for state in loaded.states],
+            [(state.id, state.name, state.abbr, state.capital.name,
+              state.capital.latitude, state.capital.longitude)
+             for state in index.states])
+        self.assertIn('salt lake city', loaded.by_capital)
+
+    def test_workers_publish_one_at_a_time(self):
+        """Test that the snapshot is built under the cross-worker lock."""
+        build = LocationIndex.build
+        held = []
+
+        def build_under_lock():
+            with _snapshot_lock(self.path, timeout=0) as acquired:
+                held.append(not acquired)
+            return build()
+
+        with mock.patch.object(LocationIndex, 'build', build_under_lock):
+            publish_index()
+        self.assertEqual(held, [True])
+
+    def test_new_worker_loads_without_queries(self):
+        """Test that a worker without an index reads the snapshot."""
+        invalidate_index()
+        with self.assertNumQueries(0):
+            response = self.client.get('/', {'state': 'ut'})
+        self.assertContains(response, 'Salt Lake City')
+
+    def test_swapped_snapshot_is_picked_up(self):
+        """Test that workers follow snapshots written by another worker."""
+        version = get_index().version
+        Capital.objects.filter(name='Austin').update(name='Austintown')
+        # Another worker publishes the change.
+        write_snapshot(self.path, LocationIndex.build())
+
+        with self.assertNumQueries(0):
+            index = get_index()
+        self.assertNotEqual(index.version, version)
+        self.assertEqual(index.by_abbr['TX'][0].capital.name, 'Austintown')
+
+    def test_committed_changes_are_published(self):
+        """Test that saving a state writes a new snapshot on commit."""
+        with self.captureOnCommitCallbacks(execute=True):
+            state = State.objects.get(abbr='TX')
+            state.name = 'Tejas'
+            state.save()
+            # Until the commit, this worker reads its own changes.
+            self.assertIn('tejas', get_index().by_name)
+            self.assertNotIn(
+                'tejas', read_snapshot(self.path, LocationIndex).by_name)
+        self.assertIn(
+            'tejas', read_snapshot(self.path, LocationIndex).by_name)
+
+    def test_unreadable_snapshot_is_rebuilt(self):
+        """Test that a damaged snapshot is replaced from the database."""
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+        invalidate_index()
+        self.assertEqual(len(get_index().states), 50)
+        self.assertIsNotNone(read_snapshot(self.path, LocationIndex))
+
+
+class TestPagination(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+
+    def walk(self, page_size):
+        """Follow next cursors through the API, then previous ones back."""
+        pages = []
+        params = {'page_size': page_size}
+        while True:
+            data = json.loads(
+                self.client.get('/api/states/', params).content)
+            pages.append([row['abbr'] for row in data['states']])
+            if not data['next_cursor']:
+                break
+            params = {'page_size': page_size, 'cursor': data['next_cursor']}
+        backwards = [pages[-1]]
+        while data['previous_cursor']:
+            params = {
+                'page_size': page_size, 'cursor': data['previous_cursor']}
+            data = json.loads(
+                self.client.get('/api/states/', params).content)
+            backwards.append([row['abbr'] for row in data['states']])
+        return pages, backwards[::-1]
+
+    def check_walk(self):
+        expected = [state.abbr for state in State.objects.order_by('name')]
+        pages, backwards = self.walk(7)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual([len(page) for page in pages], [7] * 7 + [1])
+        self.assertEqual(backwards, pages)
+
+    def test_pages_from_the_index(self):
+        """Test that cursors walk the whole list in both directions."""
+        self.check_walk()
+
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_pages_from_the_database(self):
+        """Test that the database path seeks instead of using OFFSET."""
+        self.check_walk()
+        data = json.loads(self.client.get(
+            '/api/states/', {'page_size': 10}).content)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/states/', {
+                'page_size': 10, 'cursor': data['next_cursor']})
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql'].upper()
+        self.assertNotIn('OFFSET', sql)
+        self.assertIn('LIMIT 11', sql)
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite query plans')
+    @override_settings(LOCATION_LOOKUP_INDEX=False)
+    def test_deep_pages_seek_the_name_index(self):
+        """Test that a cursor is a range search, not an index scan."""
+        data = json.loads(self.client.get(
+            '/api/states/', {'page_size': 10}).content)
+        for cursor in (data['next_cursor'], encode_cursor(('M',), True)):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(
+                    '/api/states/', {'page_size': 10, 'cursor': cursor})
+            with connection.cursor() as db:
+                db.execute('EXPLAIN QUERY PLAN ' + queries[0]['sql'])
+                plan = [row[-1] for row in db.fetchall()]
+            self.assertIn('(name', plan[0])
+            self.assertTrue(plan[0].startswith('SEARCH'), plan)
+            self.assertFalse(
+                any(step.startswith('SCAN') for step in plan), plan)
+
+    def test_unpaginated_list_is_unchanged(self):
+        """Test that pagination is opt-in."""
+        data = json.loads(self.client.get('/api/states/').content)
+        self.assertEqual(len(data['states']), 50)
+        self.assertNotIn('next_cursor', data)
+
+    def test_invalid_parameters_are_rejected(self):
+        """Test that bad cursors and page sizes are reported with 400."""
+        for params in ({'cursor': 'nonsense'}, {'page_size': 'ten'},
+                       {'page_size': 0}, {'page_size': 100000},
+                       {'cursor': 'W1sxLCJhIl0sZmFsc2Vd'}):
+            response = self.client.get('/api/states/', params)
+            self.assertEqual(response.status_code, 400, params)
+            response = self.client.get('/', params)
+            self.assertEqual(response.status_code, 400, params)
+
+    @override_settings(LOCATION_PAGE_CACHE=False)
+    def test_page_links(self):
+        """Test that the HTML list links to the next and previous pages."""
+        response = self.client.get('/', {'page_size': 20})
+        self.assertEqual(len(response.context['states']), 20)
+        self.assertIsNone(response.context['previous_cursor'])
+        self.assertContains(response, '>Next</a>')
+
+        response = self.client.get('/', {
+            'page_size': 20, 'cursor': response.context['next_cursor']})
+        self.assertEqual(response.context['states'][0].abbr, 'MA')
+        self.assertContains(response, '>Previous</a>')
+
+
+class TestNearest(TestCase):
+    def setUp(self):
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+
+    def nearest(self, lat, lon, **params):
+        response = self.client.get(
+            reverse('api_nearest'), dict(params, lat=lat, lon=lon))
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def post(self, data):
+        return self.client.post(
+            reverse('api_nearest_batch'), json.dumps(data),
+            content_type='application/json')
+
+    def test_nearest_capitals_are_returned_closest_first(self):
+        """Test that the k nearest capitals come back by distance."""
+        results = self.nearest(30.27, -97.74, k=3)
+        self.assertEqual(
+            [result['state']['capital'] for result in results],
+            ['Austin', 'Oklahoma City', 'Baton Rouge'])
+        self.assertLess(results[0]['distance_km'], 1)
+        self.assertAlmostEqual(results[1]['distance_km'], 578.3, places=0)
+        self.assertEqual(
+            (results[0]['latitude'], results[0]['longitude']),
+            (30.2672, -97.7431))
+
+    def test_search_matches_a_full_scan(self):
+        """Test that the KD-tree agrees with measuring every capital."""
+        def haversine(lat1, lon1, lat2, lon2):
+            lat1, lon1, lat2, lon2 = map(
+                math.radians, (lat1, lon1, lat2, lon2))
+            h = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1)
+                 * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+            return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+        states = get_index().states
+        tree = NearestIndex(states)
+        for lat in range(-80, 90, 20):
+            for lon in range(-180, 180, 30):
+                expected = sorted(states, key=lambda state: haversine(
+                    lat, lon, state.capital.latitude,
+                    state.capital.longitude))[:5]
+                self.assertEqual(
+                    [neighbor.state for neighbor in tree.nearest(
+                        lat, lon, 5)],
+                    expected)
+
+    def test_capitals_without_coordinates_are_skipped(self):
+        """Test that capitals with unknown positions are never returned."""
+        Capital.objects.filter(name='Austin').update(
+            latitude=None, longitude=None)
+        invalidate_index()
+        results = self.nearest(30.27, -97.74)
+        self.assertEqual(results[0]['state']['capital'], 'Oklahoma City')
+
+    def test_nearest_supports_field_selection(self):
+        """Test that the fields parameter applies to nearest results."""
+        results = self.nearest(43.6, -116.2, fields='abbr')
+        self.assertEqual(results[0]['state'], {'abbr': 'ID'})
+
+    def test_invalid_points_are_rejected(self):
+        """Test that bad coordinates and k values return 400."""
+        url = reverse('api_nearest')
+        for params in ({'lat': 'north', 'lon': 0}, {'lat': 91, 'lon': 0},
+                       {'lat': 0, 'lon': -181}, {'lat': 0},
+                       {'lat': 0, 'lon': 0, 'k': 0},
+                       {'lat': 0, 'lon': 0, 'k': 'all'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+
+    def test_batch_answers_in_input_order_without_queries(self):
+        """Test that a warm index answers a batch without queries."""
+        get_index()
+        with self.assertNumQueries(0):
+            response = self.post(
+                {'points': [[47.6, -122.3], [21.3, -157.8]] * 50, 'k': 2})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(len(results), 100)
+        self.assertEqual(results[1]['point'], [21.3, -157.8])
+        self.assertEqual(
+            [result['state']['abbr'] for result in results[0]['results']],
+            ['WA', 'OR'])
+        self.assertEqual(
+            results[1]['results'][0]['state']['capital'], 'Honolulu')
+
+    @override_settings(LOCATION_NEAREST_BATCH_LIMIT=2)
+    def test_invalid_batches_are_rejected(self):
+        """Test that malformed and oversized batches return 400."""
+        self.assertEqual(self.post({'points': [1, 2]}).status_code, 400)
+        self.assertEqual(self.post({'points': [[1, 2, 3]]}).status_code, 400)
+        self.assertEqual(self.post({'points': [[95, 0]]}).status_code, 400)
+        self.assertEqual(self.post([[1, 2]]).status_code, 400)
+        self.assertEqual(
+            self.post({'points': [[0, 0]] * 3}).status_code, 400)
+
+
+class TestDistanceMatrix(TestCase):
+    def setUp(self):
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+
+    def distances(self, **params):
+        response = self.client.get(reverse('api_distances'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pairwise_distance(self):
+        """Test that a pair of capitals gets its great-circle distance."""
+        data = self.distances(**{'from': 'UT', 'to': 'Boise'})
+        self.assertEqual(data['from'], ['UT'])
+        self.assertEqual(data['to'], ['ID'])
+        self.assertAlmostEqual(data['distances_km'][0][0], 476.2, places=0)
+
+    def test_one_to_many_defaults_to_every_capital(self):
+        """Test that leaving out to measures against every capital."""
+        data = self.distances(**{'from': 'texas'})
+        self.assertEqual(len(data['to']), 50)
+        distances = dict(zip(data['to'], data['distances_km'][0]))
+        self.assertEqual(distances['TX'], 0)
+        self.assertEqual(min(
+            distances, key=lambda abbr: distances[abbr] or float('inf')),
+            'OK')
+
+    def test_matrix_is_symmetric_and_matches_nearest(self):
+        """Test that the matrix agrees with the nearest-capital search."""
+        matrix = DistanceMatrix(get_index().states).matrix
+        self.assertEqual(matrix.shape, (50, 50))
+        np.testing.assert_allclose(matrix, matrix.T)
+        np.testing.assert_array_equal(matrix.diagonal(), 0)
+        nearest = self.client.get(
+            reverse('api_nearest'), {'lat': 30.2672, 'lon': -97.7431, 'k': 2})
+        self.assertAlmostEqual(
+            self.distances(**{'from': 'TX', 'to': 'OK'})['distances_km'][0][0],
+            nearest.json()['results'][1]['distance_km'], places=2)
+
+    def test_npy_format_serves_the_whole_matrix(self):
+        """Test that format=npy returns the matrix as a NumPy array."""
+        response = self.client.get(reverse('api_distances'), {'format': 'npy'})
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        matrix = np.load(io.BytesIO(response.content), allow_pickle=False)
+        self.assertEqual(matrix.shape, (50, 50))
+        rows = response['X-Distance-Rows'].split(',')
+        self.assertEqual(rows, response['X-Distance-Columns'].split(','))
+        self.assertAlmostEqual(
+            matrix[rows.index('UT'), rows.index('ID')], 476.2, places=0)
+
+    def test_matrix_is_not_recomputed(self):
+        """Test that queries are answered from the cached matrix."""
+        self.distances()
+        with mock.patch('location.distances.haversine_matrix') as compute:
+            with self.assertNumQueries(0):
+                self.distances(**{'from': 'NY', 'to': 'NJ'})
+        compute.assert_not_called()
+
+    def test_matrix_follows_dataset_changes(self):
+        """Test that moving a capital gives a new matrix."""
+        before = self.distances(**{'from': 'UT', 'to': 'ID'})
+        capital = Capital.objects.get(name='Boise')
+        capital.latitude = 40.7608
+        capital.longitude = -111.8910
+        capital.save()
+        after = self.distances(**{'from': 'UT', 'to': 'ID'})
+        self.assertNotEqual(before, after)
+        self.assertEqual(after['distances_km'], [[0]])
+
+    def test_conditional_requests_get_304(self):
+        """Test that an unchanged matrix is answered with 304."""
+        response = self.client.get(reverse('api_distances'))
+        response = self.client.get(
+            reverse('api_distances'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalid_requests_are_rejected(self):
+        """Test that unknown capitals and formats are rejected."""
+        url = reverse('api_distances')
+        self.assertEqual(
+            self.client.get(url, {'from': 'XX'}).status_code, 404)
+        self.assertEqual(
+            self.client.get(url, {'format': 'csv'}).status_code, 400)
+
+    def test_command_writes_npy_file(self):
+        """Test that the command writes the matrix as an .npy file."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'distances.npy')
+            call_command('distance_matrix', output=path, stdout=io.StringIO())
+            self.assertEqual(np.load(path).shape, (50, 50))
+
+        out = io.StringIO()
+        call_command(
+            'distance_matrix', sources='UT', targets='ID,NV', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['to'], ['ID', 'NV'])
+        with self.assertRaises(CommandError):
+            call_command('distance_matrix', sources='Nowhere')
+
+
+@override_settings(LOCATION_READ_REPLICAS={'replica1': 2, 'replica2': 1})
+class TestReplicaRouter(SimpleTestCase):
+    def setUp(self):
+        token = begin_routing()
+        self.addCleanup(end_routing, token)
+
+    def serve(self, request, write=False):
+        """Run a request through the middleware, noting its read alias."""
+        def view(request):
+            if write:
+                router.db_for_write(State)
+            self.read_from = router.db_for_read(State)
+            return HttpResponse()
+        return PrimaryStickinessMiddleware(view)(request)
+
+    def test_reads_are_spread_by_weight(self):
+        """Test that replicas are picked in proportion to their weight."""
+        reads = [router.db_for_read(State) for i in range(300)]
+        self.assertEqual(
+            Counter(reads), {'replica1': 200, 'replica2': 100})
+        self.assertEqual(
+            list(zip(range(3), weighted_cycle({'a': 2, 'b': 1}))),
+            [(0, 'a'), (1, 'b'), (2, 'a')])
+
+    def test_writes_and_other_apps_use_the_primary(self):
+        """Test that writes and non-location models stay on the primary."""
+        self.assertIn(router.db_for_read(User), (None, 'default'))
+        self.assertEqual(router.db_for_write(User), 'default')
+        self.assertEqual(router.db_for_write(Capital), 'default')
+
+    def test_reads_follow_a_write_to_the_primary(self):
+        """Test that reads after a write in the same task use the primary."""
+        self.assertTrue(router.db_for_read(State).startswith('replica'))
+        router.db_for_write(State)
+        self.assertEqual(router.db_for_read(State), 'default')
+
+    def test_reads_in_a_transaction_use_the_primary(self):
+        """Test that transactions read what they write from the primary."""
+        primary = connections['default']
+        with mock.patch.object(primary, 'in_atomic_block', True):
+            self.assertEqual(router.db_for_read(State), 'default')
+        self.assertTrue(router.db_for_read(State).startswith('replica'))
+
+    def test_writing_request_sets_sticky_cookie(self):
+        """Test that a client reads from the primary after it writes."""
+        factory = RequestFactory()
+        response = self.serve(factory.post('/'), write=True)
+        self.assertEqual(self.read_from, 'default')
+        cookie = response.cookies[PRIMARY_COOKIE]
+        self.assertEqual(cookie['max-age'], 10)
+
+        request = factory.get('/')
+        request.COOKIES[PRIMARY_COOKIE] = cookie.value
+        self.serve(request)
+        self.assertEqual(self.read_from, 'default')
+
+        response = self.serve(factory.get('/'))
+        self.assertTrue(self.read_from.startswith('replica'))
+        self.assertNotIn(PRIMARY_COOKIE, response.cookies)
+
+    def test_admin_reads_from_the_primary(self):
+        """Test that admin requests never read from a replica."""
+        self.serve(RequestFactory().get(reverse('admin:index')))
+        self.assertEqual(self.read_from, 'default')
+
+    @override_settings(LOCATION_READ_REPLICAS={})
+    def test_no_replicas_means_no_routing(self):
+        """Test that without replicas reads and writes are left alone."""
+        response = self.serve(RequestFactory().post('/'), write=True)
+        self.assertEqual(self.read_from, 'default')
+        self.assertNotIn(PRIMARY_COOKIE, response.cookies)
+        self.assertIsNone(ReplicaRouter().db_for_read(State))
+
+
+class TestExport(TestCase):
+    def export(self, **params):
+        response = self.client.get(reverse('api_export'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response
+
+    def test_csv_export_lists_every_state(self):
+        """Test that the CSV export holds one row per state."""
+        response = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('locations.csv', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(
+            b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(
+            rows[0], {'state': 'Alabama', 'abbr': 'AL',
+                      'capital': 'Montgomery', 'latitude': '32.3777',
+                      'longitude': '-86.3006'})
+
+    def test_ndjson_export_lists_every_state(self):
+        """Test that the NDJSON export holds one record per line."""
+        response = self.export(format='ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 50)
+        self.assertEqual(json.loads(lines[-1])['capital'], 'Cheyenne')
+
+    def test_header_is_sent_before_the_query(self):
+        """Test that the first chunk goes out before rows are read."""
+        chunks = export_chunks('csv', size=20)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                next(chunks), 'state,abbr,capital,latitude,longitude\r\n')
+        # The rest arrives a chunk of rows at a time from one query.
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                [chunk.count('\n') for chunk in chunks], [20, 20, 10])
+
+    def test_invalid_format_is_rejected(self):
+        """Test that an unknown format returns 400."""
+        response = self.client.get(reverse('api_export'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_async_export_streams_from_the_event_loop(self):
+        """Test that the async view's response needs no queries."""
+        expected = await sync_to_async(
+            lambda: ''.join(export_chunks('csv')))()
+        for enabled in (True, False):
+            with self.subTest(index=enabled), self.settings(
+                    LOCATION_LOOKUP_INDEX=enabled):
+                request = AsyncRequestFactory().get('/api/export/')
+                response = await async_views.export_api(request)
+                # Iterated on the event loop, as Django 3.1 does, where
+                # a query would raise SynchronousOnlyOperation.
+                content = b''.join(response.streaming_content)
+                self.assertEqual(content.decode(), expected)
+
+    def test_export_can_be_loaded_back(self):
+        """Test that the command writes a file load_locations accepts."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'locations.ndjson')
+            call_command('export_locations', path, stdout=io.StringIO())
+            out = io.StringIO()
+            call_command('load_locations', path, stdout=out)
+        self.assertIn('Loaded 50 rows', out.getvalue())
+        self.assertIn('0 states updated', out.getvalue())
+
+
+class TestSingleFlight(TestCase):
+    def start_leader(self, flight, key='key'):
+        """Start a slow computation of a key in another thread."""
+        started, release = threading.Event(), threading.Event()
+        results = []
+
+        def compute():
+            started.set()
+            release.wait(5)
+            return 'fresh'
+
+        thread = threading.Thread(
+            target=lambda: results.append(flight.do(key, compute)))
+        thread.start()
+        started.wait(5)
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        return release, thread, results
+
+    def test_concurrent_callers_share_one_computation(self):
+        """Test that callers waiting on a key get the leader's value."""
+        flight = SingleFlight()
+        release, leader, results = self.start_leader(flight)
+        compute = mock.Mock(return_value='again')
+        follower = threading.Thread(target=lambda: results.append(
+            flight.do('key', compute, timeout=5)))
+        follower.start()
+        follower.join(0.1)
+        self.assertTrue(follower.is_alive())
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertCountEqual(
+            results, [('fresh', 'computed'), ('fresh', 'coalesced')])
+        compute.assert_not_called()
+
+    def test_stale_value_is_served_during_a_refill(self):
+        """Test that a caller with a stale value does not wait."""
+        flight = SingleFlight()
+        self.start_leader(flight)
+        self.assertEqual(
+            flight.do('key', mock.Mock(), stale='old'), ('old', 'stale'))
+        self.assertEqual(
+            flight.do('other', lambda: 'new', stale='old'),
+            ('new', 'computed'))
+
+    def test_callers_compute_after_waiting_too_long(self):
+        """Test that a timed out wait falls back to computing."""
+        flight = SingleFlight()
+        self.start_leader(flight)
+        self.assertEqual(
+            flight.do('key', lambda: 'own', timeout=0.01),
+            ('own', 'computed'))
+
+    async def test_callers_on_the_event_loop_do_not_wait(self):
+        """Test that a thread's refill never blocks the event loop."""
+        flight = SingleFlight()
+        release, leader, results = self.start_leader(flight)
+        start = time.monotonic()
+        self.assertEqual(
+            flight.do('key', lambda: 'own', timeout=5), ('own', 'computed'))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(leader.is_alive())
+
+    def test_file_lock_excludes_other_holders(self):
+        """Test that a held file lock times out for other holders."""
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(LOCATION_LOCK_DIR=directory):
+                with file_lock('refill') as acquired:
+                    self.assertTrue(acquired)
+                    with file_lock('refill', timeout=0.02) as other:
+                        self.assertFalse(other)
+                with file_lock('refill', timeout=0.02) as acquired:
+                    self.assertTrue(acquired)
+
+
+class TestPageRefill(TestCase):
+    def setUp(self):
+        invalidate_index()
+        page_cache.clear()
+        stale_pages.clear()
+        self.addCleanup(invalidate_index)
+        self.addCleanup(page_cache.clear)
+        self.addCleanup(stale_pages.clear)
+
+    def change_capital(self):
+        """Retire every cached page and warm the new index."""
+        self.client.get('/', {'state': 'tx'})
+        capital = Capital.objects.get(name='Austin')
+        capital.name = 'Austintown'
+        capital.save()
+        # Share the index as if the change were committed, as the test
+        # transaction keeps it from the other threads' connections.
+        patcher = mock.patch('location.index._uncommitted', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_index()
+
+    def slow_refill(self):
+        """Start rendering a page in another thread and hold it there."""
+        started, release = threading.Event(), threading.Event()
+        render_page = StateListView.render_page
+
+        def slow_render_page(view, *args, **kwargs):
+            started.set()
+            release.wait(5)
+            return render_page(view, *args, **kwargs)
+
+        patcher = mock.patch.object(
+            StateListView, 'render_page', slow_render_page)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(
+            self.client.get('/', {'state': 'tx'})))
+        thread.start()
+        started.wait(5)
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        return release, thread, responses
+
+    def test_requests_during_a_refill_wait_for_it(self):
+        """Test that one request renders while the others wait."""
+        self.change_capital()
+        release, leader, responses = self.slow_refill()
+        follower = threading.Thread(target=lambda: responses.append(
+            self.client.get('/', {'state': 'tx'})))
+        follower.start()
+        follower.join(0.2)
+        self.assertTrue(follower.is_alive())
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertCountEqual(
+            [re.search(r'cache;desc="(\w+)"', response['Server-Timing'])[1]
+             for response in responses],
+            ['miss', 'coalesced'])
+        for response in responses:
+            self.assertContains(response, 'Austintown')
+
+    @override_settings(LOCATION_STALE_WHILE_REVALIDATE=True)
+    def test_stale_page_is_served_while_revalidating(self):
+        """Test that the previous page is served during a refill."""
+        self.change_capital()
+        release, leader, responses = self.slow_refill()
+        response = self.client.get('/', {'state': 'TX'})
+        self.assertIn('cache;desc="stale"', response['Server-Timing'])
+        self.assertContains(response, 'Austin<')
+        release.set()
+        leader.join()
+        self.assertContains(responses[0], 'Austintown')
+        self.assertContains(
+            self.client.get('/', {'state': 'tx'}), 'Austintown')
+
+    def test_missing_snapshot_is_rebuilt_by_one_worker(self):
+        """Test that a worker waiting on the lock reads the new snapshot."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot.bin')
+            with override_settings(
+                    LOCATION_SNAPSHOT_PATH=path,
+                    LOCATION_LOCK_DIR=directory):
+                index = LocationIndex.build()
+                # Another worker writes the snapshot while this one waits.
+                with mock.patch('location.index.read_snapshot',
+                                side_effect=[None, index]) as read:
+                    with self.assertNumQueries(0):
+                        self.assertIs(get_index(), index)
+        self.assertEqual(read.call_count, 2)
+
+
+class TestBoot(TestCase):
+    def setUp(self):
+        directories = [tempfile.TemporaryDirectory() for i in range(3)]
+        for directory in directories:
+            self.addCleanup(directory.cleanup)
+        state, self.static_root, self.static_source = (
+            directory.name for directory in directories)
+        with open(os.path.join(self.static_source, 'site.css'), 'w') as f:
+            f.write('body { color: black; }')
+        settings = override_settings(
+            LOCATION_BOOT_STATE_DIR=state,
+            LOCATION_PRERENDER_DIR=None,
+            STATIC_ROOT=self.static_root,
+            STATICFILES_DIRS=[self.static_source])
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def steps(self, **kwargs):
+        return [(result.name, result.ran) for result in boot(**kwargs)]
+
+    def test_unchanged_steps_are_skipped(self):
+        """Test that a second boot skips migrate and collectstatic."""
+        self.assertEqual(
+            self.steps(), [('migrate', True), ('collectstatic', True)])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.static_root, 'site.css')))
+        self.assertEqual(
+            self.steps(), [('migrate', False), ('collectstatic', False)])
+        self.assertEqual(
+            self.steps(force=True),
+            [('migrate', True), ('collectstatic', True)])
+
+    def test_changed_static_sources_are_collected(self):
+        """Test that editing a static file collects static files again."""
+        self.steps()
+        static = load_state()['collectstatic']
+        with open(os.path.join(self.static_source, 'site.css'), 'w') as f:
+            f.write('body { color: navy; }')
+        self.assertEqual(
+            self.steps(), [('migrate', False), ('collectstatic', True)])
+        self.assertNotEqual(load_state()['collectstatic'], static)
+        with open(os.path.join(self.static_root, 'site.css')) as f:
+            self.assertIn('navy', f.read())
+
+    def test_missing_static_root_is_collected(self):
+        """Test that an emptied static volume is filled again."""
+        self.steps()
+        os.remove(os.path.join(self.static_root, 'site.css'))
+        for name in os.listdir(self.static_root):
+            path = os.path.join(self.static_root, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        self.assertIn(('collectstatic', True), self.steps())
+
+    def test_changed_migrations_are_applied(self):
+        """Test that a different migration graph runs migrate again."""
+        self.steps()
+        with mock.patch('location.boot.migrations_hash', return_value='x'), \
+                mock.patch('location.boot.call_command') as command:
+            self.assertEqual(
+                self.steps(), [('migrate', True), ('collectstatic', False)])
+        self.assertEqual(
+            [call.args[0] for call in command.call_args_list],
+            ['makemigrations', 'migrate'])
+
+    def test_unapplied_migrations_are_applied(self):
+        """Test that a database missing migrations is migrated again."""
+        self.steps()
+        self.assertFalse(migrations_pending())
+        with mock.patch(
+                'location.boot.migrations_pending', return_value=True), \
+                mock.patch('location.boot.call_command') as command:
+            self.assertEqual(
+                self.steps(), [('migrate', True), ('collectstatic', False)])
+        self.assertIn('migrate', [
+            call.args[0] for call in command.call_args_list])
+
+    def test_command_reports_phase_timings(self):
+        """Test that the boot command prints how long each step took."""
+        out = io.StringIO()
+        call_command('boot', stdout=out)
+        call_command('boot', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertRegex(lines[-3], r'^migrate +skipped +\d+\.\d{3}s$')
+        self.assertRegex(lines[-2], r'^collectstatic +skipped ')
+        self.assertRegex(lines[-1], r'^Booted in \d+\.\d{3}s\.$')
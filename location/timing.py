@@ -0,0 +1,30 @@
+"""
+Per-request timing breakdown reported by ServerTimingMiddleware.
+
+Code that does measurable work during a request records it here; the
+calls do nothing when the middleware is not installed.
+"""
+import time
+from contextlib import contextmanager
+
+
+def add_timing(request, name, duration):
+    """Add ``duration`` seconds to the named timing of a request."""
+    timings = getattr(request, 'server_timing', None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + duration
+
+
+def set_cache_status(request, status):
+    """Record whether a request was served from cache ('hit' or 'miss')."""
+    request.cache_status = status
+
+
+@contextmanager
+def timed(request, name):
+    """Time the enclosed block as the named timing of a request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(request, name, time.perf_counter() - start)
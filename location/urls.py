@@ -1,6 +1,43 @@
+from django.conf import settings
 from django.urls import path
-from .views import StateListView
+
+from . import async_views
+from .views import (
+    AutocompleteAPIView, BatchLookupAPIView, BatchNearestAPIView,
+    CapitalDetailAPIView, DistanceMatrixAPIView, ExportAPIView, MetricsView,
+    NearestAPIView, StateDetailAPIView, StateListAPIView, StateListView
+)
+
+if getattr(settings, 'LOCATION_ASYNC_VIEWS', False):
+    # Serve read-only views from the event loop under ASGI.
+    state_list = async_views.state_list
+    state_list_api = async_views.state_list_api
+    state_detail_api = async_views.state_detail_api
+    capital_detail_api = async_views.capital_detail_api
+    autocomplete_api = async_views.autocomplete_api
+    export_api = async_views.export_api
+    nearest_api = async_views.nearest_api
+else:
+    state_list = StateListView.as_view()
+    state_list_api = StateListAPIView.as_view()
+    state_detail_api = StateDetailAPIView.as_view()
+    capital_detail_api = CapitalDetailAPIView.as_view()
+    autocomplete_api = AutocompleteAPIView.as_view()
+    export_api = ExportAPIView.as_view()
+    nearest_api = NearestAPIView.as_view()
 
 urlpatterns = [
-    path('', StateListView.as_view(), name='states'),
+    path('', state_list, name='states'),
+    path('api/states/', state_list_api, name='api_states'),
+    path('api/autocomplete/', autocomplete_api, name='api_autocomplete'),
+    path('api/lookup/', BatchLookupAPIView.as_view(), name='api_lookup'),
+    path('api/nearest/', nearest_api, name='api_nearest'),
+    path('api/nearest/batch/', BatchNearestAPIView.as_view(),
+         name='api_nearest_batch'),
+    path('api/distances/', DistanceMatrixAPIView.as_view(),
+         name='api_distances'),
+    path('api/export/', export_api, name='api_export'),
+    path('api/states/<str:abbr>/', state_detail_api, name='api_state'),
+    path('api/capitals/<str:name>/', capital_detail_api, name='api_capital'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,57 +1,432 @@
-from django.views.generic import ListView
+import hashlib
+import json
 
-from .models import State, Capital
+from django.conf import settings
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+)
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import ListView, View
 
+from .autocomplete import get_autocomplete
+from .cache import CachedPageMixin
+from .distances import (
+    UnknownCapital, get_distance_matrix, parse_queries, to_npy
+)
+from .export import CONTENT_TYPES, export_chunks, preloaded_rows
+from .geo import get_nearest_index, parse_neighbors, parse_point
+from .lookups import (
+    NOT_FOUND_MESSAGES, ROW_FIELDS, find_states, lookup_type, paginate_states,
+    resolve_many, state_rows, states_for_capital_query, states_for_state_query
+)
+from .metrics import render_metrics
+from .pagination import pagination_params
+from .models import State
 
-class StateListView(ListView):
+
+class StateListView(CachedPageMixin, ListView):
     model = State
     template_name = 'location/home.html'
     context_object_name = 'states'
+    query_budget = 1
+    compressible = True
+    page = None
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.pagination = pagination_params(request.GET)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        return super().get(request, *args, **kwargs)
 
     def get_queryset(self, **kwargs):
-        state_query = self.request.GET.get('state', None)
-        capital_query = self.request.GET.get('capital', None)
-
-        if state_query:
-            if len(state_query) == 2:
-                # Return state matching state abbreviation
-                try:
-                    queryset = State.objects.filter(abbr=state_query.upper())
-                    if queryset:
-                        return queryset
-                    else:
-                        raise AttributeError
-                except (AttributeError, IndexError):
-                    context = {}
-                    context['message'] = 'State not found!'
-                    return context
+        kind, queryset = find_states(self.request.GET)
+        self.request.lookup_type = lookup_type(self.request.GET, queryset)
+        if kind == 'list' and self.pagination:
+            self.page = paginate_states(*self.pagination)
+            return self.page.items
+        if queryset or kind == 'list':
+            return queryset
+        return {'message': NOT_FOUND_MESSAGES[kind]}
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if self.page is not None:
+            context.update(
+                page_size=self.pagination[1],
+                next_cursor=self.page.next_cursor,
+                previous_cursor=self.page.previous_cursor,
+            )
+        return context
+
+
+class LocationAPIView(View):
+    """Base view for the JSON read API."""
+    http_method_names = ['get', 'head', 'options']
+    query_budget = 1
+    compressible = True
+
+    def get_fields(self):
+        """Return the row fields requested with the fields parameter."""
+        fields = self.request.GET.get('fields', None)
+        if not fields:
+            return ROW_FIELDS
+        fields = tuple(field.strip() for field in fields.split(','))
+        unknown = [field for field in fields if field not in ROW_FIELDS]
+        if unknown:
+            raise ValueError('Unknown field(s): {}'.format(', '.join(unknown)))
+        return fields
+
+    def get_states(self, **kwargs):
+        """Return the kind of lookup made and the matching states."""
+        raise NotImplementedError
+
+    def get_lookup_params(self, **kwargs):
+        """Return the lookup as state or capital request parameters."""
+        return self.request.GET
+
+    def render_rows(self, rows):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = self.get_fields()
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        kind, states = self.get_states(**kwargs)
+        rows = [
+            {field: row[field] for field in fields}
+            for row in state_rows(states)
+        ]
+        request.lookup_type = lookup_type(
+            self.get_lookup_params(**kwargs), rows)
+        if not rows and kind != 'list':
+            return JsonResponse(
+                {'error': NOT_FOUND_MESSAGES[kind]}, status=404)
+        return JsonResponse(self.render_rows(rows))
+
+
+class StateListAPIView(LocationAPIView):
+    """
+    List states, optionally filtered by state or capital.
+
+    The full list is paginated when a page_size or cursor is given.
+    """
+    page = None
+
+    def get(self, request, *args, **kwargs):
+        try:
+            self.pagination = pagination_params(request.GET)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return super().get(request, *args, **kwargs)
+
+    def get_states(self):
+        kind, states = find_states(self.request.GET)
+        if kind == 'list' and self.pagination:
+            self.page = paginate_states(*self.pagination)
+            return kind, self.page.items
+        return kind, states
+
+    def render_rows(self, rows):
+        if self.page is None:
+            return {'states': rows}
+        return {
+            'states': rows,
+            'next_cursor': self.page.next_cursor,
+            'previous_cursor': self.page.previous_cursor,
+        }
+
+
+class StateDetailAPIView(LocationAPIView):
+    """Return the state matching an abbreviation or name."""
+
+    def get_states(self, abbr):
+        return 'state', states_for_state_query(abbr)
+
+    def get_lookup_params(self, abbr):
+        return {'state': abbr}
+
+    def render_rows(self, rows):
+        return rows[0]
+
+
+class CapitalDetailAPIView(LocationAPIView):
+    """Return the state whose capital matches a capital name."""
+
+    def get_states(self, name):
+        return 'capital', states_for_capital_query(name)
+
+    def get_lookup_params(self, name):
+        return {'capital': name}
+
+    def render_rows(self, rows):
+        return rows[0]
+
+
+class AutocompleteAPIView(View):
+    """Suggest states and capitals for a partial query."""
+    http_method_names = ['get', 'head', 'options']
+    query_budget = 1
+    compressible = True
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '')
+        try:
+            limit = int(request.GET.get('limit', 10))
+        except ValueError:
+            return JsonResponse(
+                {'error': 'limit must be a number.'}, status=400)
+
+        results = [
+            {
+                'text': entry.text,
+                'kind': entry.kind,
+                'name': entry.state.name,
+                'abbr': entry.state.abbr,
+                'capital': entry.state.capital.name,
+            }
+            for entry in get_autocomplete().suggest(query, max(limit, 0))
+        ]
+        return JsonResponse({'query': query, 'results': results})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchLookupAPIView(LocationAPIView):
+    """
+    Resolve many state abbreviations, state names and capital names.
+
+    Expects a JSON body of the form {"queries": ["TX", "Salt Lake City"]}
+    and answers with one result per query, in input order.
+    """
+    http_method_names = ['post', 'options']
+
+    def get_queries(self):
+        """Return the queries from the request body."""
+        try:
+            queries = json.loads(self.request.body)['queries']
+        except (ValueError, TypeError, KeyError):
+            raise ValueError('Expected a JSON object with a "queries" list.')
+        if not isinstance(queries, list) or not all(
+                isinstance(query, str) for query in queries):
+            raise ValueError('"queries" must be a list of strings.')
+        limit = getattr(settings, 'LOCATION_BATCH_LIMIT', 1000)
+        if len(queries) > limit:
+            raise ValueError(
+                'At most {} queries are allowed per request.'.format(limit))
+        return queries
+
+    def post(self, request, *args, **kwargs):
+        try:
+            fields = self.get_fields()
+            queries = self.get_queries()
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        states = resolve_many(queries)
+        rows = iter(state_rows([state for state in states if state]))
+        results = []
+        for query, state in zip(queries, states):
+            if state is None:
+                results.append({'query': query, 'found': False})
+                continue
+            row = next(rows)
+            results.append({
+                'query': query,
+                'found': True,
+                'state': {field: row[field] for field in fields},
+            })
+        return JsonResponse({'results': results})
+
+
+class NearestAPIView(LocationAPIView):
+    """
+    Return the k capitals nearest a point, closest first.
+
+    Expects lat and lon query parameters and an optional k (1 by default).
+    """
+
+    def get_neighbor_rows(self, neighbors, fields, rows):
+        """
+        Return the neighbours of a point as plain rows, reusing the state
+        rows already built in ``rows``.
+        """
+        missing = [
+            neighbor.state for neighbor in neighbors
+            if neighbor.state.id not in rows
+        ]
+        for state, row in zip(missing, state_rows(missing)):
+            rows[state.id] = {field: row[field] for field in fields}
+        return [
+            {
+                'distance_km': round(neighbor.distance_km, 3),
+                'latitude': neighbor.state.capital.latitude,
+                'longitude': neighbor.state.capital.longitude,
+                'state': rows[neighbor.state.id],
+            }
+            for neighbor in neighbors
+        ]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = self.get_fields()
+            latitude, longitude = parse_point(
+                request.GET.get('lat', None), request.GET.get('lon', None))
+            k = parse_neighbors(request.GET.get('k', 1))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        request.lookup_type = 'nearest'
+        neighbors = get_nearest_index().nearest(latitude, longitude, k)
+        return JsonResponse({
+            'latitude': latitude,
+            'longitude': longitude,
+            'results': self.get_neighbor_rows(neighbors, fields, {}),
+        })
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchNearestAPIView(NearestAPIView):
+    """
+    Return the k capitals nearest each of many points.
+
+    Expects a JSON body of the form {"points": [[30.2, -97.7]], "k": 1}
+    and answers with one result per point, in input order.
+    """
+    http_method_names = ['post', 'options']
+
+    def get_points(self):
+        """Return the points and k from the request body."""
+        try:
+            body = json.loads(self.request.body)
+            points = body['points']
+            k = body.get('k', 1)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise ValueError('Expected a JSON object with a "points" list.')
+        if not isinstance(points, list) or not all(
+                isinstance(point, list) and len(point) == 2
+                for point in points):
+            raise ValueError(
+                '"points" must be a list of [latitude, longitude] pairs.')
+        limit = getattr(settings, 'LOCATION_NEAREST_BATCH_LIMIT', 10000)
+        if len(points) > limit:
+            raise ValueError(
+                'At most {} points are allowed per request.'.format(limit))
+        return [parse_point(*point) for point in points], parse_neighbors(k)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            fields = self.get_fields()
+            points, k = self.get_points()
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        request.lookup_type = 'nearest'
+        # Each state's row is built once however many points it serves.
+        rows = {}
+        results = [
+            {
+                'point': list(point),
+                'results': self.get_neighbor_rows(neighbors, fields, rows),
+            }
+            for point, neighbors in zip(
+                points, get_nearest_index().nearest_many(points, k))
+        ]
+        return JsonResponse({'results': results})
+
+
+class DistanceMatrixAPIView(View):
+    """
+    Return great-circle distances between state capitals.
+
+    The from and to parameters take comma separated state abbreviations,
+    state names or capital names and default to every capital. Add
+    format=npy for the distances as a NumPy array, whose row and column
+    states are listed in the X-Distance-Rows and X-Distance-Columns
+    headers.
+    """
+    http_method_names = ['get', 'head', 'options']
+    query_budget = 1
+    compressible = True
+
+    def get(self, request, *args, **kwargs):
+        output_format = request.GET.get('format', 'json')
+        if output_format not in ('json', 'npy'):
+            return JsonResponse(
+                {'error': 'format must be json or npy.'}, status=400)
+
+        request.lookup_type = 'distance'
+        matrix = get_distance_matrix()
+        sources = parse_queries(request.GET.get('from', None))
+        targets = parse_queries(request.GET.get('to', None))
+        try:
+            sources = matrix.resolve(sources)
+            targets = matrix.resolve(targets)
+        except UnknownCapital as e:
+            return JsonResponse({'error': str(e)}, status=404)
+
+        if output_format == 'npy':
+            if sources is matrix.states and targets is matrix.states:
+                content = matrix.to_npy()
             else:
-                # Return state matching state name
-                try:
-                    queryset = State.objects.filter(
-                        name=state_query.replace('_', ' ').title())
-                    if queryset:
-                        return queryset
-                    else:
-                        raise AttributeError
-                except (AttributeError, IndexError):
-                    context = {}
-                    context['message'] = 'State not found!'
-                    return context
-        elif capital_query:
-            # Return state matching capital name
-            try:
-                capital = Capital.objects.filter(
-                    name=capital_query.replace('_', ' ').title())
-                queryset = State.objects.filter(capital=capital[0])
-                if queryset:
-                    return queryset
-                else:
-                    raise AttributeError
-            except (AttributeError, IndexError):
-                context = {}
-                context['message'] = 'Capital not found!'
-                return context
+                content = to_npy(matrix.distances(sources, targets))
+            response = HttpResponse(
+                content, content_type='application/octet-stream')
+            response['X-Distance-Rows'] = ','.join(
+                state.abbr for state in sources)
+            response['X-Distance-Columns'] = ','.join(
+                state.abbr for state in targets)
         else:
-            # Return all states and capitals
-            return State.objects.all()
+            response = JsonResponse({
+                'from': [state.abbr for state in sources],
+                'to': [state.abbr for state in targets],
+                'distances_km': matrix.distances(
+                    sources, targets).round(3).tolist(),
+            })
+
+        etag = '"{}"'.format(hashlib.sha1(response.content).hexdigest())
+        response['ETag'] = etag
+        return get_conditional_response(
+            request, etag=etag, response=response)
+
+
+class ExportAPIView(View):
+    """
+    Stream every state and its capital as CSV (the default) or NDJSON,
+    selected with the format parameter.
+    """
+    http_method_names = ['get', 'head', 'options']
+    query_budget = 1
+    # Read every row before the response starts, for the async view.
+    preload = False
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in CONTENT_TYPES:
+            return JsonResponse(
+                {'error': 'format must be csv or ndjson.'}, status=400)
+
+        request.lookup_type = 'export'
+        rows = preloaded_rows() if self.preload else None
+        response = StreamingHttpResponse(
+            export_chunks(export_format, rows=rows),
+            content_type='{}; charset=utf-8'.format(
+                CONTENT_TYPES[export_format]))
+        response['Content-Disposition'] = (
+            'attachment; filename="locations.{}"'.format(export_format))
+        return response
+
+
+class MetricsView(View):
+    """Report request metrics of all workers in the Prometheus format."""
+    http_method_names = ['get', 'head', 'options']
+    query_budget = 0
+    compressible = True
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(
+            render_metrics(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')